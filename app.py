@@ -1,11 +1,64 @@
 import io
-import re
-import base64
-import requests
+import time
+import uuid
+import hashlib
+from pathlib import Path
+
 from PIL import Image
-from huggingface_hub import InferenceClient
 import streamlit as st
 
+import comic_core
+from comic_core import (
+    EXTENSOES_VIDEO,
+    HF_PROVIDERS,
+    ImagemGerada,
+    LIMITE_CONCORRENCIA_PADRAO,
+    MODELOS_HF_IMAGEM,
+    MODELO_HF_INICIAL,
+    MODELO_LOCAL,
+    MODELO_OPENROUTER_INICIAL,
+    NEGATIVE_COMIC_PADRAO,
+    PROMPT_COMIC_PADRAO,
+    PROVEDOR_LOCAL,
+    chave_limite_provedor,
+    codificar_miniatura,
+    compactar_bruto,
+    comparar_modelos,
+    configurar,
+    descrever_candidato,
+    dividir_em_tiles,
+    estatisticas_sessao_http,
+    estilo_local_do_prompt,
+    formato_animacao,
+    gerar_animacao,
+    gerar_com_cache,
+    gerar_com_hedge,
+    gerar_em_tiles,
+    gerar_imagem_de_outra_openrouter,
+    gerar_imagem_huggingface_img2img,
+    gerar_imagem_local_comic,
+    medir,
+    montar_candidatos_comparacao,
+    montar_alternativas_hedge,
+    modelos_openrouter_disponiveis,
+    montar_prompt_final,
+    obter_cache_resultados,
+    obter_catalogo_openrouter,
+    obter_fila_jobs,
+    obter_geracoes_em_andamento,
+    obter_indice_similares,
+    obter_limitador_concorrencia,
+    obter_limitador_taxa,
+    obter_memoria_metodos_hf,
+    obter_metricas,
+    obter_registro_clientes_hf,
+    obter_roteador_providers_hf,
+    obter_sessao_openrouter,
+    processar_lote,
+    renderizar_comic_local,
+    tags_do_bruto,
+)
+
 # =========================
 # CONFIGURAÇÕES GERAIS
 # =========================
@@ -17,7 +70,7 @@ st.set_page_config(
 )
 
 st.title("🖼️ Comic Book Image Studio")
-st.caption("Transforme uma imagem em estilo comic book usando OpenRouter ou Hugging Face")
+st.caption("Transforme uma imagem em estilo comic book usando OpenRouter, Hugging Face ou o motor local")
 
 # ---- Senha simples de acesso ----
 APP_PASSWORD = st.secrets.get("APP_PASSWORD", "1234")
@@ -34,438 +87,341 @@ st.success("Acesso liberado! ✅")
 # SECRETS / CHAVES
 # =========================
 
-OPENROUTER_API_KEY = st.secrets.get("OPENROUTER_API_KEY", "")
-
-HF_TOKEN = (
-    st.secrets.get("HF_TOKEN", "")
-    or st.secrets.get("HUGGINGFACE_API_KEY", "")
-)
-
-APP_REFERER = st.secrets.get("APP_REFERER", "https://streamlit.app")
-APP_TITLE = st.secrets.get("APP_TITLE", "Comic Book Image Studio")
+configurar(st.secrets)
 
 # =========================
-# ENDPOINTS
+# SESSÃO
 # =========================
 
-OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+UPLOADS_MAX_ENTRADAS = int(st.secrets.get("UPLOADS_MAX_ENTRADAS", 64))
+RESULTADOS_SESSAO_MAX_ITENS = int(st.secrets.get("RESULTADOS_SESSAO_MAX_ITENS", 20))
+RESULTADOS_SESSAO_MAX_BYTES = int(st.secrets.get("RESULTADOS_SESSAO_MAX_BYTES", 100 * 1024 * 1024))
 
 # =========================
-# PROVEDOR
+# EXIBIÇÃO
 # =========================
 
-provedor = st.selectbox(
-    "Provedor",
-    ["OpenRouter", "Hugging Face"],
-    index=0,
-)
+# Largura (px) das miniaturas mostradas na coluna principal; metade nas colunas duplas
+EXIBICAO_LARGURA = int(st.secrets.get("EXIBICAO_LARGURA", 800))
 
 # =========================
-# MODELOS OPENROUTER
+# FILA DE JOBS
 # =========================
 
-MODELO_OPENROUTER_INICIAL = "x-ai/grok-imagine-image-quality"
+JOBS_INTERVALO_ATUALIZACAO = float(st.secrets.get("JOBS_INTERVALO_ATUALIZACAO", 2))
 
-MODELOS_OPENROUTER_IMAGEM = [
-    "x-ai/grok-imagine-image-quality",
-    "black-forest-labs/flux.2-max",
-    "black-forest-labs/flux.2-klein-4b",
-    "bytedance-seed/seedream-4.5",
-    "recraft/recraft-v4.1-pro-vector",
-    "qwen/qwen3.7-plus",
-    "openrouter/auto",
-]
+# Opção do seletor de provider HF que delega a escolha ao roteador
+HF_PROVIDER_AUTOMATICO = "automático (roteador)"
 
 # =========================
-# MODELOS HUGGING FACE
+# FUNÇÕES DE INTERFACE
 # =========================
 
-MODELO_HF_INICIAL = "black-forest-labs/FLUX.2-klein-9B"
-
-MODELOS_HF_IMAGEM = [
-    "black-forest-labs/FLUX.2-klein-9B",
-    "Qwen/Qwen-Image-Edit-2511",
-    "autoweeb/Qwen-Image-Edit-2509-Photo-to-Anime",
-    "timbrooks/instruct-pix2pix",
-    "nitrosocke/comic-diffusion",
-    "runwayml/stable-diffusion-v1-5",
-    "stabilityai/stable-diffusion-xl-base-1.0",
-]
-
-HF_PROVIDER_INICIAL = "replicate"
-
-HF_PROVIDERS = [
-    "replicate",
-    "fal-ai",
-    "wavespeed",
-]
-# =========================
-# PROMPTS PADRÃO
-# =========================
-
-PROMPT_COMIC_PADRAO = (
-    "Transform the uploaded image into a Western comic book illustration. "
-    "Preserve the person's identity, pose, body proportions, composition, and main scene elements. "
-    "Convert the image into a detailed comic book style with bold clean ink lines, "
-    "rich cel shading, soft halftone texture, expressive contours, strong highlights and shadows, "
-    "vibrant but balanced colors, and a polished graphic novel appearance. "
-    "Do not make it photorealistic. "
-    "The final result should clearly look like a drawn comic book illustration, not a painted photo."
-)
+def download_button_from_imagem(img: ImagemGerada, filename_base: str, label: str, key: str | None = None):
+    """
+    Cria botão de download servindo os bytes originais da imagem gerada.
+    """
+    st.download_button(
+        label=label,
+        data=img.dados,
+        file_name=f"{filename_base}{img.extensao}",
+        mime=img.mime,
+        key=key,
+    )
 
-NEGATIVE_COMIC_PADRAO = (
-    "photorealistic, realistic photo, photo filter, oil painting, watercolor, blurry, low quality, pixelated, noisy, "
-    "anime, manga, cartoon for kids, 3d render, cgi, deformed anatomy, extra limbs, extra fingers, "
-    "mutated hands, warped face, asymmetrical eyes, distorted proportions, text, watermark, logo, caption"
-)
 
 # =========================
-# FUNÇÕES AUXILIARES
+# UPLOADS E RESULTADOS DA SESSÃO
 # =========================
 
-def sugerir_provider_hf(model_id: str) -> str:
+@st.cache_resource(max_entries=UPLOADS_MAX_ENTRADAS)
+def decodificar_upload(_dados: bytes, hash_conteudo: str) -> Image.Image:
     """
-    Sugere provider Hugging Face de acordo com o modelo.
+    Decodifica o upload uma única vez por conteúdo; reruns reaproveitam a imagem.
+    A imagem retornada é compartilhada e não deve ser modificada.
     """
+    return Image.open(io.BytesIO(_dados)).convert("RGB")
 
-    if model_id == "Qwen/Qwen-Image-Edit-2511":
-        return "fal-ai"
 
-    if model_id == "autoweeb/Qwen-Image-Edit-2509-Photo-to-Anime":
-        return "wavespeed"
+def carregar_upload(arquivo) -> Image.Image:
+    dados = arquivo.getvalue()
+    return decodificar_upload(dados, hashlib.sha256(dados).hexdigest())
 
-    if model_id == "black-forest-labs/FLUX.2-klein-9B":
-        return "replicate"
 
-    return "replicate"
-
-def pil_to_data_url(img: Image.Image, format_: str = "PNG") -> str:
+@st.cache_resource(max_entries=UPLOADS_MAX_ENTRADAS)
+def previa_comic_local(_imagem: Image.Image, chave_upload: str, largura: int) -> bytes:
     """
-    Converte uma PIL Image em data URL base64.
+    Prévia do motor local para o upload, no estilo do prompt padrão, já
+    como miniatura. Calculada uma vez por arquivo enviado.
     """
-    buffer = io.BytesIO()
-    img.save(buffer, format=format_)
-    mime = "image/png" if format_.upper() == "PNG" else "image/jpeg"
-    b64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-    return f"data:{mime};base64,{b64}"
+    with medir("previa_local", provedor="local", modelo=MODELO_LOCAL):
+        previa = renderizar_comic_local(
+            _imagem,
+            estilo_local_do_prompt(PROMPT_COMIC_PADRAO),
+            lado_maximo=comic_core.LOCAL_LADO_PREVIA,
+        )
 
+    return codificar_miniatura(previa, largura)
 
-def data_url_to_pil(data_url: str) -> Image.Image:
+
+@st.cache_resource(max_entries=UPLOADS_MAX_ENTRADAS)
+def miniatura_upload(_imagem: Image.Image, chave_upload: str, largura: int) -> bytes:
     """
-    Converte data URL base64 para PIL Image.
+    Miniatura do upload para a tela, gerada uma vez por arquivo e largura.
     """
-    if "," not in data_url:
-        raise ValueError("Data URL inválida.")
-
-    _, b64_data = data_url.split(",", 1)
-    img_bytes = base64.b64decode(b64_data)
-    return Image.open(io.BytesIO(img_bytes)).convert("RGB")
+    return codificar_miniatura(_imagem, largura)
 
 
-def base64_puro_para_imagem(b64_data: str) -> Image.Image:
+def exibir_com_zoom(miniatura: bytes, completa, chave: str, legenda: str | None = None):
     """
-    Converte base64 puro para PIL Image.
+    Mostra a miniatura; a imagem em resolução total só é enviada ao
+    navegador quando o usuário liga o zoom.
     """
-    img_bytes = base64.b64decode(b64_data)
-    return Image.open(io.BytesIO(img_bytes)).convert("RGB")
+    if st.toggle("🔍 Resolução total", key=f"zoom_{chave}"):
+        st.image(completa, caption=legenda, use_column_width=True)
+    else:
+        st.image(miniatura, caption=legenda, use_column_width=True)
 
 
-def download_button_from_pil(img: Image.Image, filename: str, label: str):
+def guardar_resultado_sessao(titulo: str, nome_base: str, imagens: list[ImagemGerada], bruto, cache_hit: bool):
     """
-    Cria botão de download para imagem PIL.
+    Guarda o resultado em st.session_state para sobreviver aos reruns,
+    descartando os mais antigos acima dos limites de itens e de bytes.
     """
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-
-    st.download_button(
-        label=label,
-        data=buf.getvalue(),
-        file_name=filename,
-        mime="image/png",
-    )
+    resultados = st.session_state.setdefault("resultados", [])
 
+    # A sessão guarda só os bytes; os pixels decodificados não entram no histórico
+    for img in imagens:
+        img.liberar_pixels()
 
-def montar_prompt_final(prompt: str, negative_prompt: str, preservar_fundo: bool) -> str:
-    """
-    Monta o prompt final enviado ao modelo.
-    """
-    partes = [prompt.strip()]
+    st.session_state["proximo_resultado_id"] = st.session_state.get("proximo_resultado_id", 0) + 1
 
-    if preservar_fundo:
-        partes.append(
-            "Preserve the original background and scene layout as much as possible."
-        )
-    else:
-        partes.append(
-            "You may simplify the background while preserving the main subject and scene readability."
-        )
+    resultados.append({
+        "id": st.session_state["proximo_resultado_id"],
+        "titulo": titulo,
+        "nome_base": nome_base,
+        "imagens": imagens,
+        "bruto": compactar_bruto(bruto),
+        "cache_hit": cache_hit,
+        "criado_em": time.time(),
+    })
 
-    if negative_prompt.strip():
-        partes.append("Negative prompt / avoid:")
-        partes.append(negative_prompt.strip())
+    total = sum(img.bytes_em_memoria for r in resultados for img in r["imagens"])
 
-    return "\n\n".join(partes)
+    while resultados and (
+        len(resultados) > RESULTADOS_SESSAO_MAX_ITENS
+        or (total > RESULTADOS_SESSAO_MAX_BYTES and len(resultados) > 1)
+    ):
+        removido = resultados.pop(0)
+        total -= sum(img.bytes_em_memoria for img in removido["imagens"])
 
 
-def extract_images_from_openrouter(data: dict) -> list[Image.Image]:
+def exibir_resultado(resultado: dict):
     """
-    Extrai imagens da resposta do OpenRouter.
+    Exibe um resultado guardado na sessão, com download dos bytes originais.
     """
-    imagens = []
-
-    choices = data.get("choices", [])
-    if not choices:
-        return imagens
+    st.markdown(f"### {resultado['titulo']}")
 
-    message = choices[0].get("message", {})
-    content = message.get("content")
+    similar = resultado["bruto"].get("similar") if isinstance(resultado["bruto"], dict) else None
 
-    # Caso 1: content como lista multimodal
-    if isinstance(content, list):
-        for item in content:
-            if not isinstance(item, dict):
-                continue
-
-            tipo = item.get("type")
-
-            if tipo == "image_url":
-                image_url = item.get("image_url", {})
-                url = image_url.get("url", "") if isinstance(image_url, dict) else ""
-
-                if isinstance(url, str) and url.startswith("data:image/"):
-                    imagens.append(data_url_to_pil(url))
-
-            elif tipo in ("image", "output_image"):
-                url = item.get("url") or item.get("image_url") or ""
+    if similar:
+        st.caption(
+            f"⚡ Resultado reaproveitado de uma imagem parecida já transformada "
+            f"(distância {similar['distancia']} de 64 bits no hash perceptual)."
+        )
+    elif isinstance(resultado["bruto"], dict) and resultado["bruto"].get("agregado"):
+        st.caption("⚡ Resultado compartilhado com um pedido idêntico que já estava em andamento.")
+    elif resultado["cache_hit"]:
+        st.caption("⚡ Resultado servido do cache (mesma imagem, prompt e parâmetros).")
+    else:
+        st.caption("🌐 Resultado gerado pelo provedor e salvo no cache.")
+
+    bruto = resultado["bruto"]
+    entrada = bruto.get("entrada") if isinstance(bruto, dict) else None
+    if entrada:
+        st.caption(
+            f"Entrada enviada: {entrada['dimensoes_originais']} → {entrada['dimensoes_enviadas']} "
+            f"({entrada['formato']}), {entrada['bytes_rgb_originais'] / 1e6:.1f} MB em pixels → "
+            f"{entrada['bytes_enviados'] / 1e3:.0f} KB."
+        )
 
-                if isinstance(url, dict):
-                    url = url.get("url", "")
+    for idx, img in enumerate(resultado["imagens"], start=1):
+        miniatura = img.miniatura(EXIBICAO_LARGURA)
 
-                if isinstance(url, str) and url.startswith("data:image/"):
-                    imagens.append(data_url_to_pil(url))
+        with medir("renderizacao", bytes=len(miniatura), **tags_do_bruto(bruto)):
+            exibir_com_zoom(miniatura, img.dados, chave=f"{resultado['id']}_{idx}")
 
-    # Caso 2: content como string com data URL
-    elif isinstance(content, str):
-        encontrados = re.findall(
-            r"data:image\/[a-zA-Z]+;base64,[A-Za-z0-9+/=]+",
-            content
+        download_button_from_imagem(
+            img,
+            f"{resultado['nome_base']}_{idx}",
+            f"⬇️ Baixar resultado {idx}",
+            key=f"download_{resultado['id']}_{idx}",
         )
 
-        for data_url in encontrados:
-            imagens.append(data_url_to_pil(data_url))
+    with st.expander("Ver resposta bruta da API"):
+        st.json(bruto)
 
-    # Caso 3: fallback message.images
-    imagens_msg = message.get("images", [])
 
-    if isinstance(imagens_msg, list):
-        for item in imagens_msg:
-            if not isinstance(item, dict):
-                continue
+def resumo_celula_comparacao(celula: dict) -> dict:
+    """
+    Linha da tabela da comparação: latência e tamanho dos dados de uma célula.
+    """
+    return {
+        "modelo": celula["candidato"],
+        "variante": celula["variante"],
+        "segundos": None if celula["segundos"] is None else round(celula["segundos"], 1),
+        "cache": celula["cache_hit"],
+        "kb_enviados": None if celula["bytes_enviados"] is None else round(celula["bytes_enviados"] / 1e3),
+        "kb_recebidos": round(celula["bytes_recebidos"] / 1e3),
+        "erro": None if celula["erro"] is None else str(celula["erro"])[:200],
+    }
 
-            image_url = item.get("image_url", {})
-            url = ""
 
-            if isinstance(image_url, dict):
-                url = image_url.get("url", "")
-            elif isinstance(image_url, str):
-                url = image_url
+# =========================
+# PÁGINAS
+# =========================
 
-            if isinstance(url, str) and url.startswith("data:image/"):
-                imagens.append(data_url_to_pil(url))
+def pagina_metricas():
+    """
+    Painel de latência: p50/p95/p99 por modelo e estágio, com exportação.
+    """
+    st.subheader("📊 Latência por estágio")
 
-    return imagens
+    metricas = obter_metricas()
+    linhas = metricas.resumo()
 
+    if not linhas:
+        st.info("Nenhuma medição ainda. Gere algumas imagens e volte aqui.")
+        return
 
-# =========================
-# CHAMADA OPENROUTER
-# =========================
+    modelos = sorted({l["modelo"] for l in linhas})
+    filtro = st.multiselect("Modelos", modelos, default=modelos)
 
-def gerar_imagem_de_outra_openrouter(
-    imagem_pil: Image.Image,
-    prompt: str,
-    negative_prompt: str,
-    model: str,
-    size: str = "1024x1024",
-    quality: str = "auto",
-    preservar_fundo: bool = True,
-):
-    if not OPENROUTER_API_KEY:
-        raise RuntimeError("OPENROUTER_API_KEY não encontrado em st.secrets.")
+    st.dataframe(
+        [l for l in linhas if l["modelo"] in filtro],
+        use_container_width=True,
+        hide_index=True,
+    )
 
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": APP_REFERER,
-        "X-Title": APP_TITLE,
-    }
+    metricas.descarregar()
+    st.caption(f"Amostras brutas (JSONL): `{metricas.arquivo_jsonl}`")
 
-    imagem_data_url = pil_to_data_url(imagem_pil, format_="PNG")
-    prompt_final = montar_prompt_final(prompt, negative_prompt, preservar_fundo)
-
-    payload = {
-        "model": model,
-        "modalities": ["image"],
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt_final
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": imagem_data_url
-                        }
-                    }
-                ]
-            }
-        ],
-        "image_config": {
-            "size": size,
-            "quality": quality
-        }
-    }
+    texto_prometheus = metricas.exportar_prometheus()
+    st.caption(f"Exportação Prometheus gravada em `{metricas.arquivo_prometheus}`")
 
-    resp = requests.post(
-        OPENROUTER_URL,
-        headers=headers,
-        json=payload,
-        timeout=300,
+    st.download_button(
+        "⬇️ Baixar métricas (Prometheus)",
+        data=texto_prometheus,
+        file_name="metricas.prom",
+        mime="text/plain",
     )
 
-    if resp.status_code == 404:
-        st.error(
-            "Erro 404: o modelo existe, mas não aceitou a modalidade solicitada. "
-            "Para modelos de imagem pura, este script usa modalities=['image']."
-        )
-        st.code(resp.text)
-        raise RuntimeError(f"Modalidade incompatível no OpenRouter: {model}")
 
-    if resp.status_code != 200:
-        st.error(f"Erro da API OpenRouter — status {resp.status_code}")
-        st.code(resp.text)
-        raise RuntimeError(f"Falha OpenRouter: {resp.status_code}")
+pagina = st.sidebar.radio("Página", ["Gerador", "Métricas de latência"])
 
-    data = resp.json()
-    imagens = extract_images_from_openrouter(data)
+if pagina == "Métricas de latência":
+    pagina_metricas()
+    st.stop()
 
-    return imagens, data
+# =========================
+# PROVEDOR
+# =========================
 
+provedor = st.selectbox(
+    "Provedor",
+    ["OpenRouter", "Hugging Face", PROVEDOR_LOCAL],
+    index=0,
+    help=f"{PROVEDOR_LOCAL} gera uma aproximação de comic na hora, sem rede e sem chave de API.",
+)
 
 # =========================
-# CHAMADA HUGGING FACE — INFERENCECLIENT
+# UI — IMAGEM
 # =========================
 
-def gerar_imagem_huggingface_img2img(
-    imagem_pil: Image.Image,
-    prompt: str,
-    negative_prompt: str,
-    model_id: str,
-    provider: str = "replicate",
-    strength: float = 0.55,
-    guidance_scale: float = 7.5,
-    preservar_fundo: bool = True,
-):
-    """
-    Chama Hugging Face Inference Providers via huggingface_hub.InferenceClient.
-    Tenta input posicional e depois image=...
-    """
-    if not HF_TOKEN:
-        raise RuntimeError("HF_TOKEN ou HUGGINGFACE_API_KEY não encontrado em st.secrets.")
+st.subheader("Enviar imagem de referência")
 
-    prompt_final = montar_prompt_final(
-        prompt=prompt,
-        negative_prompt=negative_prompt,
-        preservar_fundo=preservar_fundo,
+modo_lote = st.toggle(
+    "Modo lote (várias imagens)",
+    value=False,
+    help="Processa várias imagens em paralelo, respeitando o limite de chamadas de cada provedor."
+)
+
+modo_animacao = st.toggle(
+    "Modo animação (GIF, APNG, WebP animado ou vídeo)",
+    value=False,
+    disabled=modo_lote,
+    help=(
+        "Transforma os frames de um clipe curto. Frames quase iguais a um já transformado "
+        "são reaproveitados, e a animação é remontada com o tempo original."
     )
+) and not modo_lote
 
-    buffer = io.BytesIO()
-    imagem_pil.save(buffer, format="PNG")
-    input_image = buffer.getvalue()
+imagens_lote = []
+animacao = None
 
-    client = InferenceClient(
-        provider=provider,
-        api_key=HF_TOKEN,
+if modo_lote:
+    arquivos = st.file_uploader(
+        "Escolha as imagens",
+        type=["png", "jpg", "jpeg", "webp"],
+        accept_multiple_files=True,
     )
 
-    erros = []
+    for arquivo in arquivos or []:
+        imagens_lote.append((arquivo.name, carregar_upload(arquivo)))
 
-    # Tentativa 1 — igual aos exemplos oficiais
-    try:
-        image = client.image_to_image(
-            input_image,
-            prompt=prompt_final,
-            model=model_id,
-        )
+    if imagens_lote:
+        st.caption(f"{len(imagens_lote)} imagem(ns) no lote.")
 
-        if isinstance(image, Image.Image):
-            return [image.convert("RGB")], {
-                "provider": "huggingface",
-                "hf_provider": provider,
-                "model": model_id,
-                "method": "positional_input_image",
-                "strength": strength,
-                "guidance_scale": guidance_scale,
-            }
-
-        erros.append(f"Tentativa posicional retornou tipo inesperado: {type(image)}")
-
-    except Exception as e:
-        erros.append(f"Tentativa posicional falhou: {repr(e)}")
-
-    # Tentativa 2 — keyword image=...
-    try:
-        image = client.image_to_image(
-            image=input_image,
-            prompt=prompt_final,
-            model=model_id,
-        )
+    imagem_original = None
 
-        if isinstance(image, Image.Image):
-            return [image.convert("RGB")], {
-                "provider": "huggingface",
-                "hf_provider": provider,
-                "model": model_id,
-                "method": "keyword_image",
-                "strength": strength,
-                "guidance_scale": guidance_scale,
-            }
+elif modo_animacao:
+    arquivo = st.file_uploader(
+        "Escolha a animação",
+        type=["gif", "png", "webp"] + [ext.lstrip(".") for ext in EXTENSOES_VIDEO],
+    )
 
-        erros.append(f"Tentativa image= retornou tipo inesperado: {type(image)}")
+    if arquivo:
+        dados_animacao = arquivo.getvalue()
+        formato = formato_animacao(dados_animacao, arquivo.name)
 
-    except Exception as e:
-        erros.append(f"Tentativa image= falhou: {repr(e)}")
+        if formato is None:
+            st.warning("O arquivo não é animado. Desligue o modo animação para enviar imagens estáticas.")
+        else:
+            animacao = (arquivo.name, dados_animacao)
 
-    raise RuntimeError(
-        "Falha ao chamar Hugging Face InferenceClient.\n\n"
-        f"Provider: {provider}\n"
-        f"Modelo: {model_id}\n\n"
-        "Erros:\n- " + "\n- ".join(erros)
-    )
+            if formato == "VIDEO":
+                st.video(dados_animacao)
+            else:
+                st.image(dados_animacao, caption="Animação original", use_column_width=True)
 
+    imagem_original = None
 
-# =========================
-# UI — IMAGEM
-# =========================
+else:
+    arquivo = st.file_uploader(
+        "Escolha uma imagem",
+        type=["png", "jpg", "jpeg", "webp"]
+    )
 
-st.subheader("Enviar imagem de referência")
+    if arquivo:
+        imagem_original = carregar_upload(arquivo)
+        col_original, col_previa = st.columns(2)
 
-arquivo = st.file_uploader(
-    "Escolha uma imagem",
-    type=["png", "jpg", "jpeg", "webp"]
-)
+        with col_original:
+            exibir_com_zoom(
+                miniatura_upload(imagem_original, arquivo.file_id, EXIBICAO_LARGURA // 2),
+                arquivo.getvalue(),
+                chave=f"upload_{arquivo.file_id}",
+                legenda="Imagem original",
+            )
 
-if arquivo:
-    imagem_original = Image.open(arquivo).convert("RGB")
-    st.image(
-        imagem_original,
-        caption="Imagem original",
-        use_column_width=True
-    )
-else:
-    imagem_original = None
+        with col_previa:
+            st.image(
+                previa_comic_local(imagem_original, arquivo.file_id, EXIBICAO_LARGURA // 2),
+                caption=f"Prévia instantânea ({PROVEDOR_LOCAL})",
+                use_column_width=True
+            )
+    else:
+        imagem_original = None
 
 # =========================
 # UI — CONFIGURAÇÃO
@@ -474,13 +430,15 @@ else:
 st.subheader("Configuração")
 
 if provedor == "OpenRouter":
+    modelos_openrouter = modelos_openrouter_disponiveis()
+
     modelo = st.selectbox(
         "Modelo OpenRouter",
-        MODELOS_OPENROUTER_IMAGEM,
-        index=MODELOS_OPENROUTER_IMAGEM.index(MODELO_OPENROUTER_INICIAL),
+        modelos_openrouter,
+        index=modelos_openrouter.index(MODELO_OPENROUTER_INICIAL) if MODELO_OPENROUTER_INICIAL in modelos_openrouter else 0,
         help=(
-            "Modelos chamados pelo OpenRouter. "
-            "Para image-to-image, use modelos que aceitam imagem de referência e saída de imagem."
+            "Modelos chamados pelo OpenRouter. Quando o catálogo do OpenRouter está disponível, "
+            "só aparecem os que aceitam imagem de referência e geram imagem."
         )
     )
 
@@ -490,8 +448,28 @@ if provedor == "OpenRouter":
         placeholder="ex: x-ai/grok-imagine-image-quality"
     )
 
+    usar_stream = st.checkbox(
+        "Streaming da resposta",
+        value=False,
+        help=(
+            "Recebe a resposta do OpenRouter em partes (SSE), decodificando as imagens "
+            "conforme chegam e mostrando o progresso. Usa menos memória por requisição."
+        )
+    )
+
     hf_provider = None
 
+elif provedor == PROVEDOR_LOCAL:
+    modelo = MODELO_LOCAL
+    modelo_manual = ""
+    usar_stream = False
+    hf_provider = None
+
+    st.caption(
+        "O motor local aplica traço de nanquim, cores chapadas, cel shading e retícula halftone "
+        "conforme o prompt positivo. Não usa modelo remoto."
+    )
+
 else:
     modelo = st.selectbox(
         "Modelo Hugging Face",
@@ -506,28 +484,34 @@ else:
         placeholder="ex: black-forest-labs/FLUX.2-klein-9B"
     )
 
-    modelo_final_preview = modelo_manual.strip() if modelo_manual.strip() else modelo
-    provider_recomendado = sugerir_provider_hf(modelo_final_preview)
+    usar_stream = False
 
     hf_provider = st.selectbox(
         "Provider Hugging Face",
-        HF_PROVIDERS,
-        index=HF_PROVIDERS.index(provider_recomendado)
-        if provider_recomendado in HF_PROVIDERS
-        else HF_PROVIDERS.index(HF_PROVIDER_INICIAL),
-        help="Provider usado pelo InferenceClient da Hugging Face."
+        [HF_PROVIDER_AUTOMATICO] + HF_PROVIDERS,
+        index=0,
+        help=(
+            "Provider usado pelo InferenceClient da Hugging Face. No modo automático, "
+            "o roteador escolhe o mais rápido entre os saudáveis, pela latência e taxa de erro recentes."
+        )
     )
 
 modelo_final = modelo_manual.strip() if modelo_manual.strip() else modelo
 
+# Recusa aqui modelos que o catálogo diz não fazerem image-to-image, antes de qualquer upload
+problema_modelo = obter_catalogo_openrouter().verificar(modelo_final) if provedor == "OpenRouter" else None
+
+if problema_modelo:
+    st.error(problema_modelo)
+
 st.caption(f"Provedor selecionado: `{provedor}`")
 st.caption(f"Modelo selecionado: `{modelo_final}`")
 
 if provedor == "Hugging Face":
-    provider_recomendado = sugerir_provider_hf(modelo_final)
+    ordem_roteador = obter_roteador_providers_hf().ordenar(modelo_final, HF_PROVIDERS)
 
     st.caption(f"HF provider selecionado: `{hf_provider}`")
-    st.caption(f"HF provider recomendado para este modelo: `{provider_recomendado}`")
+    st.caption(f"Ordem atual do roteador para este modelo: `{' > '.join(ordem_roteador)}`")
 
     if modelo_final == "Qwen/Qwen-Image-Edit-2511":
         st.warning(
@@ -543,13 +527,6 @@ if provedor == "Hugging Face":
             "é o provider/roteamento, não o app. Use prompt simples, como: transform into anime."
         )
 
-    if hf_provider != provider_recomendado:
-        st.warning(
-            f"O provider selecionado foi `{hf_provider}`, mas para `{modelo_final}` "
-            f"o recomendado é `{provider_recomendado}`. "
-            f"Na geração, o app usará `{provider_recomendado}` automaticamente."
-        )
-
 # =========================
 # UI — PROMPTS
 # =========================
@@ -644,88 +621,743 @@ else:
     strength = None
     guidance_scale = None
 
+# =========================
+# UI — ALTA RESOLUÇÃO (TILES)
+# =========================
+
+usar_tiles = st.toggle(
+    "Processar em blocos (alta resolução)",
+    value=False,
+    help=(
+        "Divide a imagem em blocos sobrepostos, transforma todos em paralelo e costura o resultado "
+        "na resolução original. Indicado para fotos grandes e páginas para impressão."
+    )
+)
+
+if usar_tiles:
+    col_t1, col_t2 = st.columns(2)
+
+    with col_t1:
+        lado_tile = st.select_slider(
+            "Lado do bloco (px)",
+            options=[512, 768, 1024, 1536],
+            value=comic_core.TILES_LADO,
+        )
+
+    with col_t2:
+        sobreposicao_tile = st.slider(
+            "Sobreposição (px)",
+            min_value=32,
+            max_value=lado_tile // 2 - 1,
+            value=min(comic_core.TILES_SOBREPOSICAO, lado_tile // 2 - 1),
+            step=16,
+            help="Faixa compartilhada entre blocos vizinhos, usada para misturar as emendas."
+        )
+
+    if imagem_original is not None:
+        total_tiles = len(dividir_em_tiles(*imagem_original.size, lado_tile, sobreposicao_tile))
+        st.caption(f"{imagem_original.width}x{imagem_original.height} → {total_tiles} bloco(s) por imagem.")
+
+    st.caption("O hedge não é usado no modo em blocos.")
+
+# =========================
+# UI — IMAGENS PARECIDAS
+# =========================
+
+reaproveitar_similares = st.checkbox(
+    "Reaproveitar resultado de imagens parecidas",
+    value=False,
+    help=(
+        "Antes de chamar o provedor, procura uma imagem já transformada nesta sessão quase igual "
+        "a esta (recortada, recomprimida, sem EXIF...) com o mesmo modelo, prompt e parâmetros. "
+        "O resultado devolvido é o da outra imagem."
+    )
+)
+
+if reaproveitar_similares:
+    distancia_similar = st.slider(
+        "Distância máxima do hash perceptual",
+        min_value=0,
+        max_value=16,
+        value=comic_core.SIMILARES_DISTANCIA_PADRAO,
+        help="Bits diferentes (de 64) aceitos. 0 só reaproveita imagens visualmente idênticas."
+    )
+else:
+    distancia_similar = None
+
+# =========================
+# UI — ANIMAÇÃO
+# =========================
+
+if modo_animacao:
+    distancia_frames = st.slider(
+        "Tolerância para reaproveitar frames",
+        min_value=0,
+        max_value=16,
+        value=comic_core.ANIMACAO_DISTANCIA_MAX,
+        help=(
+            "Distância máxima (bits diferentes no hash perceptual de 64 bits) para um frame "
+            "reaproveitar um quadro já transformado. 0 transforma todos os frames diferentes."
+        )
+    )
+else:
+    distancia_frames = None
+
+# =========================
+# UI — HEDGE
+# =========================
+
+usar_hedge = st.checkbox(
+    "Hedge: tentar outro provedor/modelo se demorar",
+    value=False,
+    help=(
+        "Se a chamada principal não responder no tempo definido, a mesma imagem é enviada "
+        "a uma alternativa (outro provider HF para o mesmo modelo, ou outro modelo OpenRouter). "
+        "A primeira imagem válida vence. Vale para imagem única e para a fila de jobs."
+    )
+)
+
+if usar_hedge:
+    col_h1, col_h2 = st.columns(2)
+
+    with col_h1:
+        hedge_atraso = st.number_input(
+            "Esperar antes do hedge (s)",
+            min_value=1.0,
+            max_value=300.0,
+            value=comic_core.HEDGE_ATRASO_PADRAO,
+            step=5.0,
+        )
+
+    with col_h2:
+        hedge_max_extras = st.number_input(
+            "Máximo de chamadas extras",
+            min_value=1,
+            max_value=max(1, comic_core.HEDGE_MAX_EXTRAS),
+            value=1,
+            step=1,
+            help="Limita o custo: cada chamada extra pode ser cobrada pelo provedor."
+        )
+else:
+    hedge_atraso = 0.0
+    hedge_max_extras = 0
+
+# =========================
+# UI — COMPARAÇÃO DE MODELOS
+# =========================
+
+modo_comparacao = st.toggle(
+    "Comparar modelos",
+    value=False,
+    disabled=modo_lote or modo_animacao,
+    help=(
+        "Envia a mesma imagem a vários modelos (e variantes de prompt) ao mesmo tempo e monta "
+        "uma grade conforme cada resultado chega, com a latência e o tamanho dos dados de cada um."
+    )
+) and not (modo_lote or modo_animacao)
+
+if modo_comparacao:
+    col_m1, col_m2 = st.columns(2)
+
+    with col_m1:
+        modelos_comparacao_disponiveis = modelos_openrouter_disponiveis()
+        modelos_comparacao_openrouter = st.multiselect(
+            "Modelos OpenRouter",
+            modelos_comparacao_disponiveis,
+            default=[modelo_final] if modelo_final in modelos_comparacao_disponiveis else [],
+        )
+
+    with col_m2:
+        modelos_comparacao_hf = st.multiselect(
+            "Modelos Hugging Face",
+            MODELOS_HF_IMAGEM,
+            default=[modelo_final] if modelo_final in MODELOS_HF_IMAGEM else [],
+            help="Cada modelo vai para o provider escolhido pelo roteador, ou para o provider fixado acima.",
+        )
+
+    comparar_local = st.checkbox(f"Incluir {PROVEDOR_LOCAL}", value=provedor == PROVEDOR_LOCAL)
+
+    variantes_texto = st.text_area(
+        "Variantes de prompt (opcional)",
+        value="",
+        placeholder="ex: heavy halftone dots, 1960s print\nmanga screentone, black and white",
+        help=(
+            "Uma por linha. Cada variante é acrescentada ao prompt positivo e vira uma linha da grade; "
+            "a primeira linha usa o prompt sem variante."
+        )
+    )
+
+    st.caption("Na comparação, tiles e hedge não são usados; a grade roda nesta página.")
+else:
+    modelos_comparacao_openrouter = []
+    modelos_comparacao_hf = []
+    comparar_local = False
+    variantes_texto = ""
+
 st.divider()
 
 with st.expander("Ver prompt final"):
     st.code(montar_prompt_final(prompt_positivo, prompt_negativo, preservar_fundo))
 
+with st.expander("Cache de resultados"):
+    st.json(obter_cache_resultados().estatisticas())
+    st.caption("Índice de imagens parecidas:")
+    st.json(obter_indice_similares().estatisticas())
+    st.caption("Gerações em andamento (pedidos idênticos esperam a mesma chamada):")
+    st.json(obter_geracoes_em_andamento().estatisticas())
+
+    if st.button("Limpar cache"):
+        obter_cache_resultados().limpar()
+        st.success("Cache limpo.")
+
+with st.expander("Conexões HTTP"):
+    st.caption(
+        f"Timeouts: conexão {comic_core.HTTP_TIMEOUT_CONEXAO:.0f}s, leitura {comic_core.HTTP_TIMEOUT_LEITURA:.0f}s."
+    )
+    st.json(estatisticas_sessao_http(obter_sessao_openrouter()))
+    st.caption("Clientes Hugging Face reaproveitados:")
+    st.json(obter_registro_clientes_hf().estatisticas())
+
+with st.expander("Catálogo de modelos OpenRouter"):
+    st.caption(
+        "Buscado uma vez e guardado em disco por "
+        f"{comic_core.CATALOGO_OPENROUTER_TTL / 3600:.0f} h; usado para recusar modelos incompatíveis antes do upload."
+    )
+    st.json(obter_catalogo_openrouter().estatisticas())
+
+with st.expander("Limite de taxa por provedor"):
+    st.caption(
+        "Chamadas por minuto por provedor e chave de API, somando todas as sessões; o limite "
+        "prévio só vale com LIMITES_TAXA_POR_MINUTO configurado. "
+        "Respostas 429 bloqueiam a chave pelo tempo pedido e a chamada é repetida "
+        f"(até {comic_core.TAXA_MAX_TENTATIVAS} tentativas)."
+    )
+    estatisticas_taxa = obter_limitador_taxa().estatisticas()
+
+    if estatisticas_taxa:
+        st.json(estatisticas_taxa)
+    else:
+        st.info("Nenhuma chamada feita ainda.")
+
+with st.expander("Fila de jobs (todas as sessões)"):
+    st.json(obter_fila_jobs().estatisticas())
+
+with st.expander("Roteamento de providers Hugging Face"):
+    st.caption(
+        "Latência e taxa de erro (médias móveis) por modelo/provider, somando todas as sessões. "
+        f"O circuito abre após {comic_core.ROTEADOR_FALHAS_PARA_ABRIR} falhas seguidas."
+    )
+    linhas_roteador = obter_roteador_providers_hf().estatisticas()
+
+    if linhas_roteador:
+        st.dataframe(linhas_roteador, use_container_width=True, hide_index=True)
+    else:
+        st.info("Nenhuma chamada Hugging Face medida ainda.")
+
+with st.expander("Métodos de chamada Hugging Face"):
+    st.caption("Forma de chamada que funcionou e falhas recentes por modelo/provider.")
+    st.json(obter_memoria_metodos_hf().estatisticas())
+
 # =========================
 # BOTÃO
 # =========================
 
-if st.button("🚀 Transformar em comic book"):
-    if imagem_original is None:
-        st.error("Envie uma imagem primeiro.")
-        st.stop()
+sessao_id = st.session_state.setdefault("sessao_id", uuid.uuid4().hex)
 
-    if not prompt_positivo.strip():
-        st.error("Digite um prompt positivo.")
-        st.stop()
+em_segundo_plano = st.toggle(
+    "Executar em segundo plano",
+    value=True,
+    help=(
+        "Envia a transformação para a fila de jobs e libera a página na hora. "
+        "O andamento aparece abaixo e os jobs podem ser cancelados."
+    )
+)
 
-    if provedor == "OpenRouter" and not OPENROUTER_API_KEY:
-        st.error("OPENROUTER_API_KEY não configurada nos secrets.")
-        st.stop()
+gerar_agora = st.button("🚀 Transformar em comic book")
+
+if gerar_agora:
+    erro_validacao = None
+
+    if modo_lote and not imagens_lote:
+        erro_validacao = "Envie ao menos uma imagem para o lote."
+    elif modo_animacao and animacao is None:
+        erro_validacao = "Envie uma animação primeiro."
+    elif not modo_lote and not modo_animacao and imagem_original is None:
+        erro_validacao = "Envie uma imagem primeiro."
+    elif not prompt_positivo.strip():
+        erro_validacao = "Digite um prompt positivo."
+    elif modo_comparacao and not (modelos_comparacao_openrouter or modelos_comparacao_hf or comparar_local):
+        erro_validacao = "Escolha ao menos um modelo para comparar."
+    elif modo_comparacao and modelos_comparacao_openrouter and not comic_core.OPENROUTER_API_KEY:
+        erro_validacao = "OPENROUTER_API_KEY não configurada nos secrets."
+    elif modo_comparacao and modelos_comparacao_hf and not comic_core.HF_TOKEN:
+        erro_validacao = "HF_TOKEN ou HUGGINGFACE_API_KEY não configurado nos secrets."
+    elif not modo_comparacao and provedor == "OpenRouter" and not comic_core.OPENROUTER_API_KEY:
+        erro_validacao = "OPENROUTER_API_KEY não configurada nos secrets."
+    elif not modo_comparacao and problema_modelo:
+        erro_validacao = problema_modelo
+    elif not modo_comparacao and provedor == "Hugging Face" and not comic_core.HF_TOKEN:
+        erro_validacao = "HF_TOKEN ou HUGGINGFACE_API_KEY não configurado nos secrets."
+
+    if erro_validacao:
+        st.error(erro_validacao)
+        gerar_agora = False
+
+if gerar_agora:
+    if provedor == "OpenRouter":
+        funcao_geradora = gerar_imagem_de_outra_openrouter
+        parametros_geracao = {
+            "model": modelo_final,
+            "size": tamanho,
+            "quality": qualidade,
+            "stream": usar_stream,
+        }
+        provider_usado = None
 
-    if provedor == "Hugging Face" and not HF_TOKEN:
-        st.error("HF_TOKEN ou HUGGINGFACE_API_KEY não configurado nos secrets.")
-        st.stop()
+    elif provedor == PROVEDOR_LOCAL:
+        funcao_geradora = gerar_imagem_local_comic
+        parametros_geracao = {}
+        provider_usado = None
 
-    try:
-        st.info(f"Enviando imagem para {provedor}...")
-        st.info(f"Modelo usado: {modelo_final}")
+    else:
+        funcao_geradora = gerar_imagem_huggingface_img2img
+        provider_usado = (
+            obter_roteador_providers_hf().escolher(modelo_final, HF_PROVIDERS)
+            if hf_provider == HF_PROVIDER_AUTOMATICO
+            else hf_provider
+        )
+        parametros_geracao = {
+            "model_id": modelo_final,
+            "provider": provider_usado,
+            "strength": strength,
+            "guidance_scale": guidance_scale,
+        }
 
-        if provedor == "OpenRouter":
-            imagens, bruto = gerar_imagem_de_outra_openrouter(
-                imagem_pil=imagem_original,
+    alternativas_hedge = (
+        montar_alternativas_hedge(provedor, parametros_geracao, int(hedge_max_extras))
+        if usar_hedge and not usar_tiles and not modo_animacao
+        else []
+    )
+
+    chave_limite = chave_limite_provedor(provedor, provider_usado)
+    parametros_geracao["distancia_similar"] = distancia_similar
+    parametros_geracao["escopo_similar"] = sessao_id
+
+    if usar_tiles:
+        # Os blocos ocupam as vagas do provedor; a imagem inteira usa uma vaga à parte.
+        # O tamanho de saída de cada bloco é escolhido por gerar_em_tiles.
+        parametros_geracao.pop("size", None)
+        parametros_geracao = {
+            "funcao_tile": funcao_geradora,
+            "chave_limite_tile": chave_limite,
+            "lado_tile": lado_tile,
+            "sobreposicao_tile": sobreposicao_tile,
+            **parametros_geracao,
+        }
+        funcao_geradora = gerar_em_tiles
+        chave_limite = "tiles"
+
+    if modo_animacao:
+        # A fila de jobs recebe imagens; animações são processadas aqui, com progresso
+        nome_animacao, dados_animacao = animacao
+        st.info(f"Transformando os frames de `{nome_animacao}` em {provedor} ({modelo_final})...")
+        progresso_quadros = st.progress(0.0, text="Decodificando frames...")
+
+        def mostrar_progresso_quadros(concluidos: int, total: int):
+            progresso_quadros.progress(concluidos / total, text=f"{concluidos}/{total} quadros-chave")
+
+        try:
+            imagens, bruto = gerar_animacao(
+                dados_animacao,
+                nome_animacao,
+                funcao_geradora,
+                chave_limite,
+                distancia_max=distancia_frames,
+                ao_quadro_concluido=mostrar_progresso_quadros,
                 prompt=prompt_positivo,
                 negative_prompt=prompt_negativo,
-                model=modelo_final,
-                size=tamanho,
-                quality=qualidade,
                 preservar_fundo=preservar_fundo,
+                **parametros_geracao,
             )
 
-        else:
-            provider_usado = sugerir_provider_hf(modelo_final)
+            resumo = bruto["animacao"]
+            st.success(
+                f"Animação transformada: {resumo['frames']} frames, {resumo['quadros_chave']} enviados ao provedor, "
+                f"{resumo['frames_reaproveitados']} reaproveitados. ✅"
+            )
 
-            st.info(f"HF provider usado: {provider_usado}")
+            if resumo["truncado"]:
+                st.warning(f"A animação passou de {comic_core.ANIMACAO_MAX_FRAMES} frames; o restante foi cortado.")
+
+            if resumo["reuso_forcado"]:
+                st.warning(
+                    f"Limite de {comic_core.ANIMACAO_MAX_QUADROS_CHAVE} quadros-chave atingido: "
+                    f"{resumo['reuso_forcado']} frame(s) diferentes reaproveitaram o quadro mais próximo."
+                )
+
+            guardar_resultado_sessao(
+                titulo=f"{nome_animacao} — {modelo_final}",
+                nome_base=f"{Path(nome_animacao).stem}_comic",
+                imagens=imagens,
+                bruto=bruto,
+                cache_hit=resumo["cache_hits"] == resumo["quadros_chave"],
+            )
 
-            imagens, bruto = gerar_imagem_huggingface_img2img(
+        except Exception as e:
+            st.error(f"Falha ao transformar a animação: {e}")
+
+    elif modo_comparacao:
+        parametros_hf = {
+            "strength": strength if strength is not None else 0.55,
+            "guidance_scale": guidance_scale if guidance_scale is not None else 7.5,
+        }
+        if provedor == "Hugging Face" and hf_provider != HF_PROVIDER_AUTOMATICO:
+            parametros_hf["provider"] = hf_provider
+
+        candidatos = montar_candidatos_comparacao(
+            modelos_comparacao_openrouter,
+            modelos_comparacao_hf,
+            parametros_openrouter={
+                "size": tamanho,
+                "quality": qualidade,
+                "distancia_similar": distancia_similar,
+                "escopo_similar": sessao_id,
+            },
+            parametros_hf={**parametros_hf, "distancia_similar": distancia_similar, "escopo_similar": sessao_id},
+            incluir_local=comparar_local,
+        )
+        variantes = [("Prompt base", prompt_positivo)] + [
+            (linha.strip(), f"{prompt_positivo.strip()}\n\n{linha.strip()}")
+            for linha in variantes_texto.splitlines()
+            if linha.strip()
+        ]
+        total_celulas = len(candidatos) * len(variantes)
+
+        st.info(
+            f"Comparando {len(candidatos)} modelo(s) x {len(variantes)} prompt(s): "
+            f"{total_celulas} chamada(s) em paralelo, respeitando o limite de cada provedor."
+        )
+        progresso = st.progress(0.0)
+
+        # Um espaço por célula, preenchido quando ela termina
+        grade = []
+
+        for nome_variante, _ in variantes:
+            if len(variantes) > 1:
+                st.markdown(f"**{nome_variante}**")
+
+            espacos = []
+
+            for coluna, (_, _, parametros) in zip(st.columns(len(candidatos)), candidatos):
+                with coluna:
+                    st.caption(f"`{descrever_candidato(parametros)}`")
+                    espaco = st.empty()
+                    espaco.caption("⏳ aguardando...")
+                    espacos.append(espaco)
+
+            grade.append(espacos)
+
+        resumo_comparacao = []
+
+        for concluidas, celula in enumerate(
+            comparar_modelos(
+                candidatos,
+                variantes,
                 imagem_pil=imagem_original,
-                prompt=prompt_positivo,
                 negative_prompt=prompt_negativo,
-                model_id=modelo_final,
-                provider=provider_usado,
-                strength=strength,
-                guidance_scale=guidance_scale,
                 preservar_fundo=preservar_fundo,
+            ),
+            start=1,
+        ):
+            progresso.progress(concluidas / total_celulas, text=f"{concluidas}/{total_celulas} concluídas")
+            resumo_comparacao.append(resumo_celula_comparacao(celula))
+            linha = resumo_comparacao[-1]
+
+            with grade[celula["linha"]][celula["coluna"]].container():
+                if celula["erro"] is not None:
+                    st.error(f"Falha: {linha['erro']}")
+                    continue
+
+                if not celula["imagens"]:
+                    st.warning("O modelo respondeu sem imagem.")
+                    continue
+
+                st.image(celula["imagens"][0].miniatura(EXIBICAO_LARGURA // 2), use_column_width=True)
+                st.caption(
+                    ("⚡ cache" if celula["cache_hit"] else f"⏱️ {linha['segundos']}s")
+                    + (f" · ↑ {linha['kb_enviados']} KB" if linha["kb_enviados"] is not None else "")
+                    + f" · ↓ {linha['kb_recebidos']} KB"
+                )
+
+            guardar_resultado_sessao(
+                titulo=f"Comparação — {celula['candidato']} — {celula['variante']}",
+                nome_base="comic_book_comparacao",
+                imagens=celula["imagens"],
+                bruto=celula["bruto"],
+                cache_hit=celula["cache_hit"],
             )
 
-        if not imagens:
-            st.warning(
-                "O modelo respondeu, mas nenhuma imagem foi encontrada na resposta. "
-                "Veja a resposta bruta abaixo para identificar o formato retornado pelo provedor."
+        # Em ordem de chegada, que já é a ordem de latência
+        st.dataframe(
+            resumo_comparacao,
+            use_container_width=True,
+            hide_index=True,
+        )
+
+    elif em_segundo_plano:
+        fila = obter_fila_jobs()
+
+        if modo_lote:
+            entradas_jobs = [
+                (f"{nome} — {modelo_final}", f"{Path(nome).stem}_comic", imagem_pil)
+                for nome, imagem_pil in imagens_lote
+            ]
+        else:
+            entradas_jobs = [(f"Resultado — {modelo_final}", "comic_book_result", imagem_original)]
+
+        for titulo, nome_base, imagem_pil in entradas_jobs:
+            fila.submeter(
+                sessao_id,
+                titulo,
+                nome_base,
+                chave_limite,
+                funcao_geradora,
+                imagem_pil=imagem_pil,
+                alternativas=alternativas_hedge,
+                hedge_atraso=hedge_atraso,
+                prompt=prompt_positivo,
+                negative_prompt=prompt_negativo,
+                preservar_fundo=preservar_fundo,
+                **parametros_geracao,
             )
 
-            with st.expander("Ver resposta bruta da API"):
-                st.json(bruto)
+        st.success(f"{len(entradas_jobs)} job(s) enviado(s) para a fila.")
 
-            st.stop()
+    elif modo_lote:
+        limite = obter_limitador_concorrencia().limites.get(chave_limite, LIMITE_CONCORRENCIA_PADRAO)
 
-        st.success("Imagem transformada com sucesso! ✅")
+        st.info(
+            f"Processando {len(imagens_lote)} imagem(ns) em {provedor} "
+            f"(até {limite} chamadas simultâneas para `{chave_limite}`)..."
+        )
+        st.info(f"Modelo usado: {modelo_final}")
 
-        for idx, img in enumerate(imagens, start=1):
-            st.markdown(f"### Resultado {idx}")
-            st.image(img, use_column_width=True)
+        progresso = st.progress(0.0)
+        concluidas = 0
+        falhas = 0
 
-            download_button_from_pil(
-                img,
-                f"comic_book_result_{idx}.png",
-                f"⬇️ Baixar resultado {idx}"
-            )
+        # Resultados aparecem aqui conforme terminam; ao final ficam na lista da sessão
+        painel_lote = st.empty()
+
+        with painel_lote.container():
+            for nome, imagens, bruto, cache_hit, erro in processar_lote(
+                imagens_lote,
+                chave_limite,
+                funcao_geradora,
+                prompt=prompt_positivo,
+                negative_prompt=prompt_negativo,
+                preservar_fundo=preservar_fundo,
+                **parametros_geracao,
+            ):
+                concluidas += 1
+                progresso.progress(
+                    concluidas / len(imagens_lote),
+                    text=f"{concluidas}/{len(imagens_lote)} concluídas",
+                )
+
+                if erro is not None:
+                    falhas += 1
+                    st.error(f"{nome}: falha ao gerar imagem: {erro}")
+                    continue
+
+                if not imagens:
+                    falhas += 1
+                    st.warning(f"{nome}: o modelo respondeu, mas nenhuma imagem foi encontrada na resposta.")
+                    continue
+
+                st.markdown(f"**{nome}** ✅")
+                st.image([img.miniatura(320) for img in imagens], width=160)
+
+                guardar_resultado_sessao(
+                    titulo=f"{nome} — {modelo_final}",
+                    nome_base=f"{Path(nome).stem}_comic",
+                    imagens=imagens,
+                    bruto=bruto,
+                    cache_hit=cache_hit,
+                )
+
+        if falhas:
+            st.warning(f"Lote concluído com {falhas} falha(s) de {len(imagens_lote)}.")
+        else:
+            painel_lote.empty()
+            st.success("Lote concluído com sucesso! ✅")
+
+    else:
+        try:
+            st.info(f"Enviando imagem para {provedor}...")
+            st.info(f"Modelo usado: {modelo_final}")
+
+            if provider_usado:
+                st.info(f"HF provider usado: {provider_usado}")
+
+            if usar_tiles:
+                progresso_tiles = st.progress(0.0)
+
+                def mostrar_progresso_tiles(concluidos: int, total: int):
+                    progresso_tiles.progress(concluidos / total, text=f"{concluidos}/{total} blocos")
+
+                parametros_geracao["ao_tile_concluido"] = mostrar_progresso_tiles
+
+            if usar_stream and not usar_tiles:
+                status_stream = st.empty()
+                inicio_stream = time.time()
+
+                def mostrar_progresso_stream(status: str, bytes_recebidos: int, imagens_recebidas: int):
+                    status_stream.caption(
+                        f"Stream {status}: {bytes_recebidos / 1e6:.2f} MB recebidos, "
+                        f"{imagens_recebidas} imagem(ns) decodificada(s), "
+                        f"{time.time() - inicio_stream:.1f}s"
+                    )
+
+                parametros_geracao["ao_progresso"] = mostrar_progresso_stream
+
+            if alternativas_hedge:
+                status_hedge = st.empty()
+
+                imagens, bruto, cache_hit = gerar_com_hedge(
+                    [(chave_limite, funcao_geradora, parametros_geracao)]
+                    + alternativas_hedge,
+                    imagem_pil=imagem_original,
+                    atraso_segundos=hedge_atraso,
+                    ao_status=status_hedge.caption,
+                    prompt=prompt_positivo,
+                    negative_prompt=prompt_negativo,
+                    preservar_fundo=preservar_fundo,
+                )
+
+                st.info(f"Hedge: venceu `{bruto['hedge']['vencedor']}`.")
+
+            else:
+                imagens, bruto, cache_hit = gerar_com_cache(
+                    funcao_geradora,
+                    imagem_pil=imagem_original,
+                    chave_limite=chave_limite,
+                    prompt=prompt_positivo,
+                    negative_prompt=prompt_negativo,
+                    preservar_fundo=preservar_fundo,
+                    **parametros_geracao,
+                )
+
+            if not imagens:
+                st.warning(
+                    "O modelo respondeu, mas nenhuma imagem foi encontrada na resposta. "
+                    "Veja a resposta bruta abaixo para identificar o formato retornado pelo provedor."
+                )
+
+                with st.expander("Ver resposta bruta da API"):
+                    st.json(bruto)
+
+            else:
+                st.success("Imagem transformada com sucesso! ✅")
+
+                guardar_resultado_sessao(
+                    titulo=f"Resultado — {modelo_final}",
+                    nome_base="comic_book_result",
+                    imagens=imagens,
+                    bruto=bruto,
+                    cache_hit=cache_hit,
+                )
+
+        except Exception as e:
+            st.error(f"Falha ao gerar imagem: {e}")
+
+            if getattr(e, "corpo", None):
+                st.code(e.corpo)
+
+# =========================
+# FILA DE JOBS
+# =========================
+
+ROTULOS_ESTADO_JOB = {
+    "na_fila": "⏳ na fila",
+    "executando": "⚙️ executando",
+    "concluido": "✅ concluído",
+    "falhou": "❌ falhou",
+    "cancelado": "🚫 cancelado",
+}
+
+
+@st.fragment(run_every=JOBS_INTERVALO_ATUALIZACAO)
+def painel_jobs():
+    """
+    Acompanha os jobs desta sessão sem rodar o script inteiro a cada atualização.
+    Jobs concluídos viram resultados da sessão.
+    """
+    fila = obter_fila_jobs()
+    jobs = fila.listar(st.session_state["sessao_id"])
+
+    if not jobs:
+        return
+
+    st.subheader("Fila de jobs")
+    novos_resultados = False
+
+    for job in jobs:
+        if job.estado == "concluido":
+            if job.imagens:
+                guardar_resultado_sessao(
+                    titulo=job.titulo,
+                    nome_base=job.nome_base,
+                    imagens=job.imagens,
+                    bruto=job.bruto,
+                    cache_hit=job.cache_hit,
+                )
+                novos_resultados = True
+            else:
+                st.warning(f"{job.titulo}: o modelo respondeu, mas nenhuma imagem foi encontrada na resposta.")
+
+            fila.remover(job.id)
+            continue
+
+        col_titulo, col_estado, col_acao = st.columns([4, 2, 1])
+
+        col_titulo.markdown(f"**{job.titulo}**")
+        col_estado.caption(f"{ROTULOS_ESTADO_JOB[job.estado]} · {job.tempo_decorrido():.0f}s")
+
+        if job.progresso and job.estado == "executando":
+            col_titulo.caption(job.progresso)
+
+        if job.erro:
+            col_titulo.error(job.erro)
+
+        if job.finalizado:
+            if col_acao.button("Dispensar", key=f"dispensar_{job.id}"):
+                fila.remover(job.id)
+                st.rerun(scope="fragment")
+        else:
+            if col_acao.button("Cancelar", key=f"cancelar_{job.id}"):
+                fila.cancelar(job.id)
+                st.rerun(scope="fragment")
+
+    if novos_resultados:
+        st.rerun()
+
+
+painel_jobs()
+
+# =========================
+# RESULTADOS DA SESSÃO
+# =========================
+
+resultados_sessao = st.session_state.get("resultados", [])
+
+if resultados_sessao:
+    st.divider()
+    st.subheader("Resultados")
 
-        with st.expander("Ver resposta bruta da API"):
-            st.json(bruto)
+    if st.button("Limpar resultados"):
+        st.session_state["resultados"] = []
+        st.rerun()
 
-    except Exception as e:
-        st.error(f"Falha ao gerar imagem: {e}")
+    for resultado in reversed(resultados_sessao):
+        exibir_resultado(resultado)
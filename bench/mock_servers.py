@@ -0,0 +1,291 @@
+"""
+Servidores locais que imitam o endpoint chat/completions do OpenRouter e um
+provider Hugging Face image-to-image, para medir o custo do próprio app sem
+rede e sem chaves de API.
+
+Rodam em um processo separado (iniciar_mocks), para que CPU e memória dos
+mocks não entrem nas medições do benchmark. A configuração e os contadores
+de bytes são acessados por HTTP:
+
+    POST /_config   {"forma": "message_images", "n_imagens": 2, "recusas_429": 3, ...}
+    GET  /_stats    bytes recebidos/enviados e número de requisições
+    POST /_reset    zera os contadores
+
+GET /api/v1/models devolve um catálogo com os modelos de "modelos_imagem"
+(entrada e saída de imagem) e de "modelos_texto" (só texto).
+"""
+
+import io
+import json
+import base64
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image, ImageFilter
+
+# Formatos de resposta tratados por extract_images_from_openrouter (e o SSE)
+FORMAS_RESPOSTA = (
+    "content_image_url",
+    "content_output_image",
+    "content_texto",
+    "message_images",
+    "stream",
+)
+
+MIME_POR_FORMATO = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+_imagens_geradas = {}
+_imagens_lock = threading.Lock()
+
+
+def imagem_realista(largura: int, altura: int, formato: str = "PNG") -> bytes:
+    """
+    Imagem com gradiente e ruído suavizado, que comprime como uma ilustração
+    real (ao contrário de uma cor sólida). Gerada uma vez por tamanho/formato.
+    """
+    chave = (largura, altura, formato)
+
+    with _imagens_lock:
+        if chave not in _imagens_geradas:
+            ruido = Image.effect_noise((largura, altura), 64).filter(ImageFilter.GaussianBlur(1.5))
+            gradiente = Image.linear_gradient("L").resize((largura, altura))
+            img = Image.merge("RGB", (ruido, gradiente, Image.blend(ruido, gradiente, 0.5)))
+
+            buf = io.BytesIO()
+            img.save(buf, format=formato, **({"quality": 90} if formato != "PNG" else {}))
+            _imagens_geradas[chave] = buf.getvalue()
+
+        return _imagens_geradas[chave]
+
+
+def data_url(dados: bytes, formato: str) -> str:
+    return f"data:{MIME_POR_FORMATO[formato]};base64,{base64.b64encode(dados).decode('ascii')}"
+
+
+class EstadoMock:
+    def __init__(self):
+        self.config = {
+            "forma": "message_images",
+            "n_imagens": 1,
+            "formato": "PNG",
+            "tamanho_hf": "1024x1024",
+            "atraso": 0.0,
+            # As próximas N chamadas de geração respondem 429 com Retry-After
+            "recusas_429": 0,
+            "retry_after": 1,
+            "modelos_imagem": ["bench/modelo"],
+            "modelos_texto": ["bench/texto"],
+        }
+        self.bytes_recebidos = 0
+        self.bytes_enviados = 0
+        self.requisicoes = 0
+        self.lock = threading.Lock()
+
+    def contar(self, recebidos: int, enviados: int):
+        with self.lock:
+            self.bytes_recebidos += recebidos
+            self.bytes_enviados += enviados
+            self.requisicoes += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "bytes_recebidos": self.bytes_recebidos,
+                "bytes_enviados": self.bytes_enviados,
+                "requisicoes": self.requisicoes,
+            }
+
+    def reset(self):
+        with self.lock:
+            self.bytes_recebidos = 0
+            self.bytes_enviados = 0
+            self.requisicoes = 0
+
+
+def resposta_openrouter(forma: str, urls: list[str], modelo: str) -> dict:
+    if forma == "content_image_url":
+        content = [{"type": "image_url", "image_url": {"url": u}} for u in urls]
+        message = {"role": "assistant", "content": content}
+    elif forma == "content_output_image":
+        content = [{"type": "output_image", "url": u} for u in urls]
+        message = {"role": "assistant", "content": content}
+    elif forma == "content_texto":
+        message = {"role": "assistant", "content": "Aqui está: " + " ".join(urls)}
+    else:
+        message = {
+            "role": "assistant",
+            "content": "",
+            "images": [{"type": "image_url", "image_url": {"url": u}} for u in urls],
+        }
+
+    return {
+        "id": "gen-bench",
+        "model": modelo,
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0},
+    }
+
+
+def criar_handler(estado: EstadoMock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _ler_corpo(self) -> bytes:
+            tamanho = int(self.headers.get("Content-Length", 0))
+            return self.rfile.read(tamanho) if tamanho else b""
+
+        def _responder(self, status: int, corpo: bytes, content_type: str, recebidos: int):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+            estado.contar(recebidos, len(corpo))
+
+        def _enviar_chunk(self, dados: bytes) -> int:
+            bloco = f"{len(dados):x}\r\n".encode("ascii") + dados + b"\r\n"
+            self.wfile.write(bloco)
+            return len(bloco)
+
+        def do_GET(self):
+            if self.path == "/_stats":
+                corpo = json.dumps(estado.stats()).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(corpo)))
+                self.end_headers()
+                self.wfile.write(corpo)
+                return
+
+            if self.path.startswith("/api/v1/models"):
+                self._catalogo()
+                return
+
+            self.send_error(404)
+
+        def _catalogo(self):
+            config = estado.config
+            modelos = [
+                {"id": m, "name": m, "architecture": {"input_modalities": ["text", "image"], "output_modalities": ["image"]}}
+                for m in config["modelos_imagem"]
+            ] + [
+                {"id": m, "name": m, "architecture": {"input_modalities": ["text"], "output_modalities": ["text"]}}
+                for m in config["modelos_texto"]
+            ]
+            corpo = json.dumps({"data": modelos}).encode("utf-8")
+
+            # Fora dos contadores: o catálogo é buscado uma vez, não a cada geração
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def do_POST(self):
+            corpo = self._ler_corpo()
+            recebidos = len(corpo) + sum(len(k) + len(v) + 4 for k, v in self.headers.items())
+
+            if self.path == "/_config":
+                estado.config.update(json.loads(corpo))
+                self._responder(200, b"{}", "application/json", 0)
+                return
+
+            if self.path == "/_reset":
+                estado.reset()
+                self._responder(200, b"{}", "application/json", 0)
+                return
+
+            with estado.lock:
+                recusar = estado.config["recusas_429"] > 0
+                if recusar:
+                    estado.config["recusas_429"] -= 1
+
+            if recusar:
+                self.send_response(429)
+                self.send_header("Retry-After", str(estado.config["retry_after"]))
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+                estado.contar(recebidos, 2)
+                return
+
+            if estado.config["atraso"]:
+                threading.Event().wait(estado.config["atraso"])
+
+            if self.path.startswith("/api/v1/chat/completions"):
+                self._openrouter(json.loads(corpo), recebidos)
+            else:
+                self._huggingface(recebidos)
+
+        def _openrouter(self, payload: dict, recebidos: int):
+            config = estado.config
+            tamanho = payload.get("image_config", {}).get("size", "1024x1024")
+            largura, altura = (int(v) for v in tamanho.split("x"))
+
+            dados = imagem_realista(largura, altura, config["formato"])
+            urls = [data_url(dados, config["formato"])] * int(config["n_imagens"])
+
+            if not payload.get("stream"):
+                corpo = json.dumps(resposta_openrouter(config["forma"], urls, payload.get("model"))).encode("utf-8")
+                self._responder(200, corpo, "application/json", recebidos)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            enviados = self._enviar_chunk(b": OPENROUTER PROCESSING\n\n")
+
+            for url in urls:
+                evento = {
+                    "id": "gen-bench",
+                    "model": payload.get("model"),
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"role": "assistant", "images": [{"type": "image_url", "image_url": {"url": url}}]},
+                    }],
+                }
+                enviados += self._enviar_chunk(b"data: " + json.dumps(evento).encode("utf-8") + b"\n\n")
+
+            final = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            enviados += self._enviar_chunk(b"data: " + json.dumps(final).encode("utf-8") + b"\n\n")
+            enviados += self._enviar_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+            estado.contar(recebidos, enviados + 5)
+
+        def _huggingface(self, recebidos: int):
+            config = estado.config
+            largura, altura = (int(v) for v in config["tamanho_hf"].split("x"))
+            corpo = imagem_realista(largura, altura, config["formato"])
+            self._responder(200, corpo, MIME_POR_FORMATO[config["formato"]], recebidos)
+
+    return Handler
+
+
+def _servir(fila_portas):
+    estado = EstadoMock()
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), criar_handler(estado))
+    servidor.daemon_threads = True
+    fila_portas.put(servidor.server_port)
+    servidor.serve_forever()
+
+
+def iniciar_mocks() -> tuple[multiprocessing.Process, str]:
+    """
+    Sobe os mocks em outro processo. Retorna (processo, url_base); o mesmo
+    servidor atende o OpenRouter (/api/v1/chat/completions) e o HF (qualquer outro caminho).
+    """
+    contexto = multiprocessing.get_context("spawn")
+    fila_portas = contexto.Queue()
+    processo = contexto.Process(target=_servir, args=(fila_portas,), daemon=True)
+    processo.start()
+
+    porta = fila_portas.get(timeout=30)
+    return processo, f"http://127.0.0.1:{porta}"
@@ -0,0 +1,233 @@
+"""
+Benchmark offline dos geradores contra os mocks locais (bench/mock_servers.py).
+
+Mede o overhead do próprio app — codificação da entrada, montagem do payload,
+leitura da resposta e decodificação das imagens — sem rede e sem chaves:
+tempo de parede, tempo de CPU, pico de RSS e bytes trafegados, por
+resolução de entrada, número de imagens na resposta e concorrência.
+
+Uso (a partir da raiz do repositório):
+
+    python -m bench.run_bench
+    python -m bench.run_bench --resolucoes 1024x768,4000x3000 --saidas 1,4 \\
+        --concorrencia 1,8 --formas message_images,stream --json resultado.json
+"""
+
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import comic_core  # noqa: E402
+from bench.mock_servers import FORMAS_RESPOSTA, iniciar_mocks  # noqa: E402
+from PIL import Image, ImageFilter  # noqa: E402
+
+
+def rss_atual_mb() -> float:
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for linha in f:
+                if linha.startswith("VmRSS:"):
+                    return int(linha.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def zerar_pico_rss() -> bool:
+    """
+    Zera o pico de RSS do processo (Linux). Sem isso, o pico é o do processo inteiro.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def pico_rss_mb() -> float:
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for linha in f:
+                if linha.startswith("VmHWM:"):
+                    return int(linha.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def imagem_de_entrada(resolucao: str) -> Image.Image:
+    largura, altura = (int(v) for v in resolucao.split("x"))
+    ruido = Image.effect_noise((largura, altura), 48).filter(ImageFilter.GaussianBlur(1))
+    gradiente = Image.linear_gradient("L").resize((largura, altura))
+    return Image.merge("RGB", (gradiente, ruido, Image.blend(ruido, gradiente, 0.3)))
+
+
+def configurar_core(url_mock: str, diretorio: Path):
+    comic_core.configurar({
+        "OPENROUTER_URL": f"{url_mock}/api/v1/chat/completions",
+        "OPENROUTER_API_KEY": "bench",
+        "HF_TOKEN": "bench",
+        "HF_ENDPOINT_URL": f"{url_mock}/hf",
+        "CACHE_DIR": str(diretorio / "cache"),
+        "METODOS_HF_ARQUIVO": str(diretorio / "metodos_hf.json"),
+        "CATALOGO_OPENROUTER_ARQUIVO": str(diretorio / "catalogo_openrouter.json"),
+        "METRICAS_ARQUIVO_JSONL": str(diretorio / "metricas.jsonl"),
+        "METRICAS_ARQUIVO_PROMETHEUS": str(diretorio / "metricas.prom"),
+        "HTTP_POOL_CONEXOES": 64,
+    })
+
+
+def executar_cenario(
+    url_mock: str,
+    provedor: str,
+    forma: str,
+    imagem: Image.Image,
+    resolucao: str,
+    n_saidas: int,
+    concorrencia: int,
+    repeticoes: int,
+) -> dict:
+    requests.post(f"{url_mock}/_config", json={
+        "forma": forma,
+        "n_imagens": n_saidas,
+        "tamanho_hf": "1024x1024",
+    }, timeout=10)
+    requests.post(f"{url_mock}/_reset", timeout=10)
+
+    def _uma_chamada(_):
+        if provedor == "openrouter":
+            imagens, _ = comic_core.gerar_imagem_de_outra_openrouter(
+                imagem_pil=imagem,
+                prompt=comic_core.PROMPT_COMIC_PADRAO,
+                negative_prompt=comic_core.NEGATIVE_COMIC_PADRAO,
+                model="bench/modelo",
+                size="1024x1024",
+                stream=(forma == "stream"),
+            )
+        else:
+            imagens, _ = comic_core.gerar_imagem_huggingface_img2img(
+                imagem_pil=imagem,
+                prompt=comic_core.PROMPT_COMIC_PADRAO,
+                negative_prompt=comic_core.NEGATIVE_COMIC_PADRAO,
+                model_id="bench/modelo-hf",
+                provider="replicate",
+            )
+
+        # Como ao exibir/usar os pixels
+        for img in imagens:
+            _ = img.pil  # força a decodificação
+
+        return len(imagens)
+
+    total_chamadas = concorrencia * repeticoes
+
+    zerar_pico_rss()
+    rss_inicial = rss_atual_mb()
+    cpu_inicial = time.process_time()
+    inicio = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concorrencia) as executor:
+        total_imagens = sum(executor.map(_uma_chamada, range(total_chamadas)))
+
+    parede = time.perf_counter() - inicio
+    cpu = time.process_time() - cpu_inicial
+    stats = requests.get(f"{url_mock}/_stats", timeout=10).json()
+
+    return {
+        "provedor": provedor,
+        "forma": forma,
+        "resolucao": resolucao,
+        "saidas": n_saidas,
+        "concorrencia": concorrencia,
+        "chamadas": total_chamadas,
+        "imagens": total_imagens,
+        "parede_s": round(parede, 3),
+        "cpu_s": round(cpu, 3),
+        "cpu_por_chamada_ms": round(cpu / total_chamadas * 1000, 1),
+        "chamadas_por_s": round(total_chamadas / parede, 2),
+        "pico_rss_mb": round(pico_rss_mb(), 1),
+        "pico_rss_delta_mb": round(pico_rss_mb() - rss_inicial, 1),
+        "bytes_enviados": stats["bytes_recebidos"],
+        "bytes_recebidos": stats["bytes_enviados"],
+    }
+
+
+def imprimir_tabela(linhas: list[dict]):
+    colunas = [
+        "provedor", "forma", "resolucao", "saidas", "concorrencia", "parede_s", "cpu_s",
+        "cpu_por_chamada_ms", "chamadas_por_s", "pico_rss_delta_mb", "bytes_enviados", "bytes_recebidos",
+    ]
+    larguras = {c: max(len(c), *(len(str(l[c])) for l in linhas)) for c in colunas}
+
+    print("  ".join(c.ljust(larguras[c]) for c in colunas))
+    for linha in linhas:
+        print("  ".join(str(linha[c]).ljust(larguras[c]) for c in colunas))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline dos geradores do Comic Book Image Studio.")
+    parser.add_argument("--resolucoes", default="1024x768,3000x2000,4000x3000")
+    parser.add_argument("--saidas", default="1,2,4", help="Imagens por resposta do OpenRouter.")
+    parser.add_argument("--concorrencia", default="1,4,8")
+    parser.add_argument("--formas", default=",".join(FORMAS_RESPOSTA))
+    parser.add_argument("--provedores", default="openrouter,huggingface")
+    parser.add_argument("--repeticoes", type=int, default=3, help="Chamadas por worker em cada cenário.")
+    parser.add_argument("--json", help="Grava os resultados neste arquivo JSON.")
+    args = parser.parse_args(argv)
+
+    resolucoes = args.resolucoes.split(",")
+    saidas = [int(v) for v in args.saidas.split(",")]
+    concorrencias = [int(v) for v in args.concorrencia.split(",")]
+    formas = args.formas.split(",")
+    provedores = args.provedores.split(",")
+
+    processo, url_mock = iniciar_mocks()
+    resultados = []
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="comic_bench_") as tmp:
+            configurar_core(url_mock, Path(tmp))
+
+            for resolucao in resolucoes:
+                imagem = imagem_de_entrada(resolucao)
+
+                for provedor in provedores:
+                    if provedor == "openrouter":
+                        cenarios = itertools.product(formas, saidas, concorrencias)
+                    else:
+                        cenarios = itertools.product(["image_to_image"], [1], concorrencias)
+
+                    for forma, n_saidas, concorrencia in cenarios:
+                        resultado = executar_cenario(
+                            url_mock, provedor, forma, imagem, resolucao,
+                            n_saidas, concorrencia, args.repeticoes,
+                        )
+                        resultados.append(resultado)
+                        print(json.dumps(resultado), file=sys.stderr)
+
+    finally:
+        processo.terminate()
+
+    imprimir_tabela(resultados)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(resultados, indent=2), encoding="utf-8")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
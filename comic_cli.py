@@ -0,0 +1,272 @@
+"""
+Processamento em lote pela linha de comando, sem Streamlit: transforma
+todas as imagens de uma pasta em paralelo e grava os resultados em disco.
+
+As chaves e demais configurações vêm de variáveis de ambiente com os mesmos
+nomes de st.secrets (OPENROUTER_API_KEY, HF_TOKEN, LIMITES_CONCORRENCIA...)
+ou de um arquivo secrets.toml passado em --secrets.
+
+Exemplos:
+
+    python comic_cli.py fotos/ saida/ --provedor openrouter --modelo black-forest-labs/flux.2-max
+    python comic_cli.py fotos/ saida/ --provedor huggingface --hf-provider replicate --workers 4
+    python comic_cli.py fotos/ saida/ --provedor local
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from PIL import Image
+
+import comic_core
+from comic_core import (
+    HF_PROVIDERS,
+    MODELO_HF_INICIAL,
+    MODELO_OPENROUTER_INICIAL,
+    NEGATIVE_COMIC_PADRAO,
+    PROMPT_COMIC_PADRAO,
+    PROVEDOR_LOCAL,
+    chave_limite_provedor,
+    configurar,
+    gerar_com_cache,
+    gerar_em_tiles,
+    gerar_imagem_de_outra_openrouter,
+    gerar_imagem_huggingface_img2img,
+    gerar_imagem_local_comic,
+    obter_cache_resultados,
+    obter_roteador_providers_hf,
+)
+
+EXTENSOES_ENTRADA = (".png", ".jpg", ".jpeg", ".webp")
+
+PROVEDORES = {
+    "openrouter": "OpenRouter",
+    "huggingface": "Hugging Face",
+    "local": PROVEDOR_LOCAL,
+}
+
+
+def carregar_configuracao(arquivo_secrets: str | None):
+    valores = dict(os.environ)
+
+    if arquivo_secrets:
+        import tomllib
+
+        with open(arquivo_secrets, "rb") as f:
+            valores.update(tomllib.load(f))
+
+    configurar(valores)
+
+
+def listar_entradas(pasta: Path, recursivo: bool) -> list[Path]:
+    padrao = "**/*" if recursivo else "*"
+    return sorted(p for p in pasta.glob(padrao) if p.is_file() and p.suffix.lower() in EXTENSOES_ENTRADA)
+
+
+def montar_geracao(args) -> tuple:
+    """
+    (funcao_geradora, chave_limite, parametros) a partir dos argumentos,
+    como o botão de geração do app.
+    """
+    provedor = PROVEDORES[args.provedor]
+    hf_provider = None
+
+    if args.provedor == "openrouter":
+        funcao_geradora = gerar_imagem_de_outra_openrouter
+        parametros = {
+            "model": args.modelo or MODELO_OPENROUTER_INICIAL,
+            "size": args.tamanho,
+            "quality": args.qualidade,
+        }
+
+    elif args.provedor == "huggingface":
+        funcao_geradora = gerar_imagem_huggingface_img2img
+        modelo = args.modelo or MODELO_HF_INICIAL
+        hf_provider = (
+            obter_roteador_providers_hf().escolher(modelo, HF_PROVIDERS)
+            if args.hf_provider == "auto"
+            else args.hf_provider
+        )
+        parametros = {
+            "model_id": modelo,
+            "provider": hf_provider,
+            "strength": args.strength,
+            "guidance_scale": args.guidance_scale,
+        }
+
+    else:
+        funcao_geradora = gerar_imagem_local_comic
+        parametros = {}
+
+    chave_limite = chave_limite_provedor(provedor, hf_provider)
+    parametros["distancia_similar"] = args.distancia_similar
+
+    if args.tiles:
+        # O tamanho de saída de cada bloco é escolhido por gerar_em_tiles
+        parametros.pop("size", None)
+        parametros = {
+            "funcao_tile": funcao_geradora,
+            "chave_limite_tile": chave_limite,
+            "lado_tile": args.lado_tile,
+            "sobreposicao_tile": args.sobreposicao_tile,
+            **parametros,
+        }
+        funcao_geradora = gerar_em_tiles
+        chave_limite = "tiles"
+
+    return funcao_geradora, chave_limite, parametros
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Transforma uma pasta de imagens em comic book, sem navegador.")
+    parser.add_argument("entrada", type=Path, help="Pasta com as imagens (png, jpg, jpeg, webp).")
+    parser.add_argument("saida", type=Path, help="Pasta onde os resultados são gravados.")
+    parser.add_argument("--provedor", choices=sorted(PROVEDORES), default="openrouter")
+    parser.add_argument("--modelo", help="Modelo OpenRouter ou Hugging Face (padrão: o inicial do app).")
+    parser.add_argument("--hf-provider", choices=["auto"] + HF_PROVIDERS, default="auto")
+    parser.add_argument("--prompt", default=PROMPT_COMIC_PADRAO)
+    parser.add_argument("--prompt-arquivo", type=Path, help="Lê o prompt positivo deste arquivo.")
+    parser.add_argument("--negative", default=NEGATIVE_COMIC_PADRAO)
+    parser.add_argument("--sem-preservar-fundo", action="store_true")
+    parser.add_argument("--tamanho", default="1024x1024", help="Tamanho de saída (com --tiles, escolhido por bloco).")
+    parser.add_argument("--qualidade", default="auto", choices=["auto", "low", "medium", "high"])
+    parser.add_argument("--strength", type=float, default=0.55)
+    parser.add_argument("--guidance-scale", type=float, default=7.5)
+    parser.add_argument("--tiles", action="store_true", help="Processa cada imagem em blocos (alta resolução).")
+    parser.add_argument("--lado-tile", type=int, default=comic_core.TILES_LADO)
+    parser.add_argument("--sobreposicao-tile", type=int, default=comic_core.TILES_SOBREPOSICAO)
+    parser.add_argument(
+        "--distancia-similar",
+        type=int,
+        default=None,
+        help="Reaproveita resultados de imagens parecidas até esta distância de hash (desligado por padrão).",
+    )
+    parser.add_argument("--workers", type=int, default=comic_core.LOTE_MAX_WORKERS, help="Imagens em andamento ao mesmo tempo.")
+    parser.add_argument("--recursivo", action="store_true", help="Inclui subpastas.")
+    parser.add_argument("--sobrescrever", action="store_true", help="Refaz imagens que já têm resultado na saída.")
+    parser.add_argument("--secrets", help="Arquivo secrets.toml com as chaves e configurações.")
+    args = parser.parse_args(argv)
+
+    carregar_configuracao(args.secrets)
+
+    if args.provedor == "openrouter" and not comic_core.OPENROUTER_API_KEY:
+        parser.error("OPENROUTER_API_KEY não configurada (variável de ambiente ou --secrets).")
+    if args.provedor == "huggingface" and not comic_core.HF_TOKEN:
+        parser.error("HF_TOKEN ou HUGGINGFACE_API_KEY não configurado (variável de ambiente ou --secrets).")
+
+    prompt = args.prompt_arquivo.read_text(encoding="utf-8") if args.prompt_arquivo else args.prompt
+    funcao_geradora, chave_limite, parametros = montar_geracao(args)
+
+    entradas = listar_entradas(args.entrada, args.recursivo)
+    args.saida.mkdir(parents=True, exist_ok=True)
+
+    def _destino(caminho: Path) -> Path:
+        relativo = caminho.relative_to(args.entrada).with_suffix("")
+        return args.saida / relativo.parent / f"{relativo.name}_comic"
+
+    if not args.sobrescrever:
+        entradas = [p for p in entradas if not list(_destino(p).parent.glob(f"{_destino(p).name}_*"))]
+
+    if not entradas:
+        print("Nenhuma imagem para processar.", file=sys.stderr)
+        return 0
+
+    cache = obter_cache_resultados()
+    relatorio_lock = threading.Lock()
+    relatorio = (args.saida / "resultados.jsonl").open("a", encoding="utf-8")
+
+    def _processar(caminho: Path) -> dict:
+        inicio = time.perf_counter()
+        registro = {"entrada": str(caminho)}
+
+        try:
+            # A imagem é decodificada no worker, só quando chega a vez dela
+            with Image.open(caminho) as imagem:
+                imagem_pil = imagem.convert("RGB")
+
+            imagens, bruto, cache_hit = gerar_com_cache(
+                funcao_geradora,
+                imagem_pil=imagem_pil,
+                cache=cache,
+                chave_limite=chave_limite,
+                prompt=prompt,
+                negative_prompt=args.negative,
+                preservar_fundo=not args.sem_preservar_fundo,
+                **parametros,
+            )
+
+            if not imagens:
+                raise RuntimeError("o modelo respondeu, mas nenhuma imagem foi encontrada na resposta")
+
+            destino = _destino(caminho)
+            destino.parent.mkdir(parents=True, exist_ok=True)
+            arquivos = []
+
+            for idx, img in enumerate(imagens, start=1):
+                arquivo = destino.with_name(f"{destino.name}_{idx}{img.extensao}")
+                arquivo.write_bytes(img.dados)
+                arquivos.append(str(arquivo))
+
+            registro.update({"saidas": arquivos, "cache_hit": cache_hit, "modelo": bruto.get("model") if isinstance(bruto, dict) else None})
+
+        except Exception as e:
+            registro["erro"] = str(e)
+
+        registro["segundos"] = round(time.perf_counter() - inicio, 2)
+
+        with relatorio_lock:
+            relatorio.write(json.dumps(registro, ensure_ascii=False) + "\n")
+            relatorio.flush()
+
+        return registro
+
+    falhas = 0
+    inicio_total = time.perf_counter()
+
+    # Mantém no máximo 2x workers imagens em voo, para não decodificar a pasta inteira de uma vez
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        pendentes = set()
+        concluidas = 0
+
+        for caminho in entradas:
+            pendentes.add(executor.submit(_processar, caminho))
+
+            while len(pendentes) >= args.workers * 2:
+                feitos, pendentes = wait(pendentes, return_when=FIRST_COMPLETED)
+                for futuro in feitos:
+                    concluidas += 1
+                    falhas += _informar(futuro.result(), concluidas, len(entradas))
+
+        for futuro in wait(pendentes).done:
+            concluidas += 1
+            falhas += _informar(futuro.result(), concluidas, len(entradas))
+
+    relatorio.close()
+
+    print(
+        f"{len(entradas) - falhas}/{len(entradas)} imagem(ns) em {time.perf_counter() - inicio_total:.1f}s; "
+        f"relatório em {args.saida / 'resultados.jsonl'}",
+        file=sys.stderr,
+    )
+
+    return 1 if falhas else 0
+
+
+def _informar(registro: dict, concluidas: int, total: int) -> int:
+    if "erro" in registro:
+        print(f"[{concluidas}/{total}] ❌ {registro['entrada']}: {registro['erro']}", file=sys.stderr)
+        return 1
+
+    origem = "cache" if registro["cache_hit"] else f"{registro['segundos']}s"
+    print(f"[{concluidas}/{total}] ✅ {registro['entrada']} ({origem})", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,4319 @@
+"""
+Núcleo do Comic Book Image Studio: chamadas ao OpenRouter e ao Hugging Face,
+codificação de imagens, cache, fila de jobs, hedge e métricas.
+
+Não depende do Streamlit: o app (app.py), o processamento em lote pela linha
+de comando (comic_cli.py) e os scripts de benchmark configuram este módulo com
+configurar(...) e chamam as mesmas funções.
+"""
+
+import io
+import os
+import atexit
+import re
+import json
+import math
+import time
+import random
+import base64
+import bisect
+import shutil
+import hashlib
+import functools
+import inspect
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image, ImageEnhance, ImageFilter
+
+if TYPE_CHECKING:
+    from huggingface_hub import InferenceClient
+
+# =========================
+# SECRETS / CHAVES
+# =========================
+
+OPENROUTER_API_KEY = ""
+HF_TOKEN = ""
+
+APP_REFERER = "https://streamlit.app"
+APP_TITLE = "Comic Book Image Studio"
+
+# =========================
+# ENDPOINTS
+# =========================
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# Se definido, as chamadas HF vão para este endpoint (Inference Endpoint
+# próprio, servidor local) em vez do modelo roteado pelo provider
+HF_ENDPOINT_URL = ""
+
+# =========================
+# CATÁLOGO DE MODELOS OPENROUTER
+# =========================
+
+# Vazio: derivado de OPENROUTER_URL (.../api/v1/models)
+OPENROUTER_MODELOS_URL = ""
+CATALOGO_OPENROUTER_ARQUIVO = Path(".cache/catalogo_openrouter.json")
+CATALOGO_OPENROUTER_TTL = 24 * 3600
+# Sem rede, nenhum modelo é recusado; nova tentativa de busca após este tempo
+CATALOGO_OPENROUTER_TTL_FALHA = 5 * 60
+
+# =========================
+# CACHE DE RESULTADOS
+# =========================
+
+CACHE_DIR = Path(".cache/resultados")
+CACHE_MAX_ITENS_MEMORIA = 32
+CACHE_MAX_BYTES_DISCO = 512 * 1024 * 1024
+CACHE_TTL_SEGUNDOS = 7 * 24 * 3600
+
+# =========================
+# MODO LOTE
+# =========================
+
+LOTE_MAX_WORKERS = 8
+
+# Chamadas simultâneas permitidas por provedor, somando todas as sessões
+LIMITES_CONCORRENCIA = {
+    "local": 4,
+    "openrouter": 4,
+    "replicate": 2,
+    "fal-ai": 2,
+    "wavespeed": 2,
+}
+LIMITE_CONCORRENCIA_PADRAO = 2
+
+# =========================
+# LIMITE DE TAXA (429)
+# =========================
+
+# Chamadas por minuto por provedor, para cada chave de API, ex.: {"openrouter": 20}.
+# Opcional: sem limite (0), nada espera antes da chamada e o limitador só reage
+# a 429, Retry-After e X-RateLimit-Remaining. Use a cota real do plano da chave.
+LIMITES_TAXA_POR_MINUTO = {}
+LIMITE_TAXA_PADRAO_POR_MINUTO = 0
+# Chamadas que podem sair de uma vez quando o balde está cheio
+TAXA_RAJADA = 2
+# Tentativas por chamada recusada com 429, e o backoff (com jitter) quando não vem Retry-After
+TAXA_MAX_TENTATIVAS = 5
+TAXA_BACKOFF_BASE = 2.0
+TAXA_BACKOFF_MAXIMO = 60.0
+
+# =========================
+# PROCESSAMENTO EM BLOCOS (TILES)
+# =========================
+
+TILES_LADO = 1024
+TILES_SOBREPOSICAO = 128
+# Lados quadrados pedidos ao modelo para cada bloco (o mais próximo do bloco)
+TILES_TAMANHOS_SAIDA = (512, 768, 1024, 1536)
+# Threads por imagem; as chamadas simultâneas continuam limitadas por LIMITES_CONCORRENCIA
+TILES_MAX_WORKERS = 8
+
+# =========================
+# ÍNDICE DE IMAGENS PARECIDAS
+# =========================
+
+# Distância de Hamming (em 64 bits) padrão para reaproveitar o resultado de uma entrada parecida
+SIMILARES_DISTANCIA_PADRAO = 6
+SIMILARES_ARQUIVO = Path(".cache/indice_similares.jsonl")
+# Entradas mantidas no índice; as mais antigas saem primeiro
+SIMILARES_MAX_ENTRADAS = 20000
+
+# =========================
+# EXIBIÇÃO
+# =========================
+
+# Formato das miniaturas mostradas na tela (download e zoom usam os bytes originais)
+MINIATURA_FORMATO = "WEBP"
+MINIATURA_QUALIDADE = 80
+
+# =========================
+# MOTOR LOCAL
+# =========================
+
+# Lado máximo da imagem gerada pelo motor local (a prévia usa LOCAL_LADO_PREVIA)
+LOCAL_LADO_MAXIMO = 2048
+LOCAL_LADO_PREVIA = 768
+
+# =========================
+# ANIMAÇÕES
+# =========================
+
+# Distância de Hamming (em 64 bits) até a qual um frame reaproveita um quadro-chave
+ANIMACAO_DISTANCIA_MAX = 6
+# Diferença máxima da cor média (0-255, por canal) para reaproveitar um quadro-chave;
+# o dHash só olha o brilho relativo e não vê mudanças de cor
+ANIMACAO_DIFERENCA_COR_MAX = 12
+ANIMACAO_MAX_FRAMES = 300
+# Acima disso, frames novos reaproveitam à força o quadro-chave mais parecido (contado em reuso_forcado)
+ANIMACAO_MAX_QUADROS_CHAVE = 48
+ANIMACAO_MAX_WORKERS = 8
+
+EXTENSOES_VIDEO = (".mp4", ".webm", ".mov", ".mkv", ".avi")
+
+# =========================
+# COMPARAÇÃO DE MODELOS
+# =========================
+
+# Células da grade em andamento ao mesmo tempo; cada provedor continua limitado por LIMITES_CONCORRENCIA
+COMPARACAO_MAX_WORKERS = 16
+
+# =========================
+# FILA DE JOBS
+# =========================
+
+JOBS_MAX_WORKERS = 16
+JOBS_RETENCAO_SEGUNDOS = 3600
+
+# =========================
+# HEDGE
+# =========================
+
+HEDGE_ATRASO_PADRAO = 45.0
+HEDGE_MAX_EXTRAS = 2
+
+# Modelos OpenRouter usados como alternativa quando o principal demora
+HEDGE_MODELOS_OPENROUTER = [
+    "black-forest-labs/flux.2-klein-4b",
+    "bytedance-seed/seedream-4.5",
+]
+
+# =========================
+# MÉTRICAS
+# =========================
+
+METRICAS_ARQUIVO_JSONL = Path(".cache/metricas.jsonl")
+METRICAS_ARQUIVO_PROMETHEUS = Path(".cache/metricas.prom")
+METRICAS_MAX_AMOSTRAS = 2000
+# As amostras vão para o JSONL em lotes: a cada N amostras ou a cada X segundos
+METRICAS_LOTE_JSONL = 200
+METRICAS_INTERVALO_JSONL = 5.0
+# Acima disso o JSONL vira .jsonl.1 (substituindo o anterior) e recomeça
+METRICAS_MAX_BYTES_JSONL = 50 * 1024 * 1024
+
+# =========================
+# CONEXÕES HTTP
+# =========================
+
+HTTP_TIMEOUT_CONEXAO = 10.0
+HTTP_TIMEOUT_LEITURA = 300.0
+HTTP_POOL_CONEXOES = 16
+
+# =========================
+# MÉTODOS DE CHAMADA HUGGING FACE
+# =========================
+
+METODOS_HF_ARQUIVO = Path(".cache/metodos_hf.json")
+METODOS_HF_TTL_FALHA = 30 * 60
+
+# =========================
+# ROTEAMENTO DE PROVIDERS HUGGING FACE
+# =========================
+
+# Peso da chamada mais recente nas médias móveis (EWMA) de latência e erro
+ROTEADOR_ALFA_EWMA = 0.3
+# Quanto a taxa de erro piora a nota: latência * (1 + penalidade * erro)
+ROTEADOR_PENALIDADE_ERRO = 4.0
+# Falhas seguidas que abrem o circuito, e por quanto tempo ele fica aberto
+ROTEADOR_FALHAS_PARA_ABRIR = 3
+ROTEADOR_TEMPO_ABERTO = 120
+# Provider saudável sem uso há este tempo recebe uma chamada de sondagem
+ROTEADOR_INTERVALO_SONDA = 300
+
+# =========================
+# PRÉ-PROCESSAMENTO DA ENTRADA
+# =========================
+
+# Lado máximo da imagem enviada quando o provedor não recebe tamanho de saída
+LADO_MAXIMO_ENTRADA_PADRAO = 1024
+
+# Limite por modelo (sobrepõe o tamanho de saída quando menor)
+LADO_MAXIMO_ENTRADA_POR_MODELO = {
+    "timbrooks/instruct-pix2pix": 768,
+    "nitrosocke/comic-diffusion": 768,
+    "runwayml/stable-diffusion-v1-5": 768,
+}
+
+# (formato, qualidade) da imagem enviada a cada provedor
+FORMATO_ENTRADA_POR_PROVEDOR = {
+    "openrouter": ("JPEG", 90),
+    "replicate": ("WEBP", 90),
+    "fal-ai": ("JPEG", 92),
+    "wavespeed": ("JPEG", 92),
+}
+
+CONFIGURAVEIS = (
+    "OPENROUTER_API_KEY",
+    "HF_TOKEN",
+    "APP_REFERER",
+    "APP_TITLE",
+    "OPENROUTER_URL",
+    "HF_ENDPOINT_URL",
+    "OPENROUTER_MODELOS_URL",
+    "CATALOGO_OPENROUTER_ARQUIVO",
+    "CATALOGO_OPENROUTER_TTL",
+    "CATALOGO_OPENROUTER_TTL_FALHA",
+    "CACHE_DIR",
+    "CACHE_MAX_ITENS_MEMORIA",
+    "CACHE_MAX_BYTES_DISCO",
+    "CACHE_TTL_SEGUNDOS",
+    "LOTE_MAX_WORKERS",
+    "LIMITES_CONCORRENCIA",
+    "LIMITES_TAXA_POR_MINUTO",
+    "LIMITE_TAXA_PADRAO_POR_MINUTO",
+    "TAXA_RAJADA",
+    "TAXA_MAX_TENTATIVAS",
+    "TAXA_BACKOFF_BASE",
+    "TAXA_BACKOFF_MAXIMO",
+    "TILES_LADO",
+    "TILES_SOBREPOSICAO",
+    "TILES_TAMANHOS_SAIDA",
+    "TILES_MAX_WORKERS",
+    "SIMILARES_DISTANCIA_PADRAO",
+    "SIMILARES_ARQUIVO",
+    "SIMILARES_MAX_ENTRADAS",
+    "MINIATURA_FORMATO",
+    "MINIATURA_QUALIDADE",
+    "LOCAL_LADO_MAXIMO",
+    "LOCAL_LADO_PREVIA",
+    "ANIMACAO_DISTANCIA_MAX",
+    "ANIMACAO_DIFERENCA_COR_MAX",
+    "ANIMACAO_MAX_FRAMES",
+    "ANIMACAO_MAX_QUADROS_CHAVE",
+    "ANIMACAO_MAX_WORKERS",
+    "COMPARACAO_MAX_WORKERS",
+    "JOBS_MAX_WORKERS",
+    "JOBS_RETENCAO_SEGUNDOS",
+    "HEDGE_ATRASO_PADRAO",
+    "HEDGE_MAX_EXTRAS",
+    "HEDGE_MODELOS_OPENROUTER",
+    "METRICAS_ARQUIVO_JSONL",
+    "METRICAS_ARQUIVO_PROMETHEUS",
+    "METRICAS_MAX_AMOSTRAS",
+    "METRICAS_LOTE_JSONL",
+    "METRICAS_INTERVALO_JSONL",
+    "METRICAS_MAX_BYTES_JSONL",
+    "HTTP_TIMEOUT_CONEXAO",
+    "HTTP_TIMEOUT_LEITURA",
+    "HTTP_POOL_CONEXOES",
+    "METODOS_HF_ARQUIVO",
+    "METODOS_HF_TTL_FALHA",
+    "ROTEADOR_ALFA_EWMA",
+    "ROTEADOR_PENALIDADE_ERRO",
+    "ROTEADOR_FALHAS_PARA_ABRIR",
+    "ROTEADOR_TEMPO_ABERTO",
+    "ROTEADOR_INTERVALO_SONDA",
+    "LADO_MAXIMO_ENTRADA_PADRAO",
+    "LADO_MAXIMO_ENTRADA_POR_MODELO",
+    "FORMATO_ENTRADA_POR_PROVEDOR",
+)
+
+
+def configurar(valores: Mapping):
+    """
+    Aplica configurações vindas de st.secrets, de variáveis de ambiente ou
+    de um dicionário. Só os nomes de CONFIGURAVEIS são considerados; textos
+    são convertidos para o tipo do valor padrão (JSON para números, listas e
+    dicionários). Dicionários são mesclados com os padrões.
+    """
+    valores = dict(valores)
+
+    if not valores.get("HF_TOKEN") and valores.get("HUGGINGFACE_API_KEY"):
+        valores["HF_TOKEN"] = valores["HUGGINGFACE_API_KEY"]
+
+    modulo = globals()
+
+    for nome in CONFIGURAVEIS:
+        if nome not in valores:
+            continue
+
+        valor = valores[nome]
+        atual = modulo[nome]
+
+        if isinstance(valor, str) and not isinstance(atual, (str, Path)):
+            valor = json.loads(valor)
+
+        if isinstance(atual, dict):
+            atual.update(dict(valor))
+        elif isinstance(atual, list):
+            modulo[nome] = list(valor)
+        elif isinstance(atual, Path):
+            modulo[nome] = Path(valor)
+        else:
+            modulo[nome] = type(atual)(valor)
+
+
+# =========================
+# RECURSOS COMPARTILHADOS
+# =========================
+
+_recursos = {}
+_recursos_lock = threading.RLock()
+
+
+def recurso_compartilhado(fabrica):
+    """
+    Cria o recurso uma única vez por processo e devolve sempre a mesma
+    instância — compartilhada entre sessões, reruns e threads.
+    """
+    @functools.wraps(fabrica)
+    def obter():
+        with _recursos_lock:
+            if fabrica.__name__ not in _recursos:
+                _recursos[fabrica.__name__] = fabrica()
+
+            return _recursos[fabrica.__name__]
+
+    return obter
+
+
+# =========================
+# MODELOS OPENROUTER
+# =========================
+
+MODELO_OPENROUTER_INICIAL = "x-ai/grok-imagine-image-quality"
+
+MODELOS_OPENROUTER_IMAGEM = [
+    "x-ai/grok-imagine-image-quality",
+    "black-forest-labs/flux.2-max",
+    "black-forest-labs/flux.2-klein-4b",
+    "bytedance-seed/seedream-4.5",
+    "recraft/recraft-v4.1-pro-vector",
+    "qwen/qwen3.7-plus",
+    "openrouter/auto",
+]
+
+# =========================
+# MODELOS HUGGING FACE
+# =========================
+
+MODELO_HF_INICIAL = "black-forest-labs/FLUX.2-klein-9B"
+
+MODELOS_HF_IMAGEM = [
+    "black-forest-labs/FLUX.2-klein-9B",
+    "Qwen/Qwen-Image-Edit-2511",
+    "autoweeb/Qwen-Image-Edit-2509-Photo-to-Anime",
+    "timbrooks/instruct-pix2pix",
+    "nitrosocke/comic-diffusion",
+    "runwayml/stable-diffusion-v1-5",
+    "stabilityai/stable-diffusion-xl-base-1.0",
+]
+
+HF_PROVIDER_INICIAL = "replicate"
+
+HF_PROVIDERS = [
+    "replicate",
+    "fal-ai",
+    "wavespeed",
+]
+
+# =========================
+# MOTOR LOCAL (CPU)
+# =========================
+
+PROVEDOR_LOCAL = "Local (CPU)"
+MODELO_LOCAL = "comic-local-cpu"
+
+# =========================
+# PROMPTS PADRÃO
+# =========================
+
+PROMPT_COMIC_PADRAO = (
+    "Transform the uploaded image into a Western comic book illustration. "
+    "Preserve the person's identity, pose, body proportions, composition, and main scene elements. "
+    "Convert the image into a detailed comic book style with bold clean ink lines, "
+    "rich cel shading, soft halftone texture, expressive contours, strong highlights and shadows, "
+    "vibrant but balanced colors, and a polished graphic novel appearance. "
+    "Do not make it photorealistic. "
+    "The final result should clearly look like a drawn comic book illustration, not a painted photo."
+)
+
+NEGATIVE_COMIC_PADRAO = (
+    "photorealistic, realistic photo, photo filter, oil painting, watercolor, blurry, low quality, pixelated, noisy, "
+    "anime, manga, cartoon for kids, 3d render, cgi, deformed anatomy, extra limbs, extra fingers, "
+    "mutated hands, warped face, asymmetrical eyes, distorted proportions, text, watermark, logo, caption"
+)
+
+# Acrescentado ao prompt de cada bloco no processamento em tiles
+PROMPT_TILE = (
+    "This image is one tile cut from a larger picture. Keep the exact framing, scale and composition of the tile; "
+    "do not add borders, panels, frames, margins or text, and do not center or complete cut-off subjects."
+)
+
+# =========================
+# FUNÇÕES AUXILIARES
+# =========================
+
+def sugerir_provider_hf(model_id: str) -> str:
+    """
+    Sugere provider Hugging Face de acordo com o modelo. Usado pelo
+    roteador apenas enquanto ainda não há chamadas medidas.
+    """
+
+    if model_id == "Qwen/Qwen-Image-Edit-2511":
+        return "fal-ai"
+
+    if model_id == "autoweeb/Qwen-Image-Edit-2509-Photo-to-Anime":
+        return "wavespeed"
+
+    if model_id == "black-forest-labs/FLUX.2-klein-9B":
+        return "replicate"
+
+    return "replicate"
+
+MIME_POR_FORMATO = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "GIF": "image/gif",
+}
+
+
+def bytes_to_data_url(dados: bytes, mime: str) -> str:
+    """
+    Converte bytes já codificados em data URL base64.
+    """
+    b64 = base64.b64encode(dados).decode("utf-8")
+    return f"data:{mime};base64,{b64}"
+
+
+class CorpoJsonComImagem:
+    """
+    Corpo de requisição JSON com uma imagem embutida como data URL, gerado
+    em partes: o envelope é serializado uma vez com um marcador no lugar da
+    imagem, e o base64 é calculado bloco a bloco a partir de uma memoryview
+    dos bytes codificados. Nem o data URL nem o JSON completo chegam a
+    existir inteiros na memória. O tamanho é conhecido de antemão (requests
+    envia Content-Length em vez de chunked) e o corpo pode ser iterado de
+    novo quando a chamada é repetida.
+    """
+
+    # Múltiplo de 3: cada bloco vira base64 sem padding no meio do corpo
+    BLOCO = 3 * 64 * 1024
+
+    # Colocado no payload onde vai o data URL da imagem
+    MARCADOR = f"__imagem_{uuid.uuid4().hex}__"
+
+    def __init__(self, payload: dict, dados, mime: str):
+        inicio, fim = json.dumps(payload, allow_nan=False).encode("utf-8").split(self.MARCADOR.encode("ascii"))
+        prefixo = f"data:{mime};base64,"
+
+        self._dados = memoryview(dados).cast("B")
+        self._inicio = inicio + prefixo.encode("ascii")
+        self._fim = fim
+        self.tamanho_data_url = len(prefixo) + 4 * ((len(self._dados) + 2) // 3)
+
+    def __len__(self) -> int:
+        return len(self._inicio) + 4 * ((len(self._dados) + 2) // 3) + len(self._fim)
+
+    def __iter__(self):
+        yield self._inicio
+
+        for posicao in range(0, len(self._dados), self.BLOCO):
+            yield base64.b64encode(self._dados[posicao:posicao + self.BLOCO])
+
+        yield self._fim
+
+
+def parse_tamanho(size: str | None) -> tuple[int, int] | None:
+    """
+    Converte "1024x768" em (1024, 768). Retorna None se não for possível.
+    """
+    if not size or "x" not in size:
+        return None
+
+    try:
+        largura, altura = (int(v) for v in size.lower().split("x", 1))
+    except ValueError:
+        return None
+
+    return largura, altura
+
+
+def preparar_imagem_entrada(
+    imagem_pil: Image.Image,
+    destino: str,
+    model: str,
+    size: str | None = None,
+) -> tuple[io.BytesIO, str, dict]:
+    """
+    Reduz a imagem ao tamanho útil para o modelo e codifica no formato
+    configurado para o provedor de destino ('openrouter' ou provider HF).
+    Retorna (arquivo, mime, info): arquivo é o BytesIO com a imagem
+    codificada, na posição 0 (getbuffer() lê sem copiar); info traz o
+    tamanho antes e depois.
+    """
+    lado_maximo = LADO_MAXIMO_ENTRADA_PADRAO
+
+    tamanho_saida = parse_tamanho(size)
+    if tamanho_saida:
+        lado_maximo = max(tamanho_saida)
+
+    if model in LADO_MAXIMO_ENTRADA_POR_MODELO:
+        lado_maximo = min(lado_maximo, int(LADO_MAXIMO_ENTRADA_POR_MODELO[model]))
+
+    largura, altura = imagem_pil.size
+    escala = lado_maximo / max(largura, altura)
+
+    imagem = imagem_pil
+    if escala < 1:
+        novo_tamanho = (max(1, round(largura * escala)), max(1, round(altura * escala)))
+        imagem = imagem_pil.resize(novo_tamanho, Image.LANCZOS, reducing_gap=3.0)
+
+    if imagem.mode != "RGB":
+        imagem = imagem.convert("RGB")
+
+    formato, qualidade = FORMATO_ENTRADA_POR_PROVEDOR.get(destino, ("JPEG", 90))
+    formato = formato.upper()
+
+    buffer = io.BytesIO()
+    if formato == "PNG":
+        imagem.save(buffer, format=formato, optimize=False)
+    else:
+        imagem.save(buffer, format=formato, quality=int(qualidade))
+
+    tamanho = buffer.tell()
+    buffer.seek(0)
+
+    mime = MIME_POR_FORMATO.get(formato, "image/jpeg")
+
+    info = {
+        "dimensoes_originais": f"{largura}x{altura}",
+        "bytes_rgb_originais": largura * altura * 3,
+        "dimensoes_enviadas": f"{imagem.width}x{imagem.height}",
+        "formato": formato,
+        "qualidade": qualidade if formato != "PNG" else None,
+        "bytes_enviados": tamanho,
+    }
+
+    return buffer, mime, info
+
+
+EXTENSAO_POR_MIME = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+
+
+def codificar_miniatura(imagem: Image.Image, largura: int) -> bytes:
+    """
+    Reduz para a largura de exibição (altura limitada ao dobro) e codifica
+    em MINIATURA_FORMATO, bem menor que o PNG em resolução total.
+    """
+    miniatura = imagem.convert("RGB") if imagem.mode != "RGB" else imagem.copy()
+    miniatura.thumbnail((largura, largura * 2), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    buf = io.BytesIO()
+    miniatura.save(buf, format=MINIATURA_FORMATO, quality=MINIATURA_QUALIDADE)
+    return buf.getvalue()
+
+
+def miniatura_de_bytes(dados: bytes, largura: int) -> bytes:
+    """
+    Miniatura a partir dos bytes de um arquivo. Animações, e JPEG/WebP que já
+    cabem na largura, são devolvidos como estão. Em JPEG, o draft decodifica
+    direto numa escala reduzida.
+    """
+    with Image.open(io.BytesIO(dados)) as imagem:
+        if getattr(imagem, "n_frames", 1) > 1:
+            return dados
+
+        if imagem.width <= largura and imagem.format in ("JPEG", "WEBP"):
+            return dados
+
+        imagem.draft("RGB", (largura, largura * 2))
+        return codificar_miniatura(imagem.convert("RGB"), largura)
+
+
+class ImagemGerada:
+    """
+    Imagem retornada por um provedor, guardada com os bytes e o MIME
+    originais. Só é decodificada para PIL quando os pixels forem necessários;
+    exibição e download usam os bytes originais, sem recodificar.
+    """
+
+    def __init__(self, dados: bytes | None = None, mime: str = "image/png", imagem: Image.Image | None = None):
+        if dados is None and imagem is None:
+            raise ValueError("ImagemGerada precisa de bytes ou de uma PIL Image.")
+
+        self._dados = dados
+        self.mime = mime
+        self._pil = imagem
+        self._miniaturas = {}
+
+    @classmethod
+    def de_pil(cls, imagem: Image.Image) -> "ImagemGerada":
+        return cls(imagem=imagem.convert("RGB") if imagem.mode != "RGB" else imagem, mime="image/png")
+
+    @property
+    def dados(self) -> bytes:
+        """
+        Bytes do arquivo. Para imagens que chegaram como PIL, codifica em PNG uma única vez.
+        """
+        if self._dados is None:
+            buf = io.BytesIO()
+            self._pil.save(buf, format="PNG")
+            self._dados = buf.getvalue()
+
+        return self._dados
+
+    @property
+    def pil(self) -> Image.Image:
+        """
+        PIL Image em RGB, decodificada sob demanda.
+        """
+        imagem = self._pil
+        if imagem is None:
+            imagem = Image.open(io.BytesIO(self._dados)).convert("RGB")
+            self._pil = imagem
+
+        return imagem
+
+    @property
+    def bytes_em_memoria(self) -> int:
+        """
+        Bytes do arquivo e das miniaturas, mais os pixels se a PIL estiver decodificada.
+        """
+        total = len(self.dados) + sum(len(m) for m in self._miniaturas.values())
+
+        imagem = self._pil
+        if imagem is not None:
+            total += imagem.width * imagem.height * len(imagem.getbands())
+
+        return total
+
+    def liberar_pixels(self):
+        """
+        Descarta a PIL decodificada, mantendo os bytes do arquivo; os pixels
+        voltam a ser decodificados se alguém pedir .pil de novo.
+        """
+        _ = self.dados  # imagens que chegaram como PIL são codificadas antes
+        self._pil = None
+
+    @property
+    def extensao(self) -> str:
+        return EXTENSAO_POR_MIME.get(self.mime, ".png")
+
+    def miniatura(self, largura: int) -> bytes:
+        """
+        Versão para a tela com no máximo `largura` px, gerada uma vez por largura.
+        Os bytes completos ficam para o zoom e o download.
+        """
+        if largura not in self._miniaturas:
+            imagem = self._pil
+            if imagem is not None:
+                self._miniaturas[largura] = codificar_miniatura(imagem, largura)
+            else:
+                self._miniaturas[largura] = miniatura_de_bytes(self._dados, largura)
+
+        return self._miniaturas[largura]
+
+
+def data_url_to_bytes(data_url: str) -> tuple[bytes, str]:
+    """
+    Converte data URL base64 em (bytes, mime), sem decodificar a imagem.
+    """
+    if "," not in data_url:
+        raise ValueError("Data URL inválida.")
+
+    cabecalho, b64_data = data_url.split(",", 1)
+    mime = cabecalho[len("data:"):].split(";", 1)[0] or "image/png"
+    return base64.b64decode(b64_data), mime
+
+
+def data_url_to_imagem(data_url: str) -> ImagemGerada:
+    """
+    Converte data URL base64 em ImagemGerada, preservando os bytes originais.
+    """
+    dados, mime = data_url_to_bytes(data_url)
+    return ImagemGerada(dados=dados, mime=mime)
+
+
+def montar_prompt_final(prompt: str, negative_prompt: str, preservar_fundo: bool) -> str:
+    """
+    Monta o prompt final enviado ao modelo.
+    """
+    partes = [prompt.strip()]
+
+    if preservar_fundo:
+        partes.append(
+            "Preserve the original background and scene layout as much as possible."
+        )
+    else:
+        partes.append(
+            "You may simplify the background while preserving the main subject and scene readability."
+        )
+
+    if negative_prompt.strip():
+        partes.append("Negative prompt / avoid:")
+        partes.append(negative_prompt.strip())
+
+    return "\n\n".join(partes)
+
+
+def compactar_bruto(valor):
+    """
+    Copia a resposta bruta trocando data URLs por um marcador com o tamanho,
+    para não manter o base64 das imagens duplicado em memória.
+    """
+    if isinstance(valor, dict):
+        return {k: compactar_bruto(v) for k, v in valor.items()}
+
+    if isinstance(valor, list):
+        return [compactar_bruto(v) for v in valor]
+
+    if isinstance(valor, str) and len(valor) > 256 and "base64," in valor:
+        return re.sub(
+            r"data:image\/[a-zA-Z]+;base64,[A-Za-z0-9+/=]+",
+            lambda m: f"<data URL omitida: {len(m.group(0))} caracteres>",
+            valor,
+        )
+
+    return valor
+
+
+def extract_images_from_openrouter(data: dict) -> list[ImagemGerada]:
+    """
+    Extrai imagens da resposta do OpenRouter, mantendo os bytes originais.
+    """
+    imagens = []
+
+    choices = data.get("choices", [])
+    if not choices:
+        return imagens
+
+    message = choices[0].get("message", {})
+    content = message.get("content")
+
+    # Caso 1: content como lista multimodal
+    if isinstance(content, list):
+        for item in content:
+            if not isinstance(item, dict):
+                continue
+
+            tipo = item.get("type")
+
+            if tipo == "image_url":
+                image_url = item.get("image_url", {})
+                url = image_url.get("url", "") if isinstance(image_url, dict) else ""
+
+                if isinstance(url, str) and url.startswith("data:image/"):
+                    imagens.append(data_url_to_imagem(url))
+
+            elif tipo in ("image", "output_image"):
+                url = item.get("url") or item.get("image_url") or ""
+
+                if isinstance(url, dict):
+                    url = url.get("url", "")
+
+                if isinstance(url, str) and url.startswith("data:image/"):
+                    imagens.append(data_url_to_imagem(url))
+
+    # Caso 2: content como string com data URL
+    elif isinstance(content, str):
+        encontrados = re.findall(
+            r"data:image\/[a-zA-Z]+;base64,[A-Za-z0-9+/=]+",
+            content
+        )
+
+        for data_url in encontrados:
+            imagens.append(data_url_to_imagem(data_url))
+
+    # Caso 3: fallback message.images
+    imagens_msg = message.get("images", [])
+
+    if isinstance(imagens_msg, list):
+        for item in imagens_msg:
+            if not isinstance(item, dict):
+                continue
+
+            image_url = item.get("image_url", {})
+            url = ""
+
+            if isinstance(image_url, dict):
+                url = image_url.get("url", "")
+            elif isinstance(image_url, str):
+                url = image_url
+
+            if isinstance(url, str) and url.startswith("data:image/"):
+                imagens.append(data_url_to_imagem(url))
+
+    return imagens
+
+
+# =========================
+# MÉTRICAS DE LATÊNCIA POR ESTÁGIO
+# =========================
+
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+ROTULOS_METRICAS = ("estagio", "provedor", "modelo", "hf_provider", "tamanho")
+
+
+class HistogramaLatencia:
+    """
+    Histograma com buckets fixos (para exportar no formato Prometheus) e
+    uma janela das amostras mais recentes (para percentis exatos).
+    """
+
+    def __init__(self, max_amostras: int):
+        self.contagens = [0] * (len(BUCKETS_LATENCIA) + 1)
+        self.soma = 0.0
+        self.total = 0
+        self.amostras = deque(maxlen=max_amostras)
+
+    def observar(self, segundos: float):
+        self.contagens[bisect.bisect_left(BUCKETS_LATENCIA, segundos)] += 1
+        self.soma += segundos
+        self.total += 1
+        self.amostras.append(segundos)
+
+    def percentil(self, q: float) -> float:
+        ordenadas = sorted(self.amostras)
+        if not ordenadas:
+            return 0.0
+
+        # Posto mais próximo: o menor valor com pelo menos q% das amostras até ele
+        indice = min(len(ordenadas) - 1, max(0, math.ceil(q / 100 * len(ordenadas)) - 1))
+        return ordenadas[indice]
+
+
+def escapar_rotulo_prometheus(valor: str) -> str:
+    """
+    Escapa barra invertida, aspas e quebra de linha, como o formato de
+    exposição do Prometheus exige nos valores de rótulo.
+    """
+    return valor.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricasLatencia:
+    """
+    Registra a duração de cada estágio (codificação, requisição, leitura,
+    decodificação, renderização...) por provedor/modelo/tamanho, em
+    histogramas em memória e em um arquivo JSONL. As linhas do JSONL ficam
+    num buffer e são gravadas em lote, fora do lock dos histogramas; o
+    arquivo é rotacionado ao passar de max_bytes_jsonl.
+    """
+
+    def __init__(
+        self,
+        arquivo_jsonl: Path,
+        arquivo_prometheus: Path,
+        max_amostras: int,
+        lote_jsonl: int,
+        intervalo_jsonl: float,
+        max_bytes_jsonl: int,
+    ):
+        self.arquivo_jsonl = Path(arquivo_jsonl)
+        self.arquivo_prometheus = Path(arquivo_prometheus)
+        self.max_amostras = max_amostras
+        self.lote_jsonl = lote_jsonl
+        self.intervalo_jsonl = intervalo_jsonl
+        self.max_bytes_jsonl = max_bytes_jsonl
+        self._series = {}
+        self._pendentes = []
+        self._gravado_em = time.monotonic()
+        self._lock = threading.Lock()
+        self._lock_arquivo = threading.Lock()
+
+    def registrar(self, estagio: str, segundos: float, **tags):
+        valores = {**tags, "estagio": estagio}
+        rotulos = tuple("" if valores.get(r) is None else str(valores[r]) for r in ROTULOS_METRICAS)
+        linha = json.dumps(
+            {"ts": time.time(), "estagio": estagio, "segundos": round(segundos, 6), **tags},
+            default=str,
+        ) + "\n"
+
+        with self._lock:
+            serie = self._series.get(rotulos)
+            if serie is None:
+                serie = self._series[rotulos] = HistogramaLatencia(self.max_amostras)
+
+            serie.observar(segundos)
+            self._pendentes.append(linha)
+
+            gravar = (
+                len(self._pendentes) >= self.lote_jsonl
+                or time.monotonic() - self._gravado_em >= self.intervalo_jsonl
+            )
+
+        if gravar:
+            self.descarregar()
+
+    def descarregar(self):
+        """
+        Grava no JSONL as amostras pendentes, rotacionando o arquivo se preciso.
+        """
+        with self._lock_arquivo:
+            with self._lock:
+                linhas, self._pendentes = self._pendentes, []
+                self._gravado_em = time.monotonic()
+
+            if not linhas:
+                return
+
+            try:
+                self.arquivo_jsonl.parent.mkdir(parents=True, exist_ok=True)
+
+                if self.arquivo_jsonl.exists() and self.arquivo_jsonl.stat().st_size >= self.max_bytes_jsonl:
+                    os.replace(self.arquivo_jsonl, self.arquivo_jsonl.with_name(self.arquivo_jsonl.name + ".1"))
+
+                with self.arquivo_jsonl.open("a", encoding="utf-8") as f:
+                    f.write("".join(linhas))
+            except OSError:
+                pass
+
+    @contextmanager
+    def medir(self, estagio: str, **tags):
+        """
+        Mede o bloco. O dicionário retornado pode receber tags extras
+        (ex.: bytes) durante a execução.
+        """
+        inicio = time.perf_counter()
+        try:
+            yield tags
+        finally:
+            self.registrar(estagio, time.perf_counter() - inicio, **tags)
+
+    def resumo(self) -> list[dict]:
+        with self._lock:
+            linhas = []
+
+            for rotulos, serie in self._series.items():
+                linha = dict(zip(ROTULOS_METRICAS, rotulos))
+                linha.update({
+                    "n": serie.total,
+                    "p50_s": round(serie.percentil(50), 3),
+                    "p95_s": round(serie.percentil(95), 3),
+                    "p99_s": round(serie.percentil(99), 3),
+                    "media_s": round(serie.soma / serie.total, 3) if serie.total else 0.0,
+                })
+                linhas.append(linha)
+
+            return sorted(linhas, key=lambda l: (l["modelo"], l["estagio"]))
+
+    def exportar_prometheus(self) -> str:
+        """
+        Gera o texto no formato de exposição do Prometheus e grava no arquivo configurado.
+        """
+        linhas = [
+            "# HELP comic_estagio_segundos Duração de cada estágio da geração.",
+            "# TYPE comic_estagio_segundos histogram",
+        ]
+
+        with self._lock:
+            for rotulos, serie in self._series.items():
+                base = ",".join(
+                    f'{nome}="{escapar_rotulo_prometheus(valor)}"'
+                    for nome, valor in zip(ROTULOS_METRICAS, rotulos)
+                )
+
+                acumulado = 0
+                for limite, contagem in zip(BUCKETS_LATENCIA, serie.contagens):
+                    acumulado += contagem
+                    linhas.append(f'comic_estagio_segundos_bucket{{{base},le="{limite}"}} {acumulado}')
+
+                linhas.append(f'comic_estagio_segundos_bucket{{{base},le="+Inf"}} {serie.total}')
+                linhas.append(f"comic_estagio_segundos_sum{{{base}}} {serie.soma:.6f}")
+                linhas.append(f"comic_estagio_segundos_count{{{base}}} {serie.total}")
+
+        texto = "\n".join(linhas) + "\n"
+
+        try:
+            self.arquivo_prometheus.parent.mkdir(parents=True, exist_ok=True)
+            self.arquivo_prometheus.write_text(texto, encoding="utf-8")
+        except OSError:
+            pass
+
+        return texto
+
+
+@recurso_compartilhado
+def obter_metricas() -> MetricasLatencia:
+    metricas = MetricasLatencia(
+        METRICAS_ARQUIVO_JSONL,
+        METRICAS_ARQUIVO_PROMETHEUS,
+        METRICAS_MAX_AMOSTRAS,
+        lote_jsonl=METRICAS_LOTE_JSONL,
+        intervalo_jsonl=METRICAS_INTERVALO_JSONL,
+        max_bytes_jsonl=METRICAS_MAX_BYTES_JSONL,
+    )
+    # O que ainda estiver no buffer vai para o arquivo quando o processo termina
+    atexit.register(metricas.descarregar)
+    return metricas
+
+
+def medir(estagio: str, **tags):
+    """
+    Atalho: with medir("estagio", provedor=..., modelo=...) as tags: ...
+    """
+    return obter_metricas().medir(estagio, **tags)
+
+
+def tags_do_bruto(bruto) -> dict:
+    """
+    Deduz provedor/modelo de uma resposta bruta (OpenRouter ou metadados HF).
+    """
+    if not isinstance(bruto, dict):
+        return {}
+
+    if bruto.get("provider") == "huggingface":
+        return {"provedor": "huggingface", "modelo": bruto.get("model"), "hf_provider": bruto.get("hf_provider")}
+
+    if bruto.get("provider") == "local":
+        return {"provedor": "local", "modelo": bruto.get("model")}
+
+    return {"provedor": "openrouter", "modelo": bruto.get("model")}
+
+
+# =========================
+# SESSÃO HTTP COMPARTILHADA
+# =========================
+
+@recurso_compartilhado
+def obter_sessao_openrouter() -> requests.Session:
+    """
+    Sessão HTTP keep-alive única no processo, compartilhada entre sessões e
+    reruns do Streamlit, para reaproveitar as conexões TCP/TLS com o OpenRouter.
+    """
+    sessao = requests.Session()
+
+    adaptador = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=max(HTTP_POOL_CONEXOES, LIMITES_CONCORRENCIA.get("openrouter", 1)),
+        max_retries=0,
+    )
+    sessao.mount("https://", adaptador)
+    sessao.mount("http://", adaptador)
+
+    return sessao
+
+
+def estatisticas_sessao_http(sessao: requests.Session) -> dict:
+    """
+    Resume o uso dos pools de conexão: conexões abertas x requisições feitas.
+    Requisições acima do número de conexões reaproveitaram uma conexão existente.
+    """
+    estatisticas = {}
+
+    for adaptador in set(sessao.adapters.values()):
+        pools = adaptador.poolmanager.pools
+
+        for chave in list(pools.keys()):
+            pool = pools.get(chave)
+            if pool is None:
+                continue
+
+            conexoes = pool.num_connections
+            requisicoes = pool.num_requests
+
+            estatisticas[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "conexoes_abertas": conexoes,
+                "requisicoes": requisicoes,
+                "reaproveitadas": max(0, requisicoes - conexoes),
+            }
+
+    return estatisticas
+
+
+class RegistroClientesHF:
+    """
+    Um InferenceClient por (provider, token), criado uma única vez e
+    reaproveitado por todas as sessões e workers do modo lote. O
+    huggingface_hub só é importado quando o primeiro cliente é criado.
+    """
+
+    def __init__(self):
+        self._clientes = {}
+        self._usos = {}
+        self._lock = threading.Lock()
+
+    def obter(self, provider: str, token: str) -> "InferenceClient":
+        chave = (provider, hashlib.sha256(token.encode("utf-8")).hexdigest()[:12])
+
+        with self._lock:
+            cliente = self._clientes.get(chave)
+
+            if cliente is None:
+                from huggingface_hub import InferenceClient
+
+                cliente = InferenceClient(provider=provider, api_key=token)
+                self._clientes[chave] = cliente
+                self._usos[chave] = 0
+
+            self._usos[chave] += 1
+            return cliente
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            return {
+                f"{provider} (token {token_hash})": {"usos": usos}
+                for (provider, token_hash), usos in self._usos.items()
+            }
+
+
+@recurso_compartilhado
+def obter_registro_clientes_hf() -> RegistroClientesHF:
+    return RegistroClientesHF()
+
+
+# =========================
+# LIMITE DE TAXA POR PROVEDOR E CHAVE
+# =========================
+
+class ErroLimiteTaxa(RuntimeError):
+    """
+    Chamada recusada por limite de taxa (HTTP 429). espera é o tempo pedido
+    pelo provedor (Retry-After ou cabeçalhos de rate limit), quando informado.
+    """
+
+    def __init__(self, mensagem: str, espera: float | None = None, status: int = 429, corpo: str = ""):
+        super().__init__(mensagem)
+        self.espera = espera
+        self.status = status
+        self.corpo = corpo
+
+
+def _segundos_ate(valor: str, agora: float) -> float | None:
+    """
+    Converte um instante ou intervalo de cabeçalho em segundos a partir de
+    agora: número de segundos, epoch em segundos ou milissegundos, ou data HTTP.
+    """
+    try:
+        numero = float(valor)
+    except (TypeError, ValueError):
+        try:
+            return max(0.0, parsedate_to_datetime(valor).timestamp() - agora)
+        except (TypeError, ValueError):
+            return None
+
+    if numero > 1e12:
+        return max(0.0, numero / 1000 - agora)
+    if numero > 1e9:
+        return max(0.0, numero - agora)
+
+    return max(0.0, numero)
+
+
+def espera_dos_cabecalhos(headers: Mapping | None) -> float | None:
+    """
+    Segundos até o provedor aceitar novas chamadas, segundo Retry-After,
+    retry-after-ms ou X-RateLimit-Reset (quando não restam chamadas).
+    """
+    if not headers:
+        return None
+
+    headers = {k.lower(): v for k, v in headers.items()}
+    agora = time.time()
+
+    if "retry-after-ms" in headers:
+        try:
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        except ValueError:
+            pass
+
+    if "retry-after" in headers:
+        espera = _segundos_ate(headers["retry-after"], agora)
+        if espera is not None:
+            return espera
+
+    restantes = headers.get("x-ratelimit-remaining", headers.get("ratelimit-remaining"))
+    reset = headers.get("x-ratelimit-reset", headers.get("ratelimit-reset"))
+
+    if reset is not None and restantes is not None and str(restantes).strip() == "0":
+        return _segundos_ate(reset, agora)
+
+    return None
+
+
+class BaldeFichas:
+    """
+    Balde de fichas de um (provedor, chave): enche a taxa/segundo até a
+    capacidade (rajada). Cada chamada reserva uma ficha; quando o saldo fica
+    negativo, a chamada espera a vez dela, então a fila sai exatamente na
+    taxa permitida e na ordem de chegada. Um 429 esvazia o balde e bloqueia
+    todas as chamadas da mesma chave até o tempo pedido pelo provedor.
+    Sem taxa (por_minuto <= 0) não há fichas: só os bloqueios valem.
+    """
+
+    def __init__(self, por_minuto: float, capacidade: int):
+        self.taxa = por_minuto / 60 if por_minuto > 0 else None
+        self.capacidade = max(1, capacidade)
+        self._fichas = float(self.capacidade)
+        self._atualizado = time.monotonic()
+        self._bloqueado_ate = 0.0
+        self._lock = threading.Lock()
+        self.chamadas = 0
+        self.recusadas = 0
+        self.espera_total = 0.0
+
+    def _encher(self, agora: float):
+        if self.taxa is None:
+            return
+
+        self._fichas = min(self.capacidade, self._fichas + (agora - self._atualizado) * self.taxa)
+        self._atualizado = agora
+
+    def adquirir(self) -> float:
+        """
+        Reserva a próxima vaga e espera até ela chegar. Retorna os segundos esperados.
+        """
+        inicio = time.monotonic()
+
+        with self._lock:
+            self._encher(inicio)
+            self.chamadas += 1
+            vez = inicio
+
+            if self.taxa is not None:
+                self._fichas -= 1
+                vez += max(0.0, -self._fichas / self.taxa)
+
+        while True:
+            with self._lock:
+                liberado = max(vez, self._bloqueado_ate)
+
+            espera = liberado - time.monotonic()
+            if espera <= 0:
+                break
+
+            time.sleep(espera)
+
+        esperado = time.monotonic() - inicio
+
+        with self._lock:
+            self.espera_total += esperado
+
+        return esperado
+
+    def bloquear(self, segundos: float):
+        """
+        Chamada recusada: nenhuma chamada desta chave sai nos próximos segundos.
+        """
+        agora = time.monotonic()
+
+        with self._lock:
+            self._encher(agora)
+            self._fichas = min(self._fichas, 0.0)
+            self._bloqueado_ate = max(self._bloqueado_ate, agora + segundos)
+            self.recusadas += 1
+
+    def observar_cabecalhos(self, headers: Mapping | None):
+        """
+        Acompanha X-RateLimit-Remaining de respostas bem-sucedidas: se o
+        provedor diz que restam menos chamadas que as fichas, o balde baixa.
+        """
+        if not headers:
+            return
+
+        headers = {k.lower(): v for k, v in headers.items()}
+
+        try:
+            restantes = float(headers.get("x-ratelimit-remaining", headers.get("ratelimit-remaining")))
+        except (TypeError, ValueError):
+            return
+
+        espera = espera_dos_cabecalhos(headers) if restantes <= 0 else None
+        agora = time.monotonic()
+
+        with self._lock:
+            self._encher(agora)
+            self._fichas = min(self._fichas, restantes)
+
+            if espera:
+                self._bloqueado_ate = max(self._bloqueado_ate, agora + espera)
+
+    def estatisticas(self) -> dict:
+        agora = time.monotonic()
+
+        with self._lock:
+            self._encher(agora)
+
+            return {
+                "por_minuto": None if self.taxa is None else round(self.taxa * 60, 2),
+                "fichas": None if self.taxa is None else round(self._fichas, 2),
+                "bloqueado_por_s": round(max(0.0, self._bloqueado_ate - agora), 1),
+                "chamadas": self.chamadas,
+                "recusadas_429": self.recusadas,
+                "espera_total_s": round(self.espera_total, 1),
+            }
+
+
+class LimitadorTaxa:
+    """
+    Um BaldeFichas por (provedor, chave de API), compartilhado por todas as
+    sessões: a cota é da chave, não da sessão. Complementa o
+    LimitadorConcorrencia, que limita chamadas simultâneas, não por minuto.
+    """
+
+    def __init__(self, limites_por_minuto: dict, limite_padrao: float, rajada: int):
+        self.limites_por_minuto = dict(limites_por_minuto)
+        self.limite_padrao = limite_padrao
+        self.rajada = rajada
+        self._baldes = {}
+        self._lock = threading.Lock()
+
+    def balde(self, provedor: str, chave_api: str) -> BaldeFichas:
+        chave = (provedor, hashlib.sha256(chave_api.encode("utf-8")).hexdigest()[:12])
+
+        with self._lock:
+            if chave not in self._baldes:
+                por_minuto = float(self.limites_por_minuto.get(provedor, self.limite_padrao))
+                self._baldes[chave] = BaldeFichas(por_minuto, self.rajada)
+
+            return self._baldes[chave]
+
+    def chamar(self, provedor: str, chave_api: str, funcao, /, **tags):
+        """
+        Executa funcao() dentro da taxa do (provedor, chave); tags vão para a
+        métrica de espera. Em ErroLimiteTaxa, bloqueia a chave pelo tempo
+        pedido (ou backoff exponencial com jitter) e tenta de novo, até
+        TAXA_MAX_TENTATIVAS.
+        """
+        balde = self.balde(provedor, chave_api)
+
+        for tentativa in range(1, TAXA_MAX_TENTATIVAS + 1):
+            with medir("espera_limite_taxa", **tags):
+                balde.adquirir()
+
+            try:
+                return funcao()
+            except ErroLimiteTaxa as e:
+                if e.espera is not None:
+                    # Jitter pequeno para as chamadas bloqueadas não voltarem todas no mesmo instante
+                    espera = e.espera + random.uniform(0, 1)
+                else:
+                    espera = random.uniform(0, min(TAXA_BACKOFF_MAXIMO, TAXA_BACKOFF_BASE * 2 ** tentativa))
+
+                balde.bloquear(espera)
+
+                if tentativa == TAXA_MAX_TENTATIVAS:
+                    raise
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            baldes = dict(self._baldes)
+
+        return {
+            f"{provedor} (chave {chave_hash})": balde.estatisticas()
+            for (provedor, chave_hash), balde in sorted(baldes.items())
+        }
+
+
+@recurso_compartilhado
+def obter_limitador_taxa() -> LimitadorTaxa:
+    return LimitadorTaxa(LIMITES_TAXA_POR_MINUTO, LIMITE_TAXA_PADRAO_POR_MINUTO, TAXA_RAJADA)
+
+
+# =========================
+# STREAMING OPENROUTER (SSE)
+# =========================
+
+def ler_stream_openrouter(resp: requests.Response, ao_progresso=None):
+    """
+    Lê a resposta SSE do OpenRouter evento a evento, decodificando cada
+    imagem assim que ela chega em vez de carregar o JSON inteiro.
+    ao_progresso(status, bytes_recebidos, imagens_recebidas) é chamado a cada evento.
+    Retorna (imagens, resumo) — o resumo não guarda o base64 das imagens.
+    """
+    imagens = []
+    partes_texto = []
+    bytes_recebidos = 0
+    resumo = {"stream": True}
+
+    def _avisar(status: str):
+        if ao_progresso is not None:
+            ao_progresso(status, bytes_recebidos, len(imagens))
+
+    try:
+        for linha in resp.iter_lines(chunk_size=64 * 1024):
+            bytes_recebidos += len(linha) + 1
+
+            if not linha:
+                continue
+
+            # Comentários SSE (ex.: ": OPENROUTER PROCESSING") mantêm a conexão viva
+            if linha.startswith(b":"):
+                _avisar("processando")
+                continue
+
+            if not linha.startswith(b"data:"):
+                continue
+
+            conteudo = linha[5:].strip()
+
+            if conteudo == b"[DONE]":
+                break
+
+            evento = json.loads(conteudo)
+            del linha, conteudo
+
+            if "error" in evento:
+                raise RuntimeError(f"Erro no stream do OpenRouter: {evento['error']}")
+
+            for chave in ("id", "model", "usage"):
+                if evento.get(chave):
+                    resumo[chave] = evento[chave]
+
+            for escolha in evento.get("choices", []):
+                delta = escolha.get("delta") or escolha.get("message") or {}
+                texto = delta.get("content")
+
+                if isinstance(texto, str):
+                    partes_texto.append(texto)
+                    delta = {k: v for k, v in delta.items() if k != "content"}
+
+                imagens.extend(
+                    extract_images_from_openrouter({"choices": [{"message": delta}]})
+                )
+
+                if escolha.get("finish_reason"):
+                    resumo["finish_reason"] = escolha["finish_reason"]
+
+            _avisar("recebendo")
+
+    finally:
+        resp.close()
+
+    # Data URLs dentro do texto podem chegar quebradas em vários eventos
+    texto_final = "".join(partes_texto)
+
+    if "data:image/" in texto_final:
+        imagens.extend(
+            extract_images_from_openrouter(
+                {"choices": [{"message": {"content": texto_final}}]}
+            )
+        )
+        texto_final = re.sub(r"data:image\/[a-zA-Z]+;base64,[A-Za-z0-9+/=]+", "<imagem>", texto_final)
+
+    resumo["content"] = texto_final
+    resumo["imagens_recebidas"] = len(imagens)
+    resumo["bytes_recebidos"] = bytes_recebidos
+
+    _avisar("concluído")
+
+    return imagens, resumo
+
+
+# =========================
+# CATÁLOGO DE MODELOS OPENROUTER
+# =========================
+
+class ModeloIncompativel(ValueError):
+    """
+    O modelo não existe no catálogo do OpenRouter ou não faz image-to-image.
+    Levantada antes de qualquer upload.
+    """
+
+
+class CatalogoModelosOpenRouter:
+    """
+    Catálogo de modelos do OpenRouter (GET /api/v1/models), buscado uma vez
+    e guardado em disco por CATALOGO_OPENROUTER_TTL, indexado por id e por
+    modalidades de entrada/saída. Sem rede e sem cópia em disco, nada é
+    recusado: o 404 da chamada continua sendo o último recurso.
+    """
+
+    def __init__(self, url: str, arquivo: Path, ttl_segundos: float, ttl_falha_segundos: float):
+        self.url = url
+        self.arquivo = Path(arquivo)
+        self.ttl_segundos = ttl_segundos
+        self.ttl_falha_segundos = ttl_falha_segundos
+        self._lock = threading.Lock()
+        self._modelos = {}
+        self._por_modalidade = {}
+        self._buscado_em = 0.0
+        self._tentar_de_novo_em = 0.0
+        self._origem = None
+        self._erro = None
+
+        try:
+            dados = json.loads(self.arquivo.read_text(encoding="utf-8"))
+            self._indexar(dados["modelos"], dados["buscado_em"], "disco")
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def _indexar(self, modelos: dict, buscado_em: float, origem: str):
+        por_modalidade = {}
+
+        for model_id, info in modelos.items():
+            for lado in ("entrada", "saida"):
+                for modalidade in info.get(lado, []):
+                    por_modalidade.setdefault((lado, modalidade), set()).add(model_id)
+
+        self._modelos = modelos
+        self._por_modalidade = por_modalidade
+        self._buscado_em = buscado_em
+        self._origem = origem
+
+    def _buscar(self):
+        resp = obter_sessao_openrouter().get(
+            self.url,
+            headers={"HTTP-Referer": APP_REFERER, "X-Title": APP_TITLE},
+            timeout=(HTTP_TIMEOUT_CONEXAO, 30),
+        )
+        resp.raise_for_status()
+
+        modelos = {}
+
+        for item in resp.json().get("data", []):
+            arquitetura = item.get("architecture") or {}
+            modelos[item["id"]] = {
+                "nome": item.get("name", item["id"]),
+                "entrada": arquitetura.get("input_modalities") or [],
+                "saida": arquitetura.get("output_modalities") or [],
+            }
+
+        if not modelos:
+            raise ValueError("catálogo vazio")
+
+        agora = time.time()
+        self._indexar(modelos, agora, "rede")
+        self._erro = None
+
+        try:
+            self.arquivo.parent.mkdir(parents=True, exist_ok=True)
+            temporario = self.arquivo.with_suffix(".tmp")
+            temporario.write_text(json.dumps({"buscado_em": agora, "modelos": modelos}), encoding="utf-8")
+            os.replace(temporario, self.arquivo)
+        except OSError:
+            pass
+
+    def _atualizar(self) -> bool:
+        """
+        Busca o catálogo se não houver um dentro do TTL. Uma falha de rede
+        mantém a cópia antiga (se houver) e só tenta de novo após
+        CATALOGO_OPENROUTER_TTL_FALHA. Retorna se há catálogo para consultar.
+        """
+        with self._lock:
+            agora = time.time()
+
+            if agora - self._buscado_em >= self.ttl_segundos and agora >= self._tentar_de_novo_em:
+                try:
+                    self._buscar()
+                except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+                    self._erro = repr(e)
+                    self._tentar_de_novo_em = agora + self.ttl_falha_segundos
+
+            return bool(self._modelos)
+
+    def modelos(self, entrada: str | None = "image", saida: str | None = "image") -> list[str]:
+        """
+        Ids com as modalidades pedidas; por padrão, os que fazem image-to-image.
+        Lista vazia se o catálogo não estiver disponível.
+        """
+        if not self._atualizar():
+            return []
+
+        with self._lock:
+            ids = set(self._modelos)
+
+            if entrada:
+                ids &= self._por_modalidade.get(("entrada", entrada), set())
+            if saida:
+                ids &= self._por_modalidade.get(("saida", saida), set())
+
+            return sorted(ids)
+
+    def verificar(self, model: str) -> str | None:
+        """
+        Motivo para recusar o modelo em image-to-image, ou None se ele é
+        compatível (ou se o catálogo não está disponível).
+        """
+        if not self._atualizar():
+            return None
+
+        with self._lock:
+            info = self._modelos.get(model)
+
+        if info is None:
+            return f"O modelo {model} não existe no catálogo do OpenRouter."
+
+        if "image" not in info["saida"]:
+            return (
+                f"O modelo {model} não gera imagens no OpenRouter "
+                f"(saída: {', '.join(info['saida']) or 'desconhecida'})."
+            )
+
+        if "image" not in info["entrada"]:
+            return (
+                f"O modelo {model} gera imagens, mas não aceita imagem de referência "
+                f"(entrada: {', '.join(info['entrada']) or 'desconhecida'})."
+            )
+
+        return None
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            return {
+                "url": self.url,
+                "modelos": len(self._modelos),
+                "image_to_image": len(
+                    self._por_modalidade.get(("entrada", "image"), set())
+                    & self._por_modalidade.get(("saida", "image"), set())
+                ),
+                "origem": self._origem,
+                "idade_s": round(time.time() - self._buscado_em) if self._buscado_em else None,
+                "ultimo_erro": self._erro,
+            }
+
+
+@recurso_compartilhado
+def obter_catalogo_openrouter() -> CatalogoModelosOpenRouter:
+    url = OPENROUTER_MODELOS_URL or OPENROUTER_URL.rsplit("/chat/completions", 1)[0] + "/models"
+    return CatalogoModelosOpenRouter(
+        url,
+        CATALOGO_OPENROUTER_ARQUIVO,
+        CATALOGO_OPENROUTER_TTL,
+        CATALOGO_OPENROUTER_TTL_FALHA,
+    )
+
+
+def modelos_openrouter_disponiveis() -> list[str]:
+    """
+    Modelos para os seletores: os de MODELOS_OPENROUTER_IMAGEM que o
+    catálogo aceita, seguidos dos demais modelos image-to-image do
+    catálogo. Sem catálogo, a lista fixa.
+    """
+    catalogo = obter_catalogo_openrouter().modelos()
+
+    if not catalogo:
+        return list(MODELOS_OPENROUTER_IMAGEM)
+
+    compativeis = set(catalogo)
+    fixos = [m for m in MODELOS_OPENROUTER_IMAGEM if m in compativeis]
+    return fixos + [m for m in catalogo if m not in fixos]
+
+
+# =========================
+# CHAMADA OPENROUTER
+# =========================
+
+class ErroOpenRouter(RuntimeError):
+    """
+    Resposta de erro do OpenRouter; guarda o status e o corpo para exibição.
+    """
+
+    def __init__(self, mensagem: str, status: int, corpo: str):
+        super().__init__(mensagem)
+        self.status = status
+        self.corpo = corpo
+
+
+def gerar_imagem_de_outra_openrouter(
+    imagem_pil: Image.Image,
+    prompt: str,
+    negative_prompt: str,
+    model: str,
+    size: str = "1024x1024",
+    quality: str = "auto",
+    preservar_fundo: bool = True,
+    stream: bool = False,
+    ao_progresso=None,
+):
+    if not OPENROUTER_API_KEY:
+        raise RuntimeError("OPENROUTER_API_KEY não configurada (st.secrets ou variável de ambiente).")
+
+    # Recusa antes de codificar e enviar a imagem
+    problema = obter_catalogo_openrouter().verificar(model)
+    if problema:
+        raise ModeloIncompativel(problema)
+
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": APP_REFERER,
+        "X-Title": APP_TITLE,
+    }
+
+    tags = {"provedor": "openrouter", "modelo": model, "tamanho": size}
+
+    prompt_final = montar_prompt_final(prompt, negative_prompt, preservar_fundo)
+
+    payload = {
+        "model": model,
+        "modalities": ["image"],
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt_final
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": CorpoJsonComImagem.MARCADOR
+                        }
+                    }
+                ]
+            }
+        ],
+        "image_config": {
+            "size": size,
+            "quality": quality
+        }
+    }
+
+    if stream:
+        payload["stream"] = True
+
+    # O base64 da imagem é gerado em blocos durante o envio, não aqui
+    with medir("codificacao_entrada", **tags) as tags_estagio:
+        imagem_arquivo, imagem_mime, info_entrada = preparar_imagem_entrada(
+            imagem_pil,
+            destino="openrouter",
+            model=model,
+            size=size,
+        )
+        corpo = CorpoJsonComImagem(payload, imagem_arquivo.getbuffer(), imagem_mime)
+        info_entrada["bytes_data_url"] = corpo.tamanho_data_url
+        tags_estagio["bytes"] = corpo.tamanho_data_url
+
+    balde = obter_limitador_taxa().balde("openrouter", OPENROUTER_API_KEY)
+
+    def _postar() -> requests.Response:
+        # Sem streaming, inclui upload, processamento no provedor e download do corpo
+        with medir("requisicao_http", stream=stream, bytes=info_entrada["bytes_data_url"], **tags):
+            resp = obter_sessao_openrouter().post(
+                OPENROUTER_URL,
+                headers=headers,
+                data=corpo,
+                timeout=(HTTP_TIMEOUT_CONEXAO, HTTP_TIMEOUT_LEITURA),
+                stream=stream,
+            )
+
+        if resp.status_code == 429:
+            texto = resp.text
+            resp.close()
+            raise ErroLimiteTaxa(
+                f"Limite de taxa do OpenRouter atingido (429) para {model}.",
+                espera=espera_dos_cabecalhos(resp.headers),
+                corpo=texto,
+            )
+
+        balde.observar_cabecalhos(resp.headers)
+        return resp
+
+    resp = obter_limitador_taxa().chamar("openrouter", OPENROUTER_API_KEY, _postar, **tags)
+
+    if resp.status_code == 404:
+        raise ErroOpenRouter(
+            "Erro 404: o modelo existe, mas não aceitou a modalidade solicitada. "
+            "Para modelos de imagem pura, este script usa modalities=['image']. "
+            f"Modalidade incompatível no OpenRouter: {model}",
+            status=resp.status_code,
+            corpo=resp.text,
+        )
+
+    if resp.status_code != 200:
+        raise ErroOpenRouter(
+            f"Erro da API OpenRouter — status {resp.status_code}",
+            status=resp.status_code,
+            corpo=resp.text,
+        )
+
+    if stream:
+        # Leitura e decodificação acontecem intercaladas no streaming
+        with medir("leitura_stream", **tags) as tags_estagio:
+            imagens, data = ler_stream_openrouter(resp, ao_progresso)
+            tags_estagio["bytes"] = data.get("bytes_recebidos")
+    else:
+        with medir("leitura_json", bytes=len(resp.content), **tags):
+            data = resp.json()
+
+        with medir("decodificacao_imagens", **tags) as tags_estagio:
+            imagens = extract_images_from_openrouter(data)
+            tags_estagio["imagens"] = len(imagens)
+
+    if isinstance(data, dict):
+        data["entrada"] = info_entrada
+
+    return imagens, data
+
+
+# =========================
+# ROTEAMENTO DE PROVIDERS HUGGING FACE
+# =========================
+
+class RoteadorProvidersHF:
+    """
+    Escolhe o provider Hugging Face para cada modelo a partir das chamadas
+    reais: médias móveis (EWMA) de latência e de taxa de erro por
+    (modelo, provider). Providers com falhas seguidas têm o circuito aberto
+    por um tempo; depois disso, e periodicamente para os que ficaram sem
+    uso, recebem uma chamada de sondagem para que a recuperação seja notada.
+    """
+
+    def __init__(
+        self,
+        alfa: float,
+        penalidade_erro: float,
+        falhas_para_abrir: int,
+        tempo_aberto: float,
+        intervalo_sonda: float,
+    ):
+        self.alfa = alfa
+        self.penalidade_erro = penalidade_erro
+        self.falhas_para_abrir = falhas_para_abrir
+        self.tempo_aberto = tempo_aberto
+        self.intervalo_sonda = intervalo_sonda
+        self._lock = threading.Lock()
+        self._estado = {}
+        self._visto_em = {}
+
+    def _registro(self, model_id: str, provider: str) -> dict:
+        return self._estado.setdefault((model_id, provider), {
+            "latencia_ewma": None,
+            "erro_ewma": 0.0,
+            "chamadas": 0,
+            "falhas": 0,
+            "falhas_seguidas": 0,
+            "aberto_ate": 0.0,
+            "ultimo_uso": self._visto_em.get(model_id, time.time()),
+            "sondas": 0,
+        })
+
+    def _nota(self, registro: dict) -> float:
+        if registro["latencia_ewma"] is None:
+            return float("inf")
+
+        return registro["latencia_ewma"] * (1 + self.penalidade_erro * registro["erro_ewma"])
+
+    def ordenar(self, model_id: str, providers: list[str]) -> list[str]:
+        """
+        Providers do mais ao menos indicado: circuitos fechados pela nota
+        (latência penalizada pelo erro), o sugerido pela tabela estática
+        desempatando os que ainda não têm medição; circuitos abertos por último.
+        """
+        agora = time.time()
+        sugerido = sugerir_provider_hf(model_id)
+
+        with self._lock:
+            self._visto_em.setdefault(model_id, agora)
+            registros = {p: self._registro(model_id, p) for p in providers}
+
+            def _chave(provider: str):
+                registro = registros[provider]
+                return (
+                    registro["aberto_ate"] > agora,
+                    self._nota(registro),
+                    provider != sugerido,
+                    registro["aberto_ate"],
+                )
+
+            return sorted(providers, key=_chave)
+
+    def escolher(self, model_id: str, providers: list[str]) -> str:
+        """
+        Provider para a próxima chamada. Em geral o melhor de ordenar(); mas
+        um circuito que terminou o tempo aberto, ou um provider saudável sem
+        uso há ROTEADOR_INTERVALO_SONDA, recebe esta chamada como sondagem.
+        """
+        ordem = self.ordenar(model_id, providers)
+        agora = time.time()
+
+        with self._lock:
+            melhor = self._estado[(model_id, ordem[0])]
+
+            # Só sonda quando já existe um provider conhecido para comparar
+            if melhor["latencia_ewma"] is not None:
+                for provider in ordem[1:]:
+                    registro = self._estado[(model_id, provider)]
+                    meio_aberto = 0 < registro["aberto_ate"] <= agora
+                    ocioso = registro["aberto_ate"] == 0 and agora - registro["ultimo_uso"] >= self.intervalo_sonda
+
+                    if meio_aberto or ocioso:
+                        # Uma sondagem por vez: até o resultado chegar, o provider não é sondado de novo
+                        registro["ultimo_uso"] = agora
+                        if meio_aberto:
+                            registro["aberto_ate"] = agora + self.tempo_aberto
+                        registro["sondas"] += 1
+                        return provider
+
+            return ordem[0]
+
+    def registrar(self, model_id: str, provider: str, segundos: float, sucesso: bool):
+        with self._lock:
+            registro = self._registro(model_id, provider)
+            registro["chamadas"] += 1
+            registro["ultimo_uso"] = time.time()
+            registro["erro_ewma"] = self.alfa * (0.0 if sucesso else 1.0) + (1 - self.alfa) * registro["erro_ewma"]
+
+            if sucesso:
+                anterior = registro["latencia_ewma"]
+                registro["latencia_ewma"] = (
+                    segundos if anterior is None else self.alfa * segundos + (1 - self.alfa) * anterior
+                )
+                registro["falhas_seguidas"] = 0
+                registro["aberto_ate"] = 0.0
+                return
+
+            registro["falhas"] += 1
+            registro["falhas_seguidas"] += 1
+
+            if registro["falhas_seguidas"] >= self.falhas_para_abrir:
+                registro["aberto_ate"] = time.time() + self.tempo_aberto
+
+    def abrir_circuito(self, model_id: str, provider: str, ate: float):
+        """
+        Abre o circuito até o instante dado, sem esperar as falhas seguidas:
+        usado quando já se sabe que o provider não tem como atender.
+        """
+        with self._lock:
+            registro = self._registro(model_id, provider)
+            registro["aberto_ate"] = max(registro["aberto_ate"], ate)
+
+    def estatisticas(self) -> list[dict]:
+        agora = time.time()
+
+        with self._lock:
+            linhas = []
+
+            for (model_id, provider), registro in sorted(self._estado.items()):
+                if registro["aberto_ate"] > agora:
+                    circuito = "aberto"
+                elif registro["aberto_ate"]:
+                    circuito = "meio-aberto"
+                else:
+                    circuito = "fechado"
+
+                linhas.append({
+                    "modelo": model_id,
+                    "provider": provider,
+                    "circuito": circuito,
+                    "latencia_ewma_s": None if registro["latencia_ewma"] is None else round(registro["latencia_ewma"], 2),
+                    "erro_ewma": round(registro["erro_ewma"], 3),
+                    "chamadas": registro["chamadas"],
+                    "falhas": registro["falhas"],
+                    "sondas": registro["sondas"],
+                })
+
+            return linhas
+
+
+@recurso_compartilhado
+def obter_roteador_providers_hf() -> RoteadorProvidersHF:
+    return RoteadorProvidersHF(
+        alfa=ROTEADOR_ALFA_EWMA,
+        penalidade_erro=ROTEADOR_PENALIDADE_ERRO,
+        falhas_para_abrir=ROTEADOR_FALHAS_PARA_ABRIR,
+        tempo_aberto=ROTEADOR_TEMPO_ABERTO,
+        intervalo_sonda=ROTEADOR_INTERVALO_SONDA,
+    )
+
+
+# =========================
+# CHAMADA HUGGING FACE — INFERENCECLIENT
+# =========================
+
+class MemoriaMetodosHF:
+    """
+    Lembra, por (modelo, provider), qual forma de chamar image_to_image
+    funcionou, e guarda falhas por um tempo para não repetir tentativas
+    que já se sabe que falham. Persistida em JSON no disco.
+    """
+
+    def __init__(self, arquivo: Path, ttl_falha_segundos: int):
+        self.arquivo = Path(arquivo)
+        self.ttl_falha_segundos = ttl_falha_segundos
+        self._lock = threading.Lock()
+        self._dados = {}
+
+        try:
+            self._dados = json.loads(self.arquivo.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self._dados = {}
+
+    @staticmethod
+    def _chave(model_id: str, provider: str) -> str:
+        return f"{model_id}|{provider}"
+
+    def ordenar_metodos(self, model_id: str, provider: str, metodos: list[str]) -> list[str]:
+        """
+        Retorna os métodos a tentar: o último que funcionou primeiro,
+        sem os que falharam dentro do TTL.
+        """
+        with self._lock:
+            registro = self._dados.get(self._chave(model_id, provider), {})
+            falhas = registro.get("falhas", {})
+            agora = time.time()
+
+            candidatos = [m for m in metodos if falhas.get(m, 0) <= agora]
+            sucesso = registro.get("sucesso")
+
+            if sucesso in candidatos:
+                candidatos.remove(sucesso)
+                candidatos.insert(0, sucesso)
+
+            return candidatos
+
+    def liberado_em(self, model_id: str, provider: str, metodos: list[str]) -> float:
+        """
+        Instante em que o primeiro dos métodos volta a poder ser tentado.
+        """
+        with self._lock:
+            falhas = self._dados.get(self._chave(model_id, provider), {}).get("falhas", {})
+            return min(falhas.get(m, 0) for m in metodos)
+
+    def registrar_sucesso(self, model_id: str, provider: str, metodo: str):
+        with self._lock:
+            registro = self._dados.setdefault(self._chave(model_id, provider), {})
+            registro["sucesso"] = metodo
+            registro.setdefault("falhas", {}).pop(metodo, None)
+            self._persistir()
+
+    def registrar_falha(self, model_id: str, provider: str, metodo: str):
+        with self._lock:
+            registro = self._dados.setdefault(self._chave(model_id, provider), {})
+            registro.setdefault("falhas", {})[metodo] = time.time() + self.ttl_falha_segundos
+
+            if registro.get("sucesso") == metodo:
+                registro.pop("sucesso")
+
+            self._persistir()
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            return json.loads(json.dumps(self._dados))
+
+    def _persistir(self):
+        try:
+            self.arquivo.parent.mkdir(parents=True, exist_ok=True)
+            temporario = self.arquivo.with_suffix(".tmp")
+            temporario.write_text(json.dumps(self._dados, indent=2), encoding="utf-8")
+            os.replace(temporario, self.arquivo)
+        except OSError:
+            pass
+
+
+@recurso_compartilhado
+def obter_memoria_metodos_hf() -> MemoriaMetodosHF:
+    return MemoriaMetodosHF(METODOS_HF_ARQUIVO, METODOS_HF_TTL_FALHA)
+
+
+# Respostas de quem não entendeu os argumentos da chamada (e não de um provider instável)
+STATUS_ERRO_CONVENCAO_HF = (400, 404, 422)
+
+
+def erro_de_convencao_hf(erro: Exception) -> bool:
+    """
+    Indica se o erro vem da forma de chamar (argumento inesperado, rota
+    ou payload recusados) e, portanto, deve bloquear o método na memória.
+    Erros 5xx, timeouts e falhas de conexão não dizem nada sobre o método.
+    """
+    if isinstance(erro, TypeError):
+        return True
+
+    resposta = getattr(erro, "response", None)
+    return getattr(resposta, "status_code", None) in STATUS_ERRO_CONVENCAO_HF
+
+
+def gerar_imagem_huggingface_img2img(
+    imagem_pil: Image.Image,
+    prompt: str,
+    negative_prompt: str,
+    model_id: str,
+    provider: str = "replicate",
+    strength: float = 0.55,
+    guidance_scale: float = 7.5,
+    preservar_fundo: bool = True,
+):
+    """
+    Chama Hugging Face Inference Providers via huggingface_hub.InferenceClient.
+    Tenta input posicional e depois image=..., começando pela forma que já
+    funcionou para este modelo/provider e pulando as que falharam há pouco.
+    Só erros de convenção bloqueiam um método; erros passageiros (5xx,
+    timeout, conexão) encerram a chamada sem marcar o método.
+    Respostas 429 não contam como falha do método: a chamada espera o
+    limite de taxa do provider e é repetida.
+    """
+    if not HF_TOKEN:
+        raise RuntimeError("HF_TOKEN ou HUGGINGFACE_API_KEY não configurado (st.secrets ou variável de ambiente).")
+
+    prompt_final = montar_prompt_final(
+        prompt=prompt,
+        negative_prompt=negative_prompt,
+        preservar_fundo=preservar_fundo,
+    )
+
+    tags = {"provedor": "huggingface", "modelo": model_id, "hf_provider": provider}
+
+    with medir("codificacao_entrada", **tags) as tags_estagio:
+        arquivo_entrada, mime_entrada, info_entrada = preparar_imagem_entrada(
+            imagem_pil,
+            destino=provider,
+            model=model_id,
+        )
+        tags_estagio["bytes"] = info_entrada["bytes_enviados"]
+
+        # O hf-inference (usado também com HF_ENDPOINT_URL) recebe os bytes como
+        # corpo. Os outros providers embutem a imagem num data URL que, a partir
+        # de bytes, o InferenceClient marca sempre como image/jpeg: fora do JPEG
+        # o data URL já vai pronto, com o tipo certo.
+        entrada = arquivo_entrada.getvalue()
+        if not HF_ENDPOINT_URL and provider != "hf-inference" and mime_entrada != "image/jpeg":
+            entrada = bytes_to_data_url(entrada, mime_entrada)
+            info_entrada["bytes_data_url"] = len(entrada)
+
+    client = obter_registro_clientes_hf().obter(provider, HF_TOKEN)
+    memoria = obter_memoria_metodos_hf()
+
+    modelo_chamada = HF_ENDPOINT_URL or model_id
+
+    tentativas = {
+        # Tentativa 1 — igual aos exemplos oficiais
+        "positional_input_image": lambda: client.image_to_image(
+            entrada,
+            prompt=prompt_final,
+            model=modelo_chamada,
+        ),
+        # Tentativa 2 — keyword image=...
+        "keyword_image": lambda: client.image_to_image(
+            image=entrada,
+            prompt=prompt_final,
+            model=modelo_chamada,
+        ),
+    }
+
+    metodos = memoria.ordenar_metodos(model_id, provider, list(tentativas))
+    roteador = obter_roteador_providers_hf()
+
+    if not metodos:
+        # O roteador deixa de escolher este provider enquanto a memória o bloquear
+        roteador.registrar(model_id, provider, 0.0, sucesso=False)
+        roteador.abrir_circuito(model_id, provider, memoria.liberado_em(model_id, provider, list(tentativas)))
+
+        raise RuntimeError(
+            "Todas as formas de chamada falharam recentemente para esta combinação.\n\n"
+            f"Provider: {provider}\n"
+            f"Modelo: {model_id}\n\n"
+            "Tente outro provider ou aguarde alguns minutos."
+        )
+
+    limitador = obter_limitador_taxa()
+    erros = []
+    # Só o tempo das chamadas ao provider; a espera do limite de taxa não entra na latência do roteador
+    duracao = 0.0
+
+    for metodo in metodos:
+        def _chamar(metodo=metodo):
+            nonlocal duracao
+            inicio = time.perf_counter()
+
+            try:
+                # Inclui upload, processamento no provider e decodificação feita pelo InferenceClient
+                with medir("chamada_hf", metodo=metodo, bytes=info_entrada["bytes_enviados"], **tags):
+                    return tentativas[metodo]()
+            except Exception as e:
+                resposta = getattr(e, "response", None)
+
+                if getattr(resposta, "status_code", None) == 429:
+                    raise ErroLimiteTaxa(
+                        f"Limite de taxa do provider {provider} atingido (429) para {model_id}.",
+                        espera=espera_dos_cabecalhos(resposta.headers),
+                        corpo=getattr(resposta, "text", ""),
+                    ) from e
+
+                raise
+            finally:
+                duracao += time.perf_counter() - inicio
+
+        try:
+            image = limitador.chamar(provider, HF_TOKEN, _chamar, **tags)
+
+            if isinstance(image, Image.Image):
+                memoria.registrar_sucesso(model_id, provider, metodo)
+                roteador.registrar(model_id, provider, duracao, sucesso=True)
+
+                return [ImagemGerada.de_pil(image)], {
+                    "provider": "huggingface",
+                    "hf_provider": provider,
+                    "model": model_id,
+                    "method": metodo,
+                    "strength": strength,
+                    "guidance_scale": guidance_scale,
+                    "entrada": info_entrada,
+                }
+
+            erros.append(f"Tentativa {metodo} retornou tipo inesperado: {type(image)}")
+
+        except ErroLimiteTaxa:
+            # O método não falhou; o provider está saturado para esta chave
+            roteador.registrar(model_id, provider, duracao, sucesso=False)
+            raise
+
+        except Exception as e:
+            erros.append(f"Tentativa {metodo} falhou: {repr(e)}")
+
+            if not erro_de_convencao_hf(e):
+                # Falha passageira do provider: outra forma de chamar não ajudaria
+                break
+
+        memoria.registrar_falha(model_id, provider, metodo)
+
+    roteador.registrar(model_id, provider, duracao, sucesso=False)
+
+    raise RuntimeError(
+        "Falha ao chamar Hugging Face InferenceClient.\n\n"
+        f"Provider: {provider}\n"
+        f"Modelo: {model_id}\n\n"
+        "Erros:\n- " + "\n- ".join(erros)
+    )
+
+
+# =========================
+# MOTOR LOCAL — COMIC NA CPU
+# =========================
+
+def estilo_local_do_prompt(prompt: str) -> dict:
+    """
+    Traduz o prompt nos parâmetros do motor local, seguindo os mesmos pedidos
+    do PROMPT_COMIC_PADRAO: traço de nanquim, cel shading, halftone e cores vivas.
+    Pedidos ausentes do prompt desligam o efeito correspondente.
+    """
+    texto = prompt.lower()
+
+    return {
+        "linhas": "ink" in texto or "line" in texto or "contour" in texto,
+        "linhas_grossas": "bold" in texto or "thick" in texto,
+        "cel_shading": "cel" in texto or "shading" in texto or "shadow" in texto,
+        "halftone": "halftone" in texto or "ben-day" in texto,
+        "cores_vivas": "vibrant" in texto or "vivid" in texto or "saturated" in texto,
+    }
+
+
+def _luminancia(pixels: np.ndarray) -> np.ndarray:
+    return pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def renderizar_comic_local(
+    imagem_pil: Image.Image,
+    estilo: dict,
+    cores: int = 12,
+    bandas_sombra: int = 4,
+    lado_maximo: int | None = None,
+) -> Image.Image:
+    """
+    Aproximação de comic book feita só com operações vetorizadas (PIL + NumPy):
+    suavização, quantização de cores, bandas de cel shading pela luminância,
+    retícula halftone rotacionada nas sombras e linhas de contorno por Sobel.
+    """
+    imagem = imagem_pil.convert("RGB")
+
+    if lado_maximo and max(imagem.size) > lado_maximo:
+        imagem = imagem.copy()
+        imagem.thumbnail((lado_maximo, lado_maximo), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    # Só desfoque gaussiano: o filtro de mediana custaria mais que todo o resto junto
+    suavizada = imagem.filter(ImageFilter.GaussianBlur(1.2))
+
+    if estilo["cores_vivas"]:
+        suavizada = ImageEnhance.Color(suavizada).enhance(1.3)
+
+    # Cores chapadas: paleta reduzida pelo median cut do Pillow (em C)
+    chapada = suavizada.quantize(colors=cores, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    pixels = np.asarray(chapada.convert("RGB"), dtype=np.float32)
+    luminancia = _luminancia(np.asarray(suavizada, dtype=np.float32)) / 255.0
+
+    if estilo["cel_shading"]:
+        # Luz em degraus: cada banda de luminância recebe um fator fixo de sombra
+        banda = np.minimum((luminancia * bandas_sombra).astype(np.int32), bandas_sombra - 1)
+        fatores = np.linspace(0.6, 1.08, bandas_sombra, dtype=np.float32)
+        pixels *= fatores[banda][..., None]
+
+    if estilo["halftone"]:
+        # Pontos numa grade a 45°, com raio crescendo conforme a sombra
+        altura, largura = luminancia.shape
+        celula = max(4.0, max(altura, largura) / 180)
+        y, x = np.ogrid[:altura, :largura]
+        u = ((x + y) * 0.70710678) % celula - celula / 2
+        v = ((x - y) * 0.70710678) % celula - celula / 2
+        raio = (1.0 - luminancia) * celula * 0.55
+        pontos = (u * u + v * v) < raio * raio
+        sombra = luminancia < 0.55
+        pixels[pontos & sombra] *= 0.72
+
+    if estilo["linhas"]:
+        # Sobel na luminância suavizada; o limiar vem de um percentil para se adaptar à foto
+        l = np.pad(luminancia, 1, mode="edge")
+        gx = (l[:-2, 2:] + 2 * l[1:-1, 2:] + l[2:, 2:]) - (l[:-2, :-2] + 2 * l[1:-1, :-2] + l[2:, :-2])
+        gy = (l[2:, :-2] + 2 * l[2:, 1:-1] + l[2:, 2:]) - (l[:-2, :-2] + 2 * l[:-2, 1:-1] + l[:-2, 2:])
+        magnitude = np.hypot(gx, gy)
+        bordas = magnitude > max(np.percentile(magnitude, 90), 0.15)
+
+        mascara = Image.fromarray((bordas * 255).astype(np.uint8), "L")
+        if estilo["linhas_grossas"]:
+            mascara = mascara.filter(ImageFilter.MaxFilter(3))
+
+        pixels[np.asarray(mascara) > 0] = (18, 16, 22)
+
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+
+
+def gerar_imagem_local_comic(
+    imagem_pil: Image.Image,
+    prompt: str,
+    negative_prompt: str,
+    preservar_fundo: bool = True,
+    cores: int = 12,
+):
+    """
+    Gerador local, sem rede nem chave: mesma assinatura de retorno dos
+    provedores remotos, (imagens, bruto). Sem preservar o fundo, usa menos
+    cores para simplificar a cena.
+    """
+    estilo = estilo_local_do_prompt(prompt)
+    cores = cores if preservar_fundo else max(4, cores // 2)
+
+    with medir("render_local", provedor="local", modelo=MODELO_LOCAL) as tags:
+        imagem = renderizar_comic_local(imagem_pil, estilo, cores=cores, lado_maximo=LOCAL_LADO_MAXIMO)
+        tags["tamanho"] = f"{imagem.width}x{imagem.height}"
+
+    return [ImagemGerada.de_pil(imagem)], {
+        "provider": "local",
+        "model": MODELO_LOCAL,
+        "estilo": estilo,
+        "cores": cores,
+    }
+
+
+# =========================
+# CACHE DE RESULTADOS — MEMÓRIA + DISCO
+# =========================
+
+def hash_imagem(imagem_pil: Image.Image) -> str:
+    """
+    Hash dos pixels (com modo e dimensões) da imagem de entrada.
+    """
+    h = hashlib.sha256()
+    h.update(f"{imagem_pil.mode}:{imagem_pil.width}x{imagem_pil.height}".encode("utf-8"))
+    h.update(imagem_pil.tobytes())
+    return h.hexdigest()
+
+
+def calcular_chave_cache(
+    imagem_pil: Image.Image,
+    prompt_final: str,
+    parametros: dict,
+    hash_entrada: str | None = None,
+) -> str:
+    """
+    Calcula a chave do cache: hash dos pixels da imagem de entrada,
+    do prompt final e de todos os parâmetros de geração. hash_entrada é o
+    hash_imagem já calculado, para não percorrer os pixels de novo.
+    """
+    h = hashlib.sha256()
+    h.update((hash_entrada or hash_imagem(imagem_pil)).encode("utf-8"))
+    h.update(prompt_final.encode("utf-8"))
+    h.update(json.dumps(parametros, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+class CacheResultados:
+    """
+    Cache LRU de resultados em dois níveis (memória e disco), com limite de
+    itens em memória, limite de bytes em disco e idade máxima.
+    """
+
+    def __init__(self, diretorio: Path, max_itens_memoria: int, max_bytes_disco: int, ttl_segundos: int):
+        self.diretorio = Path(diretorio)
+        self.max_itens_memoria = max_itens_memoria
+        self.max_bytes_disco = max_bytes_disco
+        self.ttl_segundos = ttl_segundos
+
+        self._memoria = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits_memoria = 0
+        self.hits_disco = 0
+        self.misses = 0
+
+        self.diretorio.mkdir(parents=True, exist_ok=True)
+
+    def _expirado(self, criado_em: float) -> bool:
+        return time.time() - criado_em > self.ttl_segundos
+
+    def obter(self, chave: str):
+        """
+        Retorna (imagens, bruto) ou None se a chave não estiver no cache.
+        """
+        with self._lock:
+            item = self._memoria.get(chave)
+
+            if item is not None:
+                criado_em, imagens, bruto = item
+
+                if not self._expirado(criado_em):
+                    self._memoria.move_to_end(chave)
+                    self.hits_memoria += 1
+                    return list(imagens), bruto
+
+                del self._memoria[chave]
+
+            pasta = self.diretorio / chave
+            meta_path = pasta / "meta.json"
+
+            if not meta_path.exists():
+                self.misses += 1
+                return None
+
+            try:
+                meta = json.loads(meta_path.read_text(encoding="utf-8"))
+
+                if self._expirado(meta["criado_em"]):
+                    shutil.rmtree(pasta, ignore_errors=True)
+                    self.misses += 1
+                    return None
+
+                imagens = [
+                    ImagemGerada(dados=(pasta / item["arquivo"]).read_bytes(), mime=item["mime"])
+                    for item in meta["imagens"]
+                ]
+
+                bruto = meta.get("bruto")
+
+            except Exception:
+                shutil.rmtree(pasta, ignore_errors=True)
+                self.misses += 1
+                return None
+
+            # Atualiza o mtime para a ordem LRU do disco
+            os.utime(meta_path)
+
+            self._guardar_memoria(chave, meta["criado_em"], imagens, bruto)
+            self.hits_disco += 1
+            return list(imagens), bruto
+
+    def salvar(self, chave: str, imagens: list[ImagemGerada], bruto):
+        """
+        Salva o resultado em memória e em disco.
+        """
+        if not imagens:
+            return
+
+        # As imagens já ficam em arquivos próprios; o base64 não precisa ir junto
+        bruto = compactar_bruto(bruto)
+        criado_em = time.time()
+
+        with self._lock:
+            self._guardar_memoria(chave, criado_em, list(imagens), bruto)
+
+            pasta = self.diretorio / chave
+            temporaria = self.diretorio / f".{chave}.{threading.get_ident()}.tmp"
+            shutil.rmtree(temporaria, ignore_errors=True)
+            temporaria.mkdir(parents=True)
+
+            try:
+                itens = []
+                for idx, img in enumerate(imagens, start=1):
+                    nome = f"resultado_{idx}{img.extensao}"
+                    (temporaria / nome).write_bytes(img.dados)
+                    itens.append({"arquivo": nome, "mime": img.mime})
+
+                meta = {
+                    "criado_em": criado_em,
+                    "imagens": itens,
+                    "bruto": bruto,
+                }
+                (temporaria / "meta.json").write_text(
+                    json.dumps(meta, default=str),
+                    encoding="utf-8",
+                )
+
+                shutil.rmtree(pasta, ignore_errors=True)
+                os.replace(temporaria, pasta)
+
+            except Exception:
+                shutil.rmtree(temporaria, ignore_errors=True)
+                raise
+
+            self._aplicar_limite_disco()
+
+    def limpar(self):
+        with self._lock:
+            self._memoria.clear()
+            shutil.rmtree(self.diretorio, ignore_errors=True)
+            self.diretorio.mkdir(parents=True, exist_ok=True)
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            return {
+                "itens_memoria": len(self._memoria),
+                "bytes_disco": sum(tam for _, tam, _ in self._entradas_disco()),
+                "hits_memoria": self.hits_memoria,
+                "hits_disco": self.hits_disco,
+                "misses": self.misses,
+            }
+
+    def _guardar_memoria(self, chave: str, criado_em: float, imagens: list[ImagemGerada], bruto):
+        self._memoria[chave] = (criado_em, imagens, bruto)
+        self._memoria.move_to_end(chave)
+
+        while len(self._memoria) > self.max_itens_memoria:
+            self._memoria.popitem(last=False)
+
+    def _entradas_disco(self):
+        """
+        Lista (mtime, bytes, pasta) de cada entrada válida no disco.
+        """
+        entradas = []
+
+        for pasta in self.diretorio.iterdir():
+            meta_path = pasta / "meta.json"
+
+            if pasta.name.startswith(".") or not meta_path.exists():
+                continue
+
+            try:
+                tamanho = sum(f.stat().st_size for f in pasta.iterdir())
+                entradas.append((meta_path.stat().st_mtime, tamanho, pasta))
+            except OSError:
+                continue
+
+        return entradas
+
+    def _aplicar_limite_disco(self):
+        entradas = sorted(self._entradas_disco(), key=lambda e: e[0])
+        total = sum(tam for _, tam, _ in entradas)
+
+        for mtime, tamanho, pasta in entradas:
+            if total <= self.max_bytes_disco and time.time() - mtime <= self.ttl_segundos:
+                continue
+
+            shutil.rmtree(pasta, ignore_errors=True)
+            self._memoria.pop(pasta.name, None)
+            total -= tamanho
+
+
+@recurso_compartilhado
+def obter_cache_resultados() -> CacheResultados:
+    """
+    Cache compartilhado entre sessões e reruns do Streamlit.
+    """
+    return CacheResultados(
+        diretorio=CACHE_DIR,
+        max_itens_memoria=CACHE_MAX_ITENS_MEMORIA,
+        max_bytes_disco=CACHE_MAX_BYTES_DISCO,
+        ttl_segundos=CACHE_TTL_SEGUNDOS,
+    )
+
+
+# =========================
+# ÍNDICE DE IMAGENS PARECIDAS
+# =========================
+
+def hash_perceptual(imagem: Image.Image) -> int:
+    """
+    dHash de 64 bits: compara o brilho de pixels vizinhos numa miniatura 9x8.
+    Recompressão, pequenos ruídos e mudanças de tamanho quase não mudam o hash.
+    """
+    miniatura = np.asarray(imagem.convert("L").resize((9, 8), Image.Resampling.BOX), dtype=np.int16)
+    bits = np.packbits(miniatura[:, 1:] > miniatura[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def distancia_hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class _NoBK:
+    __slots__ = ("hash", "valores", "filhos")
+
+    def __init__(self, h: int, valor: str):
+        self.hash = h
+        self.valores = [valor]
+        self.filhos = {}
+
+
+class ArvoreBK:
+    """
+    BK-tree sobre a distância de Hamming: busca por raio sem comparar com
+    todos os hashes, usando a desigualdade triangular para podar ramos.
+    """
+
+    def __init__(self):
+        self._raiz = None
+        self.tamanho = 0
+
+    def inserir(self, h: int, valor: str):
+        self.tamanho += 1
+
+        if self._raiz is None:
+            self._raiz = _NoBK(h, valor)
+            return
+
+        no = self._raiz
+
+        while True:
+            distancia = distancia_hamming(h, no.hash)
+
+            if distancia == 0:
+                if valor not in no.valores:
+                    no.valores.append(valor)
+                return
+
+            filho = no.filhos.get(distancia)
+            if filho is None:
+                no.filhos[distancia] = _NoBK(h, valor)
+                return
+
+            no = filho
+
+    def buscar(self, h: int, raio: int) -> list[tuple[int, str]]:
+        """
+        Valores a até `raio` bits de h, do mais próximo ao mais distante.
+        """
+        encontrados = []
+        pendentes = [self._raiz] if self._raiz is not None else []
+
+        while pendentes:
+            no = pendentes.pop()
+            distancia = distancia_hamming(h, no.hash)
+
+            if distancia <= raio:
+                encontrados.extend((distancia, valor) for valor in no.valores)
+
+            for distancia_filho, filho in no.filhos.items():
+                if distancia - raio <= distancia_filho <= distancia + raio:
+                    pendentes.append(filho)
+
+        return sorted(encontrados)
+
+
+class IndiceSimilares:
+    """
+    Hashes perceptuais das entradas já transformadas, separados por contexto
+    (mesmo gerador, prompt final, parâmetros e escopo) e apontando para
+    chaves do cache de resultados. Persistido como JSONL só com inserções;
+    guarda no máximo max_entradas (as mais antigas saem primeiro), esquece
+    chaves que sumiram do cache e reescreve o arquivo quando ele acumula
+    linhas que não valem mais. Entradas de um escopo (a sessão) ficam só na
+    memória: o escopo não volta depois de reiniciar o processo.
+    """
+
+    def __init__(self, arquivo: Path, max_entradas: int):
+        self.arquivo = Path(arquivo)
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()
+        self._arvores = {}
+        self._removidas = set()
+        self._so_memoria = set()
+        self._linhas_arquivo = 0
+        self._lock = threading.Lock()
+        self.consultas = 0
+        self.encontrados = 0
+
+        try:
+            with self.arquivo.open(encoding="utf-8") as f:
+                for linha in f:
+                    self._linhas_arquivo += 1
+
+                    try:
+                        item = json.loads(linha)
+                        entrada = (item["contexto"], item["chave"])
+                        self._entradas.pop(entrada, None)
+                        self._entradas[entrada] = int(item["hash"], 16)
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except OSError:
+            pass
+
+        while len(self._entradas) > self.max_entradas:
+            self._entradas.popitem(last=False)
+
+        self._reconstruir()
+
+        if self._linhas_arquivo > len(self._entradas):
+            self._compactar()
+
+    def _reconstruir(self):
+        self._arvores = {}
+        self._removidas = set()
+
+        for (contexto, chave), h in self._entradas.items():
+            self._arvores.setdefault(contexto, ArvoreBK()).inserir(h, chave)
+
+    def _compactar(self):
+        """
+        Reescreve o JSONL só com as entradas vivas que são persistidas.
+        """
+        try:
+            self.arquivo.parent.mkdir(parents=True, exist_ok=True)
+            temporario = self.arquivo.with_suffix(".tmp")
+            linhas = 0
+
+            with temporario.open("w", encoding="utf-8") as f:
+                for (contexto, chave), h in self._entradas.items():
+                    if (contexto, chave) not in self._so_memoria:
+                        f.write(json.dumps({"contexto": contexto, "hash": f"{h:016x}", "chave": chave}) + "\n")
+                        linhas += 1
+
+            os.replace(temporario, self.arquivo)
+            self._linhas_arquivo = linhas
+        except OSError:
+            pass
+
+    def _descartar(self, contexto: str, chave: str):
+        if self._entradas.pop((contexto, chave), None) is not None:
+            self._removidas.add((contexto, chave))
+            self._so_memoria.discard((contexto, chave))
+
+    def _arrumar(self):
+        """
+        Aplica o limite de entradas e, quando o arquivo tem mais que o dobro
+        de linhas vivas, compacta o arquivo e reconstrói as árvores.
+        """
+        while len(self._entradas) > self.max_entradas:
+            (contexto, chave), _ = self._entradas.popitem(last=False)
+            self._removidas.add((contexto, chave))
+            self._so_memoria.discard((contexto, chave))
+
+        if self._linhas_arquivo > 2 * (len(self._entradas) - len(self._so_memoria)) + 100:
+            self._compactar()
+            self._reconstruir()
+
+    def adicionar(self, contexto: str, h: int, chave: str, persistir: bool = True):
+        """
+        Indexa a entrada; com persistir=False ela não vai para o arquivo.
+        """
+        with self._lock:
+            self._entradas.pop((contexto, chave), None)
+            self._entradas[(contexto, chave)] = h
+            self._removidas.discard((contexto, chave))
+            self._arvores.setdefault(contexto, ArvoreBK()).inserir(h, chave)
+
+            if not persistir:
+                self._so_memoria.add((contexto, chave))
+            else:
+                self._so_memoria.discard((contexto, chave))
+
+                try:
+                    self.arquivo.parent.mkdir(parents=True, exist_ok=True)
+                    with self.arquivo.open("a", encoding="utf-8") as f:
+                        f.write(json.dumps({"contexto": contexto, "hash": f"{h:016x}", "chave": chave}) + "\n")
+                    self._linhas_arquivo += 1
+                except OSError:
+                    pass
+
+            self._arrumar()
+
+    def remover(self, contexto: str, chave: str):
+        """
+        Esquece uma chave que não está mais no cache (expirada ou despejada).
+        """
+        with self._lock:
+            self._descartar(contexto, chave)
+            self._arrumar()
+
+    def buscar(self, contexto: str, h: int, distancia_max: int) -> list[tuple[int, str]]:
+        with self._lock:
+            self.consultas += 1
+            arvore = self._arvores.get(contexto)
+
+            if arvore is None:
+                return []
+
+            return [
+                (distancia, chave)
+                for distancia, chave in arvore.buscar(h, distancia_max)
+                if (contexto, chave) not in self._removidas
+            ]
+
+    def marcar_reaproveitado(self):
+        with self._lock:
+            self.encontrados += 1
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            return {
+                "contextos": len({contexto for contexto, _ in self._entradas}),
+                "entradas": len(self._entradas),
+                "so_memoria": len(self._so_memoria),
+                "linhas_arquivo": self._linhas_arquivo,
+                "consultas": self.consultas,
+                "reaproveitados": self.encontrados,
+                "arquivo": str(self.arquivo),
+            }
+
+
+@recurso_compartilhado
+def obter_indice_similares() -> IndiceSimilares:
+    return IndiceSimilares(SIMILARES_ARQUIVO, SIMILARES_MAX_ENTRADAS)
+
+
+def calcular_contexto_similar(prompt_final: str, parametros: dict, escopo: str | None = None) -> str:
+    """
+    Tudo o que define o resultado além dos pixels, mais o escopo (sessão ou
+    usuário): só entradas com o mesmo contexto podem reaproveitar o resultado
+    umas das outras, e nunca o de outra sessão.
+    """
+    h = hashlib.sha256()
+    h.update((escopo or "").encode("utf-8"))
+    h.update(prompt_final.encode("utf-8"))
+    h.update(json.dumps(parametros, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+# Não mudam o resultado (ou já entram via prompt final)
+PARAMETROS_FORA_DA_CHAVE = {"prompt", "negative_prompt", "stream", "ao_progresso", "ao_tile_concluido"}
+
+
+# =========================
+# GERAÇÕES EM ANDAMENTO (SINGLE-FLIGHT)
+# =========================
+
+class GeracoesEmAndamento:
+    """
+    Gerações em andamento por chave do cache, compartilhadas por todas as
+    sessões: um pedido idêntico a um que já está no provedor não faz outra
+    chamada, espera a primeira e recebe o mesmo resultado. Vale só enquanto
+    a chamada dura; depois disso o resultado é servido pelo cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futuros = {}
+        self.chamadas = 0
+        self.agregadas = 0
+
+    def executar(self, chave: str, funcao):
+        """
+        Executa funcao() se não houver chamada igual em andamento; senão
+        espera a que está em andamento. Retorna (resultado, agregado).
+        """
+        while True:
+            with self._lock:
+                futuro = self._futuros.get(chave)
+                lider = futuro is None
+
+                if lider:
+                    futuro = Future()
+                    self._futuros[chave] = futuro
+                    self.chamadas += 1
+                else:
+                    self.agregadas += 1
+
+            if lider:
+                try:
+                    resultado = funcao()
+                except BaseException as e:
+                    futuro.set_exception(e)
+                    raise
+                else:
+                    futuro.set_result(resultado)
+                    return resultado, False
+                finally:
+                    with self._lock:
+                        del self._futuros[chave]
+
+            try:
+                return futuro.result(), True
+            except JobCancelado:
+                # O job que estava chamando foi cancelado; este pedido continua sozinho
+                continue
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            return {
+                "em_andamento": len(self._futuros),
+                "chamadas": self.chamadas,
+                "agregadas": self.agregadas,
+            }
+
+
+@recurso_compartilhado
+def obter_geracoes_em_andamento() -> GeracoesEmAndamento:
+    return GeracoesEmAndamento()
+
+
+def _identificar_geracao(
+    funcao_geradora,
+    imagem_pil: Image.Image,
+    kwargs: dict,
+    escopo_similar: str | None,
+    hash_entrada: str | None = None,
+) -> tuple[str, str]:
+    """
+    (chave do cache, contexto do índice de parecidas) de um pedido de geração.
+    """
+    prompt_final = montar_prompt_final(
+        kwargs["prompt"],
+        kwargs["negative_prompt"],
+        kwargs.get("preservar_fundo", True),
+    )
+
+    parametros = {"funcao": funcao_geradora.__name__}
+    parametros.update(
+        {
+            k: (v.__name__ if callable(v) else v)
+            for k, v in kwargs.items()
+            if k not in PARAMETROS_FORA_DA_CHAVE
+        }
+    )
+
+    return (
+        calcular_chave_cache(imagem_pil, prompt_final, parametros, hash_entrada),
+        calcular_contexto_similar(prompt_final, parametros, escopo_similar),
+    )
+
+
+def _buscar_pronto(cache: CacheResultados, chave: str, contexto: str, imagem_pil: Image.Image, distancia_similar: int | None):
+    """
+    (imagens, bruto) já disponíveis para o pedido, pela chave exata ou por
+    uma entrada parecida; None se for preciso chamar o provedor.
+    """
+    encontrado = cache.obter(chave)
+    if encontrado is not None:
+        return encontrado
+
+    if distancia_similar is None:
+        return None
+
+    indice = obter_indice_similares()
+
+    for distancia, chave_similar in indice.buscar(contexto, hash_perceptual(imagem_pil), distancia_similar):
+        encontrado = cache.obter(chave_similar)
+
+        if encontrado is None:
+            # O resultado saiu do cache; a entrada do índice não serve mais
+            indice.remover(contexto, chave_similar)
+            continue
+
+        imagens, bruto = encontrado
+        indice.marcar_reaproveitado()
+        similar = {"distancia": distancia, "chave": chave_similar}
+        bruto = {**bruto, "similar": similar} if isinstance(bruto, dict) else {"resposta": bruto, "similar": similar}
+        return imagens, bruto
+
+    return None
+
+
+def consultar_cache(
+    funcao_geradora,
+    imagem_pil: Image.Image,
+    cache: CacheResultados | None = None,
+    distancia_similar: int | None = None,
+    escopo_similar: str | None = None,
+    hash_entrada: str | None = None,
+    **kwargs,
+):
+    """
+    Só a consulta de gerar_com_cache, sem chamar o provedor:
+    (imagens, bruto) se o pedido já tem resultado, senão None.
+    """
+    chave, contexto = _identificar_geracao(funcao_geradora, imagem_pil, kwargs, escopo_similar, hash_entrada)
+    return _buscar_pronto(cache or obter_cache_resultados(), chave, contexto, imagem_pil, distancia_similar)
+
+
+def gerar_com_cache(
+    funcao_geradora,
+    imagem_pil: Image.Image,
+    cache: CacheResultados | None = None,
+    distancia_similar: int | None = None,
+    escopo_similar: str | None = None,
+    chave_limite: str | None = None,
+    ao_iniciar=None,
+    hash_entrada: str | None = None,
+    **kwargs,
+):
+    """
+    Executa o gerador (OpenRouter ou Hugging Face) passando pelo cache.
+    Com distancia_similar, uma entrada parecida (hash perceptual a até essa
+    distância, mesmo gerador, prompt, parâmetros e escopo_similar, em geral
+    a sessão) também conta como acerto; o bruto devolvido ganha "similar"
+    com a distância. Um pedido idêntico a
+    outro ainda em andamento recebe o resultado dele, com "agregado" no bruto.
+
+    Com chave_limite, só o pedido que de fato chama o provedor ocupa uma
+    vaga do limite de concorrência, e só depois do cache e das chamadas em
+    andamento; ao_iniciar() é chamado ao obter a vaga, logo antes da chamada
+    (pode levantar JobCancelado para desistir).
+    hash_entrada evita recalcular hash_imagem quando quem chama já o tem.
+    Retorna (imagens, bruto, cache_hit).
+    """
+    chave, contexto = _identificar_geracao(funcao_geradora, imagem_pil, kwargs, escopo_similar, hash_entrada)
+    if cache is None:
+        cache = obter_cache_resultados()
+
+    encontrado = _buscar_pronto(cache, chave, contexto, imagem_pil, distancia_similar)
+    if encontrado is not None:
+        imagens, bruto = encontrado
+        return imagens, bruto, True
+
+    def _gerar():
+        # Uma chamada igual pode ter terminado entre a consulta acima e agora
+        encontrado = cache.obter(chave)
+        if encontrado is not None:
+            return (*encontrado, True)
+
+        vaga = obter_limitador_concorrencia().semaforo(chave_limite) if chave_limite else nullcontext()
+
+        with vaga:
+            if ao_iniciar is not None:
+                ao_iniciar()
+
+            inicio = time.perf_counter()
+            imagens, bruto = funcao_geradora(imagem_pil=imagem_pil, **kwargs)
+            obter_metricas().registrar("total", time.perf_counter() - inicio, **tags_do_bruto(bruto))
+
+        cache.salvar(chave, imagens, bruto)
+
+        if imagens:
+            # Com escopo (sessão), a entrada não serve depois de reiniciar: fica só na memória
+            obter_indice_similares().adicionar(
+                contexto, hash_perceptual(imagem_pil), chave, persistir=escopo_similar is None
+            )
+
+        return imagens, bruto, False
+
+    (imagens, bruto, cache_hit), agregado = obter_geracoes_em_andamento().executar(chave, _gerar)
+
+    if agregado:
+        bruto = {**bruto, "agregado": True} if isinstance(bruto, dict) else {"resposta": bruto, "agregado": True}
+        return imagens, bruto, True
+
+    return imagens, bruto, cache_hit
+
+
+# =========================
+# MODO LOTE — CONCORRÊNCIA POR PROVEDOR
+# =========================
+
+class LimitadorConcorrencia:
+    """
+    Semáforos por provedor (OpenRouter e cada provider HF), compartilhados
+    por todas as sessões para que o limite valha para o processo inteiro.
+    """
+
+    def __init__(self, limites: dict, limite_padrao: int):
+        self.limites = dict(limites)
+        self.limite_padrao = limite_padrao
+        self._semaforos = {}
+        self._lock = threading.Lock()
+
+    def limite(self, chave: str) -> int:
+        return max(1, int(self.limites.get(chave, self.limite_padrao)))
+
+    def semaforo(self, chave: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if chave not in self._semaforos:
+                self._semaforos[chave] = threading.BoundedSemaphore(self.limite(chave))
+
+            return self._semaforos[chave]
+
+
+@recurso_compartilhado
+def obter_limitador_concorrencia() -> LimitadorConcorrencia:
+    return LimitadorConcorrencia(LIMITES_CONCORRENCIA, LIMITE_CONCORRENCIA_PADRAO)
+
+
+def chave_limite_provedor(provedor: str, hf_provider: str | None) -> str:
+    """
+    Chave usada para o limite de concorrência: 'openrouter', 'local' ou o provider HF.
+    """
+    if provedor == "OpenRouter":
+        return "openrouter"
+
+    if provedor == PROVEDOR_LOCAL:
+        return "local"
+
+    return hf_provider or HF_PROVIDER_INICIAL
+
+
+def processar_lote(
+    imagens_lote: list[tuple[str, Image.Image]],
+    chave_limite: str,
+    funcao_geradora,
+    **kwargs,
+):
+    """
+    Processa várias imagens em paralelo, respeitando o limite do provedor.
+    Gera (nome, imagens, bruto, cache_hit, erro) à medida que cada job termina;
+    uma imagem com erro não interrompe o restante do lote.
+    """
+    cache = obter_cache_resultados()
+
+    def _job(imagem_pil: Image.Image):
+        return gerar_com_cache(funcao_geradora, imagem_pil=imagem_pil, cache=cache, chave_limite=chave_limite, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=LOTE_MAX_WORKERS) as executor:
+        futuros = {
+            executor.submit(_job, imagem_pil): nome
+            for nome, imagem_pil in imagens_lote
+        }
+
+        for futuro in as_completed(futuros):
+            nome = futuros[futuro]
+
+            try:
+                imagens, bruto, cache_hit = futuro.result()
+                yield nome, imagens, bruto, cache_hit, None
+            except Exception as e:
+                yield nome, [], None, False, e
+
+
+# =========================
+# PROCESSAMENTO EM BLOCOS (TILES)
+# =========================
+
+def posicoes_tiles(comprimento: int, lado: int, sobreposicao: int) -> list[int]:
+    """
+    Início de cada bloco ao longo de um eixo. O último é encostado na borda,
+    de modo que todos os blocos têm o mesmo lado (quando a imagem é maior que ele).
+    """
+    if comprimento <= lado:
+        return [0]
+
+    passo = max(1, lado - sobreposicao)
+    posicoes = list(range(0, comprimento - lado, passo))
+    posicoes.append(comprimento - lado)
+    return posicoes
+
+
+def dividir_em_tiles(largura: int, altura: int, lado: int, sobreposicao: int) -> list[tuple[int, int, int, int]]:
+    """
+    Caixas (x0, y0, x1, y1) dos blocos sobrepostos que cobrem a imagem, linha a linha.
+    """
+    xs = posicoes_tiles(largura, lado, sobreposicao)
+    ys = posicoes_tiles(altura, lado, sobreposicao)
+
+    return [
+        (x, y, min(x + lado, largura), min(y + lado, altura))
+        for y in ys
+        for x in xs
+    ]
+
+
+def tamanho_saida_tile(caixa: tuple[int, int, int, int]) -> str:
+    """
+    Tamanho de saída ("LxL") pedido para um bloco: o lado quadrado suportado
+    mais próximo do maior lado do bloco (no empate, o maior).
+    """
+    x0, y0, x1, y1 = caixa
+    lado = max(x1 - x0, y1 - y0)
+    escolhido = min(TILES_TAMANHOS_SAIDA, key=lambda t: (abs(t - lado), -t))
+    return f"{escolhido}x{escolhido}"
+
+
+def _rampa_tile(inicio: int, fim: int, inicios: list[int], lado: int) -> np.ndarray:
+    """
+    Peso 1D do bloco [inicio, fim): sobe linearmente na sobreposição com o
+    bloco anterior e desce na sobreposição com o próximo (somas dão 1 entre vizinhos).
+    """
+    tamanho = fim - inicio
+    peso = np.ones(tamanho, dtype=np.float32)
+    indice = inicios.index(inicio)
+
+    if indice > 0:
+        entrada = min(inicios[indice - 1] + lado, fim) - inicio
+        if entrada > 0:
+            peso[:entrada] = np.arange(1, entrada + 1, dtype=np.float32) / (entrada + 1)
+
+    if indice < len(inicios) - 1:
+        saida = fim - inicios[indice + 1]
+        if saida > 0:
+            descida = np.arange(saida, 0, -1, dtype=np.float32) / (saida + 1)
+            peso[-saida:] = np.minimum(peso[-saida:], descida)
+
+    return peso
+
+
+class CosturaTiles:
+    """
+    Acumula blocos transformados numa tela float32 com pesos em rampa
+    (feathering) e normaliza no final. Tudo vetorizado com NumPy; os blocos
+    podem chegar em qualquer ordem e são descartados logo após somados.
+    """
+
+    def __init__(self, largura: int, altura: int, lado: int, sobreposicao: int):
+        self.largura = largura
+        self.altura = altura
+        self.lado = lado
+        self.xs = posicoes_tiles(largura, lado, sobreposicao)
+        self.ys = posicoes_tiles(altura, lado, sobreposicao)
+        self._tela = np.zeros((altura, largura, 3), dtype=np.float32)
+        self._pesos = np.zeros((altura, largura, 1), dtype=np.float32)
+
+    def somar(self, caixa: tuple[int, int, int, int], imagem: Image.Image):
+        x0, y0, x1, y1 = caixa
+
+        if imagem.size != (x1 - x0, y1 - y0):
+            imagem = imagem.resize((x1 - x0, y1 - y0), Image.Resampling.LANCZOS)
+
+        pixels = np.asarray(imagem.convert("RGB"), dtype=np.float32)
+        peso = np.outer(
+            _rampa_tile(y0, y1, self.ys, self.lado),
+            _rampa_tile(x0, x1, self.xs, self.lado),
+        )[..., None]
+
+        self._tela[y0:y1, x0:x1] += pixels * peso
+        self._pesos[y0:y1, x0:x1] += peso
+
+    def resultado(self) -> Image.Image:
+        tela = self._tela
+        np.divide(tela, np.maximum(self._pesos, 1e-6), out=tela)
+        np.add(tela, 0.5, out=tela)
+        np.clip(tela, 0, 255, out=tela)
+        return Image.fromarray(tela.astype(np.uint8), "RGB")
+
+
+def gerar_em_tiles(
+    imagem_pil: Image.Image,
+    prompt: str,
+    negative_prompt: str,
+    funcao_tile,
+    chave_limite_tile: str,
+    lado_tile: int = 1024,
+    sobreposicao_tile: int = 128,
+    preservar_fundo: bool = True,
+    ao_tile_concluido=None,
+    **kwargs,
+):
+    """
+    Divide a imagem em blocos sobrepostos, transforma todos em paralelo pelo
+    gerador escolhido (respeitando o limite de concorrência do provedor) e
+    costura o resultado com feathering, na resolução da entrada. Todos os
+    blocos usam o mesmo prompt final. Cada bloco passa pelo cache, então
+    repetir após uma falha só refaz os blocos que faltaram.
+    Mesma assinatura de retorno dos geradores: (imagens, bruto).
+    """
+    imagem_pil = imagem_pil.convert("RGB")
+    largura, altura = imagem_pil.size
+    sobreposicao_tile = max(0, min(sobreposicao_tile, lado_tile // 2 - 1))
+
+    caixas = dividir_em_tiles(largura, altura, lado_tile, sobreposicao_tile)
+    costura = CosturaTiles(largura, altura, lado_tile, sobreposicao_tile)
+
+    prompt_tile = f"{prompt.strip()}\n\n{PROMPT_TILE}" if len(caixas) > 1 else prompt
+    prompt_final = montar_prompt_final(prompt_tile, negative_prompt, preservar_fundo)
+
+    cache = obter_cache_resultados()
+
+    # O tamanho de saída vem de cada bloco, não da imagem inteira
+    kwargs.pop("size", None)
+    recebe_tamanho = "size" in inspect.signature(funcao_tile).parameters
+
+    def _tile(caixa: tuple[int, int, int, int]):
+        if recebe_tamanho:
+            parametros = {**kwargs, "size": tamanho_saida_tile(caixa)}
+        else:
+            parametros = kwargs
+
+        return gerar_com_cache(
+            funcao_tile,
+            imagem_pil=imagem_pil.crop(caixa),
+            cache=cache,
+            chave_limite=chave_limite_tile,
+            prompt=prompt_tile,
+            negative_prompt=negative_prompt,
+            preservar_fundo=preservar_fundo,
+            **parametros,
+        )
+
+    bruto_tile = None
+    cache_hits = 0
+    executor = ThreadPoolExecutor(max_workers=min(TILES_MAX_WORKERS, len(caixas)), thread_name_prefix="tile")
+
+    try:
+        futuros = {executor.submit(_tile, caixa): caixa for caixa in caixas}
+
+        for concluidos, futuro in enumerate(as_completed(futuros), start=1):
+            caixa = futuros[futuro]
+            imagens, bruto, cache_hit = futuro.result()
+
+            if not imagens:
+                raise RuntimeError(f"O bloco {caixa} voltou sem imagem.")
+
+            costura.somar(caixa, imagens[0].pil)
+            bruto_tile = bruto_tile or bruto
+            cache_hits += int(cache_hit)
+
+            if ao_tile_concluido is not None:
+                ao_tile_concluido(concluidos, len(caixas))
+
+        with medir("costura_tiles", tiles=len(caixas), **tags_do_bruto(bruto_tile)):
+            resultado = costura.resultado()
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    bruto = {k: v for k, v in bruto_tile.items() if k in ("provider", "hf_provider", "model")} \
+        if isinstance(bruto_tile, dict) else {}
+    bruto["tiles"] = {
+        "grade": [len(costura.xs), len(costura.ys)],
+        "total": len(caixas),
+        "lado": lado_tile,
+        "sobreposicao": sobreposicao_tile,
+        "cache_hits": cache_hits,
+        "dimensoes": [largura, altura],
+        "prompt_final": prompt_final,
+    }
+
+    return [ImagemGerada.de_pil(resultado)], bruto
+
+
+# =========================
+# ANIMAÇÕES — FRAMES E DEDUPLICAÇÃO
+# =========================
+
+def formato_animacao(dados: bytes, nome: str = "") -> str | None:
+    """
+    "GIF", "PNG" (APNG) ou "WEBP" quando os bytes são uma imagem animada,
+    "VIDEO" pela extensão do arquivo, ou None para imagens estáticas.
+    """
+    if Path(nome).suffix.lower() in EXTENSOES_VIDEO:
+        return "VIDEO"
+
+    try:
+        with Image.open(io.BytesIO(dados)) as imagem:
+            if imagem.format in ("GIF", "PNG", "WEBP") and getattr(imagem, "n_frames", 1) > 1:
+                return imagem.format
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def _ler_frames_video(dados: bytes, nome: str):
+    try:
+        import cv2
+    except ImportError as e:
+        raise RuntimeError(
+            "Para transformar vídeos é preciso um decodificador local: pip install opencv-python-headless"
+        ) from e
+
+    # O OpenCV só lê de arquivo
+    with tempfile.NamedTemporaryFile(suffix=Path(nome).suffix) as arquivo:
+        arquivo.write(dados)
+        arquivo.flush()
+
+        captura = cv2.VideoCapture(arquivo.name)
+        try:
+            fps = captura.get(cv2.CAP_PROP_FPS) or 24.0
+            duracao = 1000.0 / fps
+
+            while True:
+                ok, quadro = captura.read()
+                if not ok:
+                    break
+
+                yield Image.fromarray(cv2.cvtColor(quadro, cv2.COLOR_BGR2RGB)), duracao
+        finally:
+            captura.release()
+
+
+def ler_frames(dados: bytes, nome: str = ""):
+    """
+    Decodifica os frames um a um, gerando (imagem RGB, duração em ms).
+    GIF, APNG e WebP animado pelo Pillow; vídeo pelo OpenCV, se instalado.
+    """
+    if formato_animacao(dados, nome) == "VIDEO":
+        yield from _ler_frames_video(dados, nome)
+        return
+
+    with Image.open(io.BytesIO(dados)) as imagem:
+        for indice in range(getattr(imagem, "n_frames", 1)):
+            imagem.seek(indice)
+            yield imagem.convert("RGB"), float(imagem.info.get("duration") or 100)
+
+
+def montar_animacao(frames: list[Image.Image], duracoes: list[float], formato: str, loop: int | None = 0) -> ImagemGerada:
+    """
+    Codifica os frames de volta numa animação. Frames iguais seguidos são
+    fundidos somando as durações, o que mantém o tempo original com menos frames.
+    Com loop=None a animação sai sem contagem de repetições (um GIF assim
+    toca uma vez), como a entrada que não tinha.
+    """
+    fundidos, tempos = [], []
+
+    for frame, duracao in zip(frames, duracoes):
+        if fundidos and frame is fundidos[-1]:
+            tempos[-1] += duracao
+        else:
+            fundidos.append(frame)
+            tempos.append(duracao)
+
+    formato_saida = formato if formato in ("GIF", "PNG", "WEBP") else "WEBP"
+    opcoes = {"quality": 90} if formato_saida == "WEBP" else {}
+    if loop is not None:
+        opcoes["loop"] = loop
+
+    buf = io.BytesIO()
+    fundidos[0].save(
+        buf,
+        format=formato_saida,
+        save_all=True,
+        append_images=fundidos[1:],
+        duration=[round(t) for t in tempos],
+        **opcoes,
+    )
+
+    return ImagemGerada(dados=buf.getvalue(), mime=MIME_POR_FORMATO[formato_saida])
+
+
+def _cor_media(frame: Image.Image) -> np.ndarray:
+    return np.asarray(frame.convert("RGB").resize((8, 8), Image.Resampling.BOX), dtype=np.float32).reshape(-1, 3).mean(axis=0)
+
+
+def gerar_animacao(
+    dados: bytes,
+    nome: str,
+    funcao_geradora,
+    chave_limite: str,
+    distancia_max: int | None = None,
+    ao_quadro_concluido=None,
+    **kwargs,
+):
+    """
+    Transforma uma animação: decodifica os frames em streaming, pula os que
+    têm hash perceptual a até distancia_max e cor média parecida com a de um
+    quadro-chave já enviado, transforma os quadros-chave em paralelo (com
+    cache e limite do provedor) e remonta a animação com o tempo original.
+    Frames além de ANIMACAO_MAX_FRAMES são cortados ("truncado") e, acima de
+    ANIMACAO_MAX_QUADROS_CHAVE, frames novos reaproveitam à força o quadro
+    mais próximo ("reuso_forcado"). Retorna (imagens, bruto).
+    """
+    distancia_max = ANIMACAO_DISTANCIA_MAX if distancia_max is None else distancia_max
+    formato = formato_animacao(dados, nome) or "WEBP"
+
+    # Sem "loop" na entrada (GIF que toca uma vez), a saída também não leva
+    loop = 0
+    if formato != "VIDEO":
+        with Image.open(io.BytesIO(dados)) as imagem:
+            loop = imagem.info.get("loop")
+
+    cache = obter_cache_resultados()
+
+    def _quadro(frame: Image.Image):
+        return gerar_com_cache(funcao_geradora, imagem_pil=frame, cache=cache, chave_limite=chave_limite, **kwargs)
+
+    hashes = []
+    cores = []
+    futuros = []
+    tamanhos = []
+    mapa = []
+    truncado = False
+    reuso_forcado = 0
+    executor = ThreadPoolExecutor(max_workers=ANIMACAO_MAX_WORKERS, thread_name_prefix="quadro")
+
+    try:
+        for frame, duracao in ler_frames(dados, nome):
+            if len(mapa) >= ANIMACAO_MAX_FRAMES:
+                truncado = True
+                break
+
+            h = hash_perceptual(frame)
+            cor = _cor_media(frame)
+
+            if hashes:
+                distancias = np.array([distancia_hamming(h, outro) for outro in hashes])
+                diferencas = np.abs(np.array(cores) - cor).max(axis=1)
+                parecidos = np.flatnonzero((distancias <= distancia_max) & (diferencas <= ANIMACAO_DIFERENCA_COR_MAX))
+
+                if parecidos.size:
+                    mapa.append((int(parecidos[np.argmin(distancias[parecidos])]), duracao))
+                    continue
+
+                if len(hashes) >= ANIMACAO_MAX_QUADROS_CHAVE:
+                    # Mais próximo pelo hash, desempatando pela cor
+                    mapa.append((int(np.lexsort((diferencas, distancias))[0]), duracao))
+                    reuso_forcado += 1
+                    continue
+
+            # Quadro-chave: já vai para o provedor enquanto o resto é decodificado
+            hashes.append(h)
+            cores.append(cor)
+            tamanhos.append(frame.size)
+            futuros.append(executor.submit(_quadro, frame))
+            mapa.append((len(futuros) - 1, duracao))
+
+        if not mapa:
+            raise RuntimeError("Nenhum frame encontrado no arquivo.")
+
+        transformados = [None] * len(futuros)
+        bruto_quadro = None
+        cache_hits = 0
+        indices = {futuro: i for i, futuro in enumerate(futuros)}
+
+        for concluidos, futuro in enumerate(as_completed(futuros), start=1):
+            i = indices[futuro]
+            imagens, bruto, cache_hit = futuro.result()
+
+            if not imagens:
+                raise RuntimeError(f"O quadro-chave {i + 1} voltou sem imagem.")
+
+            transformado = imagens[0].pil
+            if transformado.size != tamanhos[i]:
+                transformado = transformado.resize(tamanhos[i], Image.Resampling.LANCZOS)
+
+            transformados[i] = transformado
+            bruto_quadro = bruto_quadro or bruto
+            cache_hits += int(cache_hit)
+
+            if ao_quadro_concluido is not None:
+                ao_quadro_concluido(concluidos, len(futuros))
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    with medir("montagem_animacao", frames=len(mapa), **tags_do_bruto(bruto_quadro)):
+        animacao = montar_animacao(
+            [transformados[i] for i, _ in mapa],
+            [duracao for _, duracao in mapa],
+            formato,
+            loop=loop,
+        )
+
+    bruto = {k: v for k, v in bruto_quadro.items() if k in ("provider", "hf_provider", "model")} \
+        if isinstance(bruto_quadro, dict) else {}
+    bruto["animacao"] = {
+        "formato_entrada": formato,
+        "frames": len(mapa),
+        "quadros_chave": len(futuros),
+        "frames_reaproveitados": len(mapa) - len(futuros),
+        "distancia_max": distancia_max,
+        "duracao_total_ms": round(sum(d for _, d in mapa)),
+        "truncado": truncado,
+        "reuso_forcado": reuso_forcado,
+        "cache_hits": cache_hits,
+    }
+
+    return [animacao], bruto
+
+
+# =========================
+# FILA DE JOBS EM SEGUNDO PLANO
+# =========================
+
+class JobCancelado(Exception):
+    pass
+
+
+class Job:
+    """
+    Uma transformação enviada para a fila. Estados: na_fila, executando,
+    concluido, falhou, cancelado.
+    """
+
+    def __init__(self, sessao_id: str, titulo: str, nome_base: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.sessao_id = sessao_id
+        self.titulo = titulo
+        self.nome_base = nome_base
+        self.estado = "na_fila"
+        self.criado_em = time.time()
+        self.iniciado_em = None
+        self.terminado_em = None
+        self.imagens = []
+        self.bruto = None
+        self.cache_hit = False
+        self.erro = None
+        self.progresso = None
+        self.cancelamento = threading.Event()
+        self.futuro = None
+        # Chamado com o job depois que ele chega a um estado final
+        self.ao_finalizar = None
+        # Mudanças de estado concorrentes (worker x cancelar) passam por aqui
+        self._lock = threading.Lock()
+
+    @property
+    def finalizado(self) -> bool:
+        return self.estado in ("concluido", "falhou", "cancelado")
+
+    def iniciar(self) -> bool:
+        """
+        Marca o job como em execução; False se ele já foi cancelado.
+        """
+        with self._lock:
+            if self.cancelamento.is_set() or self.finalizado:
+                return False
+
+            self.estado = "executando"
+            self.iniciado_em = time.time()
+            return True
+
+    def finalizar(self, estado: str, imagens=None, bruto=None, cache_hit: bool = False, erro: str | None = None) -> bool:
+        """
+        Leva o job a um estado final, uma única vez. Um job cancelado nunca
+        passa a concluído, mesmo que o resultado chegue ao mesmo tempo.
+        """
+        with self._lock:
+            if self.finalizado:
+                return False
+
+            if estado == "concluido" and self.cancelamento.is_set():
+                estado = "cancelado"
+
+            if estado == "concluido":
+                self.imagens, self.bruto, self.cache_hit = imagens or [], bruto, cache_hit
+
+            self.erro = erro
+            self.estado = estado
+            self.terminado_em = time.time()
+
+        if self.ao_finalizar is not None:
+            self.ao_finalizar(self)
+
+        return True
+
+    def cancelar(self) -> bool:
+        """
+        Pede o cancelamento; um job que ainda não começou já fica cancelado.
+        False se ele já tinha terminado.
+        """
+        with self._lock:
+            if self.finalizado:
+                return False
+
+            self.cancelamento.set()
+
+            # Ainda não começou (na fila do pool ou esperando o limite do provedor)
+            if self.estado == "na_fila":
+                self.estado = "cancelado"
+                self.terminado_em = time.time()
+
+            return True
+
+    def tempo_decorrido(self) -> float:
+        fim = self.terminado_em or time.time()
+        return fim - self.criado_em
+
+
+class FilaJobs:
+    """
+    Fila compartilhada pelo processo: um pool fixo de workers executa os
+    geradores, respeitando o limite de concorrência de cada provedor.
+
+    Cada job consulta o cache primeiro; só os que precisam chamar o provedor
+    disputam as vagas dele. Quando o provedor já tem tantos jobs quanto o seu
+    limite, o job espera numa fila própria do provedor, sem ocupar um worker,
+    e é despachado quando um job do mesmo provedor termina. Assim um provedor
+    saturado não trava acertos de cache nem jobs de outros provedores.
+
+    No modo hedge, cada candidato segue esse mesmo caminho como um job
+    interno; só a coordenação da corrida roda num pool à parte.
+    """
+
+    def __init__(self, max_workers: int, limitador: LimitadorConcorrencia, cache: CacheResultados, retencao_segundos: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        # Coordenadores do hedge só esperam; ficam fora do pool que executa os geradores
+        self._hedges = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-hedge")
+        self._limitador = limitador
+        self._cache = cache
+        self._retencao_segundos = retencao_segundos
+        self._jobs = OrderedDict()
+        self._ativos = {}
+        self._aguardando = {}
+        self._lock = threading.Lock()
+
+    def submeter(
+        self,
+        sessao_id: str,
+        titulo: str,
+        nome_base: str,
+        chave_limite: str,
+        funcao_geradora,
+        imagem_pil: Image.Image,
+        alternativas: list[tuple] | None = None,
+        hedge_atraso: float = 0,
+        **kwargs,
+    ) -> str:
+        """
+        Enfileira a geração e retorna o id do job imediatamente.
+        Com alternativas, o job roda em modo hedge (ver gerar_com_hedge).
+        """
+        job = Job(sessao_id, titulo, nome_base)
+
+        with self._lock:
+            self._limpar_antigos()
+            self._jobs[job.id] = job
+
+        if alternativas:
+            job.futuro = self._hedges.submit(
+                self._executar_hedge, job, chave_limite, funcao_geradora, imagem_pil, alternativas, hedge_atraso, kwargs
+            )
+        else:
+            job.futuro = self._executor.submit(
+                self._executar, job, chave_limite, funcao_geradora, imagem_pil, kwargs
+            )
+
+        return job.id
+
+    def _executar_hedge(
+        self,
+        job: Job,
+        chave_limite: str,
+        funcao_geradora,
+        imagem_pil: Image.Image,
+        alternativas: list[tuple],
+        hedge_atraso: float,
+        kwargs: dict,
+    ):
+        if job.cancelamento.is_set():
+            return
+
+        comuns = {k: kwargs[k] for k in ("prompt", "negative_prompt", "preservar_fundo") if k in kwargs}
+        parametros = {k: v for k, v in kwargs.items() if k not in comuns}
+        # Todos os candidatos recebem a mesma imagem: um hash para a corrida inteira
+        comuns["hash_entrada"] = hash_imagem(imagem_pil)
+
+        if not job.iniciar():
+            return
+
+        def _status(mensagem: str):
+            job.progresso = mensagem
+
+        # O progresso do stream vale para qualquer candidato, não só o primeiro
+        if kwargs.get("stream"):
+            comuns["ao_progresso"] = self._progresso_job(job, kwargs.get("ao_progresso"))
+            parametros.pop("ao_progresso", None)
+
+        def _despachar(chave: str, funcao, parametros_candidato: dict, encerrado: threading.Event) -> Future:
+            return self._despachar_candidato(job, chave, funcao, imagem_pil, parametros_candidato, encerrado)
+
+        try:
+            imagens, bruto, cache_hit = gerar_com_hedge(
+                [(chave_limite, funcao_geradora, parametros)] + list(alternativas),
+                imagem_pil=imagem_pil,
+                atraso_segundos=hedge_atraso,
+                cache=self._cache,
+                cancelamento=job.cancelamento,
+                ao_status=_status,
+                despachar=_despachar,
+                **comuns,
+            )
+            job.finalizar("concluido", imagens, bruto, cache_hit)
+
+        except JobCancelado:
+            job.finalizar("cancelado")
+
+        except Exception as e:
+            job.finalizar("falhou", erro=str(e))
+
+    def _despachar_candidato(
+        self,
+        job: Job,
+        chave_limite: str,
+        funcao_geradora,
+        imagem_pil: Image.Image,
+        kwargs: dict,
+        encerrado: threading.Event,
+    ) -> Future:
+        """
+        Executa um candidato do hedge como job interno (fora da lista da
+        sessão): cache primeiro, depois a vaga ou a fila do provedor. O
+        candidato é cancelado quando a corrida termina.
+        """
+        candidato = Job(job.sessao_id, job.titulo, job.nome_base)
+        candidato.cancelamento = encerrado
+        resultado = Future()
+
+        def _finalizado(candidato: Job):
+            if candidato.estado == "concluido":
+                resultado.set_result((candidato.imagens, candidato.bruto, candidato.cache_hit))
+            elif candidato.estado == "falhou":
+                resultado.set_exception(RuntimeError(candidato.erro))
+            else:
+                resultado.set_exception(JobCancelado())
+
+        candidato.ao_finalizar = _finalizado
+        candidato.futuro = self._executor.submit(
+            self._executar, candidato, chave_limite, funcao_geradora, imagem_pil, kwargs
+        )
+        return resultado
+
+    @staticmethod
+    def _progresso_job(job: Job, seguinte=None):
+        """
+        Callback do modo streaming: mostra o progresso no job, interrompe a
+        leitura se ele foi cancelado e repassa ao callback que já existia.
+        """
+        def _progresso(status: str, bytes_recebidos: int, imagens_recebidas: int):
+            job.progresso = f"{status}: {bytes_recebidos / 1e6:.2f} MB, {imagens_recebidas} imagem(ns)"
+
+            # No modo streaming o cancelamento interrompe a leitura da resposta
+            if job.cancelamento.is_set():
+                raise JobCancelado()
+
+            if seguinte is not None:
+                seguinte(status, bytes_recebidos, imagens_recebidas)
+
+        return _progresso
+
+    def _reservar(self, job: Job, chave_limite: str, argumentos: tuple) -> bool:
+        """
+        Reserva uma vaga do provedor para o job; sem vaga, o job vai para a
+        fila do provedor e o worker fica livre.
+        """
+        with self._lock:
+            if self._ativos.get(chave_limite, 0) < self._limitador.limite(chave_limite):
+                self._ativos[chave_limite] = self._ativos.get(chave_limite, 0) + 1
+                return True
+
+            self._aguardando.setdefault(chave_limite, deque()).append((job, argumentos))
+            return False
+
+    def _liberar(self, chave_limite: str):
+        """
+        Devolve a vaga e a passa ao próximo job não cancelado do provedor.
+        """
+        with self._lock:
+            fila = self._aguardando.get(chave_limite)
+
+            while fila:
+                job, argumentos = fila.popleft()
+
+                if not job.cancelamento.is_set():
+                    job.futuro = self._executor.submit(self._executar, job, *argumentos, reservado=True)
+                    return
+
+                job.finalizar("cancelado")
+
+            self._ativos[chave_limite] -= 1
+
+    def _executar(
+        self,
+        job: Job,
+        chave_limite: str,
+        funcao_geradora,
+        imagem_pil: Image.Image,
+        kwargs: dict,
+        reservado: bool = False,
+    ):
+        if job.cancelamento.is_set():
+            job.finalizar("cancelado")
+            if reservado:
+                self._liberar(chave_limite)
+            return
+
+        if not reservado:
+            # Os pixels são percorridos uma vez só: a consulta e a geração usam o mesmo hash
+            if "hash_entrada" not in kwargs:
+                kwargs = {**kwargs, "hash_entrada": hash_imagem(imagem_pil)}
+
+            try:
+                encontrado = consultar_cache(funcao_geradora, imagem_pil, cache=self._cache, **kwargs)
+            except Exception:
+                encontrado = None
+
+            if encontrado is not None:
+                job.finalizar("concluido", *encontrado, cache_hit=True)
+                return
+
+            if not self._reservar(job, chave_limite, (chave_limite, funcao_geradora, imagem_pil, kwargs)):
+                return
+
+        try:
+            self._gerar(job, chave_limite, funcao_geradora, imagem_pil, kwargs)
+        finally:
+            self._liberar(chave_limite)
+
+    def _gerar(self, job: Job, chave_limite: str, funcao_geradora, imagem_pil: Image.Image, kwargs: dict):
+        def _iniciar():
+            # Só chega aqui quem vai chamar o provedor, depois de esperar a vaga
+            if not job.iniciar():
+                raise JobCancelado()
+
+        if kwargs.get("stream"):
+            kwargs = {**kwargs, "ao_progresso": self._progresso_job(job, kwargs.get("ao_progresso"))}
+
+        try:
+            imagens, bruto, cache_hit = gerar_com_cache(
+                funcao_geradora,
+                imagem_pil=imagem_pil,
+                cache=self._cache,
+                chave_limite=chave_limite,
+                ao_iniciar=_iniciar,
+                **kwargs,
+            )
+            job.finalizar("concluido", imagens, bruto, cache_hit)
+
+        except JobCancelado:
+            job.finalizar("cancelado")
+
+        except Exception as e:
+            job.finalizar("falhou", erro=str(e))
+
+    def cancelar(self, job_id: str) -> bool:
+        """
+        Cancela um job. Jobs na fila não chegam a rodar; jobs em execução têm
+        o resultado descartado (a chamada HTTP em andamento não é interrompida,
+        exceto no modo streaming).
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+
+        if job is None or not job.cancelar():
+            return False
+
+        if job.futuro is not None:
+            job.futuro.cancel()
+
+        return True
+
+    def listar(self, sessao_id: str) -> list[Job]:
+        with self._lock:
+            return [job for job in self._jobs.values() if job.sessao_id == sessao_id]
+
+    def remover(self, job_id: str):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            estados = {}
+            for job in self._jobs.values():
+                estados[job.estado] = estados.get(job.estado, 0) + 1
+
+            estados["aguardando_vaga"] = {
+                chave: len(fila) for chave, fila in self._aguardando.items() if fila
+            }
+            return estados
+
+    def _limpar_antigos(self):
+        """
+        Remove jobs finalizados que ninguém coletou (ex.: sessão encerrada).
+        """
+        limite = time.time() - self._retencao_segundos
+
+        for job_id in [j.id for j in self._jobs.values() if j.finalizado and j.terminado_em < limite]:
+            del self._jobs[job_id]
+
+
+@recurso_compartilhado
+def obter_fila_jobs() -> FilaJobs:
+    return FilaJobs(
+        max_workers=JOBS_MAX_WORKERS,
+        limitador=obter_limitador_concorrencia(),
+        cache=obter_cache_resultados(),
+        retencao_segundos=JOBS_RETENCAO_SEGUNDOS,
+    )
+
+
+# =========================
+# HEDGE — CORRIDA ENTRE PROVEDORES/MODELOS
+# =========================
+
+def montar_alternativas_hedge(provedor: str, parametros_geracao: dict, max_extras: int) -> list[tuple]:
+    """
+    Alternativas para o hedge, no formato (chave_limite, funcao_geradora, parametros):
+    no Hugging Face, o mesmo modelo nos outros providers, na ordem do
+    roteador; no OpenRouter, os modelos configurados em HEDGE_MODELOS_OPENROUTER
+    que o catálogo aceita para image-to-image.
+    O motor local não tem alternativas.
+    """
+    alternativas = []
+
+    if provedor == "OpenRouter":
+        catalogo = obter_catalogo_openrouter()
+
+        for modelo in HEDGE_MODELOS_OPENROUTER:
+            if modelo != parametros_geracao["model"] and catalogo.verificar(modelo) is None:
+                alternativas.append(
+                    ("openrouter", gerar_imagem_de_outra_openrouter, {**parametros_geracao, "model": modelo})
+                )
+
+    elif provedor == "Hugging Face":
+        ordem = obter_roteador_providers_hf().ordenar(parametros_geracao["model_id"], HF_PROVIDERS)
+
+        for provider in ordem:
+            if provider != parametros_geracao["provider"]:
+                alternativas.append(
+                    (provider, gerar_imagem_huggingface_img2img, {**parametros_geracao, "provider": provider})
+                )
+
+    return alternativas[:max(0, max_extras)]
+
+
+def descrever_candidato(parametros: dict) -> str:
+    if "model_id" in parametros:
+        return f"{parametros['model_id']} @ {parametros['provider']}"
+
+    return parametros.get("model", MODELO_LOCAL)
+
+
+def gerar_com_hedge(
+    candidatos: list[tuple],
+    imagem_pil: Image.Image,
+    atraso_segundos: float,
+    cache: CacheResultados | None = None,
+    cancelamento: threading.Event | None = None,
+    ao_status=None,
+    despachar=None,
+    **comuns,
+):
+    """
+    Dispara o primeiro candidato e, se ele não responder em atraso_segundos
+    (ou falhar), dispara o próximo. A primeira resposta com imagem vence; as
+    demais são ignoradas (no modo streaming, interrompidas). Cada candidato
+    passa pelo cache e pelo limite de concorrência do seu provedor.
+    despachar(chave_limite, funcao_geradora, parametros, encerrado) -> Future
+    substitui o pool próprio (a fila de jobs usa o seu caminho por provedor).
+    Retorna (imagens, bruto, cache_hit).
+    """
+    if cache is None:
+        cache = obter_cache_resultados()
+
+    encerrado = threading.Event()
+    tentativas = []
+
+    def _avisar(mensagem: str):
+        if ao_status is not None:
+            ao_status(mensagem)
+
+    def _preparar(parametros: dict) -> dict:
+        parametros = {**comuns, **parametros}
+
+        if parametros.get("stream"):
+            seguinte = parametros.get("ao_progresso")
+
+            def _progresso(*args):
+                if encerrado.is_set():
+                    raise JobCancelado()
+
+                if seguinte is not None:
+                    seguinte(*args)
+
+            parametros["ao_progresso"] = _progresso
+
+        return parametros
+
+    def _executar(chave_limite: str, funcao_geradora, parametros: dict):
+        def _iniciar():
+            # Outro candidato pode ter vencido enquanto este esperava a vaga
+            if encerrado.is_set():
+                raise JobCancelado()
+
+        return gerar_com_cache(
+            funcao_geradora,
+            imagem_pil=imagem_pil,
+            cache=cache,
+            chave_limite=chave_limite,
+            ao_iniciar=_iniciar,
+            **parametros,
+        )
+
+    executor = None
+    if despachar is None:
+        executor = ThreadPoolExecutor(max_workers=len(candidatos), thread_name_prefix="hedge")
+
+    pendentes = {}
+    proximo = 0
+
+    def _lancar():
+        nonlocal proximo
+        chave_limite, funcao_geradora, parametros = candidatos[proximo]
+        descricao = descrever_candidato(parametros)
+
+        if despachar is not None:
+            futuro = despachar(chave_limite, funcao_geradora, _preparar(parametros), encerrado)
+        else:
+            futuro = executor.submit(_executar, chave_limite, funcao_geradora, _preparar(parametros))
+        pendentes[futuro] = {"candidato": descricao, "inicio": time.time()}
+        proximo += 1
+
+        _avisar(f"Tentativa {proximo}/{len(candidatos)}: {descricao}")
+
+    try:
+        _lancar()
+
+        while pendentes:
+            if cancelamento is not None and cancelamento.is_set():
+                raise JobCancelado()
+
+            limite_espera = None
+            if proximo < len(candidatos):
+                inicio_ultimo = max(info["inicio"] for info in pendentes.values())
+                limite_espera = max(0.0, inicio_ultimo + atraso_segundos - time.time())
+
+            if cancelamento is not None:
+                limite_espera = 0.5 if limite_espera is None else min(limite_espera, 0.5)
+
+            feitos, _ = wait(list(pendentes), timeout=limite_espera, return_when=FIRST_COMPLETED)
+
+            for futuro in feitos:
+                info = pendentes.pop(futuro)
+                info["segundos"] = round(time.time() - info.pop("inicio"), 2)
+
+                try:
+                    imagens, bruto, cache_hit = futuro.result()
+                except Exception as e:
+                    info["erro"] = repr(e)
+                    tentativas.append(info)
+                    continue
+
+                if not imagens:
+                    info["erro"] = "resposta sem imagem"
+                    tentativas.append(info)
+                    continue
+
+                info["venceu"] = True
+                tentativas.append(info)
+                tentativas.extend(
+                    {"candidato": i["candidato"], "ignorada": True} for i in pendentes.values()
+                )
+
+                resumo = {"vencedor": info["candidato"], "tentativas": tentativas}
+                bruto = {**bruto, "hedge": resumo} if isinstance(bruto, dict) else {"resposta": bruto, "hedge": resumo}
+
+                return imagens, bruto, cache_hit
+
+            # Sem vencedor: dispara o próximo se o atraso passou ou se todos falharam
+            if proximo < len(candidatos):
+                inicio_ultimo = max((i["inicio"] for i in pendentes.values()), default=0)
+                if not pendentes or time.time() >= inicio_ultimo + atraso_segundos:
+                    _lancar()
+
+    finally:
+        encerrado.set()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    raise RuntimeError(
+        "Nenhum candidato do hedge retornou imagem.\n\n"
+        + "\n".join(f"- {t['candidato']}: {t.get('erro', '')}" for t in tentativas)
+    )
+
+
+# =========================
+# COMPARAÇÃO DE MODELOS
+# =========================
+
+def montar_candidatos_comparacao(
+    modelos_openrouter: list[str],
+    modelos_hf: list[str],
+    parametros_openrouter: dict,
+    parametros_hf: dict,
+    incluir_local: bool = False,
+) -> list[tuple]:
+    """
+    Candidatos no formato (chave_limite, funcao_geradora, parametros) para
+    comparar modelos. Sem provider em parametros_hf, cada modelo Hugging
+    Face vai para o provider escolhido pelo roteador.
+    """
+    candidatos = [
+        ("openrouter", gerar_imagem_de_outra_openrouter, {**parametros_openrouter, "model": modelo})
+        for modelo in modelos_openrouter
+    ]
+
+    for modelo in modelos_hf:
+        provider = parametros_hf.get("provider") or obter_roteador_providers_hf().escolher(modelo, HF_PROVIDERS)
+        candidatos.append(
+            (provider, gerar_imagem_huggingface_img2img, {**parametros_hf, "model_id": modelo, "provider": provider})
+        )
+
+    if incluir_local:
+        candidatos.append(("local", gerar_imagem_local_comic, {}))
+
+    return candidatos
+
+
+def comparar_modelos(
+    candidatos: list[tuple],
+    variantes: list[tuple[str, str]],
+    imagem_pil: Image.Image,
+    negative_prompt: str,
+    preservar_fundo: bool = True,
+    cache: CacheResultados | None = None,
+):
+    """
+    Gera a mesma imagem em cada candidato x variante de prompt (nome, prompt),
+    tudo em paralelo e respeitando o limite de cada provedor. Gera cada
+    célula da grade assim que ela termina, como dict com linha (variante),
+    coluna (candidato), imagens, bruto, cache_hit, erro, segundos (só a
+    chamada, sem a espera pela vaga) e bytes enviados/recebidos.
+    """
+    if cache is None:
+        cache = obter_cache_resultados()
+
+    def _celula(chave_limite: str, funcao_geradora, parametros: dict, prompt: str):
+        inicio = time.perf_counter()
+
+        def _iniciar():
+            # Recomeça a contar quando a vaga é obtida
+            nonlocal inicio
+            inicio = time.perf_counter()
+
+        imagens, bruto, cache_hit = gerar_com_cache(
+            funcao_geradora,
+            imagem_pil=imagem_pil,
+            cache=cache,
+            chave_limite=chave_limite,
+            ao_iniciar=_iniciar,
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            preservar_fundo=preservar_fundo,
+            **parametros,
+        )
+        return imagens, bruto, cache_hit, time.perf_counter() - inicio
+
+    celulas = [
+        (linha, coluna, candidato, prompt)
+        for linha, (_, prompt) in enumerate(variantes)
+        for coluna, candidato in enumerate(candidatos)
+    ]
+
+    if not celulas:
+        return
+
+    max_workers = min(COMPARACAO_MAX_WORKERS, len(celulas))
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="comparacao") as executor:
+        futuros = {
+            executor.submit(_celula, chave_limite, funcao_geradora, parametros, prompt): (linha, coluna, parametros)
+            for linha, coluna, (chave_limite, funcao_geradora, parametros), prompt in celulas
+        }
+
+        for futuro in as_completed(futuros):
+            linha, coluna, parametros = futuros[futuro]
+            celula = {
+                "linha": linha,
+                "coluna": coluna,
+                "variante": variantes[linha][0],
+                "candidato": descrever_candidato(parametros),
+                "imagens": [],
+                "bruto": None,
+                "cache_hit": False,
+                "erro": None,
+                "segundos": None,
+                "bytes_enviados": None,
+                "bytes_recebidos": 0,
+            }
+
+            try:
+                imagens, bruto, cache_hit, segundos = futuro.result()
+            except Exception as e:
+                celula["erro"] = e
+                yield celula
+                continue
+
+            entrada = bruto.get("entrada") if isinstance(bruto, dict) else None
+
+            celula.update({
+                "imagens": imagens,
+                "bruto": bruto,
+                "cache_hit": cache_hit,
+                "segundos": segundos,
+                "bytes_enviados": entrada.get("bytes_enviados") if entrada else None,
+                "bytes_recebidos": sum(len(img.dados) for img in imagens),
+            })
+            yield celula
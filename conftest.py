@@ -0,0 +1,5 @@
+"""
+Fica na raiz do repositório para que o pytest ponha a raiz no sys.path e os
+testes consigam importar comic_core tanto com `pytest` quanto com
+`python -m pytest`.
+"""
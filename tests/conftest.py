@@ -0,0 +1,25 @@
+import pytest
+
+import comic_core
+
+
+ARQUIVOS = {
+    "CATALOGO_OPENROUTER_ARQUIVO": "catalogo_openrouter.json",
+    "CACHE_DIR": "resultados",
+    "SIMILARES_ARQUIVO": "indice_similares.jsonl",
+    "METRICAS_ARQUIVO_JSONL": "metricas.jsonl",
+    "METRICAS_ARQUIVO_PROMETHEUS": "metricas.prom",
+    "METODOS_HF_ARQUIVO": "metodos_hf.json",
+}
+
+
+@pytest.fixture(autouse=True)
+def cache_isolado(tmp_path, monkeypatch):
+    """
+    Cada teste grava cache, índice e métricas em tmp_path e recebe recursos
+    compartilhados novos, em vez de mexer em .cache/ do repositório.
+    """
+    for nome, arquivo in ARQUIVOS.items():
+        monkeypatch.setattr(comic_core, nome, tmp_path / "cache" / arquivo)
+
+    monkeypatch.setattr(comic_core, "_recursos", {})
@@ -0,0 +1,451 @@
+import base64
+import io
+import json
+import random
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import comic_core
+from comic_core import (
+    ArvoreBK,
+    BaldeFichas,
+    CorpoJsonComImagem,
+    CosturaTiles,
+    GeracoesEmAndamento,
+    distancia_hamming,
+    dividir_em_tiles,
+    ler_stream_openrouter,
+)
+
+
+def imagem_aleatoria(largura: int, altura: int, semente: int = 0) -> Image.Image:
+    pixels = np.random.default_rng(semente).integers(0, 256, (altura, largura, 3), dtype=np.uint8)
+    return Image.fromarray(pixels, "RGB")
+
+
+def data_url_png(imagem: Image.Image) -> str:
+    buf = io.BytesIO()
+    imagem.save(buf, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+# =========================
+# TILES
+# =========================
+
+@pytest.mark.parametrize(
+    "largura, altura, lado, sobreposicao",
+    [(300, 200, 128, 16), (1000, 700, 256, 64), (128, 128, 128, 16), (257, 129, 128, 0)],
+)
+def test_costura_reproduz_a_imagem_quando_os_blocos_nao_mudam(largura, altura, lado, sobreposicao):
+    imagem = imagem_aleatoria(largura, altura)
+    costura = CosturaTiles(largura, altura, lado, sobreposicao)
+
+    caixas = dividir_em_tiles(largura, altura, lado, sobreposicao)
+    random.Random(1).shuffle(caixas)
+
+    for caixa in caixas:
+        costura.somar(caixa, imagem.crop(caixa))
+
+    assert np.array_equal(np.asarray(costura.resultado()), np.asarray(imagem))
+
+
+def test_cada_bloco_pede_o_proprio_tamanho_de_saida():
+    tamanhos = []
+
+    def _gerador(imagem_pil, prompt, negative_prompt, size="1024x1024", preservar_fundo=True):
+        tamanhos.append((imagem_pil.size, size))
+        return [comic_core.ImagemGerada.de_pil(imagem_pil)], {"model": "teste"}
+
+    comic_core.gerar_em_tiles(
+        imagem_aleatoria(1200, 500),
+        prompt="p",
+        negative_prompt="n",
+        funcao_tile=_gerador,
+        chave_limite_tile="teste-tiles",
+        lado_tile=768,
+        sobreposicao_tile=64,
+        size="1536x1024",
+    )
+
+    # Blocos de 768x500: o tamanho da imagem inteira não chega ao modelo
+    assert {size for _, size in tamanhos} == {"768x768"}
+    assert {dimensoes for dimensoes, _ in tamanhos} == {(768, 500)}
+
+
+# =========================
+# ANIMAÇÃO
+# =========================
+
+@pytest.mark.parametrize("loop", [None, 0, 3])
+def test_animacao_mantem_o_loop_da_entrada(loop):
+    frames = [imagem_aleatoria(24, 24, semente) for semente in range(3)]
+    opcoes = {} if loop is None else {"loop": loop}
+    buf = io.BytesIO()
+    frames[0].save(buf, format="GIF", save_all=True, append_images=frames[1:], duration=100, **opcoes)
+
+    def _gerador(imagem_pil, prompt, negative_prompt, preservar_fundo=True):
+        return [comic_core.ImagemGerada.de_pil(imagem_pil)], {"model": "teste"}
+
+    imagens, _ = comic_core.gerar_animacao(
+        buf.getvalue(), "entrada.gif", _gerador, "teste-animacao", prompt="p", negative_prompt="n"
+    )
+
+    with Image.open(io.BytesIO(imagens[0].dados)) as saida:
+        assert saida.info.get("loop") == loop
+
+
+# =========================
+# IMAGEM GERADA
+# =========================
+
+def test_liberar_pixels_mantem_os_bytes_e_conta_so_o_que_fica():
+    imagem = imagem_aleatoria(40, 30)
+    gerada = comic_core.ImagemGerada.de_pil(imagem)
+
+    assert gerada.bytes_em_memoria == len(gerada.dados) + 40 * 30 * 3
+
+    gerada.liberar_pixels()
+
+    assert gerada.bytes_em_memoria == len(gerada.dados)
+    assert np.array_equal(np.asarray(gerada.pil), np.asarray(imagem))
+
+
+# =========================
+# BK-TREE
+# =========================
+
+def test_arvore_bk_encontra_o_mesmo_que_a_busca_exaustiva():
+    aleatorio = random.Random(7)
+    base = [aleatorio.getrandbits(64) for _ in range(20)]
+    # Hashes agrupados perto de poucas bases, como fotos parecidas
+    hashes = [b ^ (1 << aleatorio.randrange(64)) ^ (1 << aleatorio.randrange(64)) for b in base for _ in range(25)]
+
+    arvore = ArvoreBK()
+    for i, h in enumerate(hashes):
+        arvore.inserir(h, str(i))
+
+    for consulta in base[:5] + [aleatorio.getrandbits(64) for _ in range(5)]:
+        for raio in (0, 2, 6, 12):
+            esperado = sorted(
+                (distancia_hamming(consulta, h), str(i))
+                for i, h in enumerate(hashes)
+                if distancia_hamming(consulta, h) <= raio
+            )
+            assert arvore.buscar(consulta, raio) == esperado
+
+
+def test_indice_guarda_entradas_de_sessao_so_na_memoria(tmp_path):
+    arquivo = tmp_path / "indice.jsonl"
+    indice = comic_core.IndiceSimilares(arquivo, 100)
+
+    indice.adicionar("global", 0b1010, "chave-global")
+    indice.adicionar("sessao", 0b1010, "chave-sessao", persistir=False)
+
+    assert indice.buscar("sessao", 0b1011, 2) == [(1, "chave-sessao")]
+    assert len(arquivo.read_text(encoding="utf-8").splitlines()) == 1
+
+    recarregado = comic_core.IndiceSimilares(arquivo, 100)
+    assert recarregado.buscar("global", 0b1010, 0) == [(0, "chave-global")]
+    assert recarregado.buscar("sessao", 0b1010, 0) == []
+
+
+# =========================
+# LIMITE DE TAXA
+# =========================
+
+def test_balde_libera_a_rajada_e_depois_segue_a_taxa():
+    balde = BaldeFichas(por_minuto=600, capacidade=2)
+    inicio = time.monotonic()
+
+    for _ in range(5):
+        balde.adquirir()
+
+    # 2 de rajada e 3 espaçadas de 0,1 s
+    assert 0.25 <= time.monotonic() - inicio < 0.6
+    assert balde.estatisticas()["chamadas"] == 5
+
+
+def test_balde_sem_taxa_so_espera_bloqueios():
+    balde = BaldeFichas(por_minuto=0, capacidade=2)
+    inicio = time.monotonic()
+
+    for _ in range(100):
+        balde.adquirir()
+
+    assert time.monotonic() - inicio < 0.1
+
+    balde.bloquear(0.2)
+    assert balde.adquirir() >= 0.15
+
+
+# =========================
+# MÉTRICAS
+# =========================
+
+@pytest.mark.parametrize(
+    "amostras, q, esperado",
+    [
+        (range(1, 101), 50, 50),
+        (range(1, 101), 95, 95),
+        (range(1, 101), 99, 99),
+        (range(1, 101), 100, 100),
+        (range(1, 11), 50, 5),
+        (range(1, 11), 95, 10),
+        (range(1, 11), 0, 1),
+        ([7], 99, 7),
+    ],
+)
+def test_percentil_pelo_posto_mais_proximo(amostras, q, esperado):
+    histograma = comic_core.HistogramaLatencia(1000)
+    for valor in random.Random(3).sample(list(amostras), len(amostras)):
+        histograma.observar(valor)
+
+    assert histograma.percentil(q) == esperado
+
+
+def test_percentil_sem_amostras():
+    assert comic_core.HistogramaLatencia(10).percentil(95) == 0.0
+
+
+# =========================
+# SINGLE-FLIGHT
+# =========================
+
+def test_pedidos_iguais_em_andamento_fazem_uma_chamada():
+    geracoes = GeracoesEmAndamento()
+    chamadas = []
+    largada = threading.Barrier(8)
+    resultados = []
+
+    def _gerar():
+        chamadas.append(1)
+        time.sleep(0.3)
+        return "resultado"
+
+    def _pedido():
+        largada.wait()
+        resultados.append(geracoes.executar("chave", _gerar))
+
+    threads = [threading.Thread(target=_pedido) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(chamadas) == 1
+    assert sorted(agregado for _, agregado in resultados) == [False] + [True] * 7
+    assert {resultado for resultado, _ in resultados} == {"resultado"}
+    assert geracoes.estatisticas() == {"em_andamento": 0, "chamadas": 1, "agregadas": 7}
+
+
+def test_so_o_lider_ocupa_vaga_do_provedor(monkeypatch):
+    cache = comic_core.obter_cache_resultados()
+    limitador = comic_core.obter_limitador_concorrencia()
+    monkeypatch.setitem(limitador.limites, "teste-vaga", 3)
+    semaforo = limitador.semaforo("teste-vaga")
+    livres = []
+
+    def _gerador(imagem_pil, **_):
+        time.sleep(0.3)
+        livres.append(semaforo._value)
+        return [comic_core.ImagemGerada.de_pil(imagem_pil)], {"model": "teste"}
+
+    def _pedido():
+        comic_core.gerar_com_cache(
+            _gerador,
+            imagem_aleatoria(16, 16),
+            cache=cache,
+            chave_limite="teste-vaga",
+            prompt="p",
+            negative_prompt="n",
+        )
+
+    threads = [threading.Thread(target=_pedido) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Seis pedidos iguais: só o líder ocupa uma das três vagas
+    assert livres == [2]
+
+
+# =========================
+# FILA DE JOBS
+# =========================
+
+def test_job_cancelado_nao_vira_concluido():
+    job = comic_core.Job("sessao", "titulo", "nome")
+    assert job.iniciar()
+
+    # O resultado chega logo depois do cancelamento
+    assert job.cancelar()
+    job.finalizar("concluido", ["imagem"], {}, True)
+    assert job.estado == "cancelado"
+    assert job.imagens == []
+
+
+def test_job_concluido_nao_pode_ser_cancelado():
+    job = comic_core.Job("sessao", "titulo", "nome")
+    assert job.finalizar("concluido", ["imagem"], {}, True)
+
+    assert not job.cancelar()
+    assert job.estado == "concluido"
+    assert not job.cancelamento.is_set()
+
+
+def esperar_jobs(fila, sessao_id: str, limite_segundos: float = 5) -> list:
+    fim = time.monotonic() + limite_segundos
+    while time.monotonic() < fim:
+        jobs = fila.listar(sessao_id)
+        if all(job.finalizado for job in jobs):
+            return jobs
+        time.sleep(0.02)
+
+    raise AssertionError([job.estado for job in fila.listar(sessao_id)])
+
+
+def test_job_calcula_o_hash_da_entrada_uma_vez(monkeypatch):
+    chamadas = []
+    original = comic_core.hash_imagem
+    monkeypatch.setattr(comic_core, "hash_imagem", lambda imagem: chamadas.append(1) or original(imagem))
+
+    def _gerador(imagem_pil, prompt, negative_prompt, preservar_fundo=True):
+        return [comic_core.ImagemGerada.de_pil(imagem_pil)], {"model": "teste"}
+
+    limitador = comic_core.LimitadorConcorrencia({}, 1)
+    fila = comic_core.FilaJobs(1, limitador, comic_core.obter_cache_resultados(), 60)
+    fila.submeter("s", "t", "n", "teste", _gerador, imagem_aleatoria(32, 32), prompt="p", negative_prompt="n")
+
+    assert [job.estado for job in esperar_jobs(fila, "s")] == ["concluido"]
+    # Cache vazio: consulta e geração com um só hash dos pixels
+    assert len(chamadas) == 1
+
+
+def test_hedge_na_fila_usa_as_vagas_do_provedor_e_repassa_o_progresso():
+    limitador = comic_core.LimitadorConcorrencia({"lento": 1, "rapido": 1}, 1)
+    fila = comic_core.FilaJobs(2, limitador, comic_core.obter_cache_resultados(), 60)
+    liberar = threading.Event()
+    progresso = []
+
+    def _lento(imagem_pil, prompt, negative_prompt, preservar_fundo=True, model="", stream=False, ao_progresso=None):
+        liberar.wait(5)
+        return [comic_core.ImagemGerada.de_pil(imagem_pil)], {"model": model}
+
+    def _rapido(imagem_pil, prompt, negative_prompt, preservar_fundo=True, model="", stream=False, ao_progresso=None):
+        if ao_progresso is not None:
+            ao_progresso("recebendo", 2_000_000, 1)
+        return [comic_core.ImagemGerada.de_pil(imagem_pil)], {"model": model}
+
+    comuns = {"prompt": "p", "negative_prompt": "n"}
+    fila.submeter("ocupa", "t", "n", "lento", _lento, imagem_aleatoria(16, 16, 1), model="m1", **comuns)
+    time.sleep(0.1)
+
+    fila.submeter(
+        "hedge", "t", "n", "lento", _lento, imagem_aleatoria(16, 16, 2),
+        alternativas=[("rapido", _rapido, {"model": "m2", "stream": True})],
+        hedge_atraso=0.5,
+        model="m1",
+        stream=True,
+        ao_progresso=lambda *args: progresso.append(args),
+        **comuns,
+    )
+    time.sleep(0.1)
+
+    # O primeiro candidato espera a vaga na fila do provedor, sem ocupar o worker livre
+    assert fila.estatisticas()["aguardando_vaga"] == {"lento": 1}
+    fila.submeter("livre", "t", "n", "rapido", _rapido, imagem_aleatoria(16, 16, 3), model="m3", **comuns)
+    assert [job.estado for job in esperar_jobs(fila, "livre", 0.3)] == ["concluido"]
+
+    [job] = esperar_jobs(fila, "hedge", 2)
+    liberar.set()
+    esperar_jobs(fila, "ocupa")
+
+    assert job.estado == "concluido"
+    assert job.bruto["hedge"]["vencedor"] == "m2"
+    assert progresso == [("recebendo", 2_000_000, 1)]
+    assert job.progresso.startswith("recebendo: 2.00 MB")
+
+
+# =========================
+# CORPO JSON COM IMAGEM
+# =========================
+
+@pytest.mark.parametrize("tamanho", [0, 1, 2, 3, CorpoJsonComImagem.BLOCO, 2 * CorpoJsonComImagem.BLOCO + 5])
+def test_corpo_json_igual_ao_json_completo(tamanho):
+    dados = bytes(random.Random(tamanho).getrandbits(8) for _ in range(tamanho))
+    payload = {
+        "model": "teste/modelo",
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": "olá \"comic\""},
+            {"type": "image_url", "image_url": {"url": CorpoJsonComImagem.MARCADOR}},
+        ]}],
+    }
+
+    corpo = CorpoJsonComImagem(payload, dados, "image/jpeg")
+
+    data_url = "data:image/jpeg;base64," + base64.b64encode(dados).decode("ascii")
+    payload["messages"][0]["content"][1]["image_url"]["url"] = data_url
+    esperado = json.dumps(payload).encode("utf-8")
+
+    assert b"".join(corpo) == esperado
+    assert len(corpo) == len(esperado)
+    assert corpo.tamanho_data_url == len(data_url)
+    # Repetição da chamada: o corpo é gerado de novo, igual
+    assert b"".join(corpo) == esperado
+
+
+# =========================
+# STREAM SSE DO OPENROUTER
+# =========================
+
+class RespostaSSE:
+    def __init__(self, linhas: list[bytes]):
+        self._linhas = linhas
+        self.fechada = False
+
+    def iter_lines(self, chunk_size=None):
+        yield from self._linhas
+
+    def close(self):
+        self.fechada = True
+
+
+def test_stream_decodifica_imagens_e_data_url_quebrada_no_texto():
+    imagem = imagem_aleatoria(8, 8, semente=1)
+    outra = imagem_aleatoria(8, 8, semente=2)
+    url = data_url_png(imagem)
+    url_texto = data_url_png(outra)
+
+    def _evento(evento: dict) -> bytes:
+        return b"data: " + json.dumps(evento).encode("utf-8")
+
+    resposta = RespostaSSE([
+        b": OPENROUTER PROCESSING",
+        b"",
+        _evento({"id": "gen-1", "model": "teste/modelo", "choices": [
+            {"delta": {"images": [{"type": "image_url", "image_url": {"url": url}}]}},
+        ]}),
+        _evento({"choices": [{"delta": {"content": "aqui: " + url_texto[:40]}}]}),
+        _evento({"choices": [{"delta": {"content": url_texto[40:]}, "finish_reason": "stop"}]}),
+        b"data: [DONE]",
+    ])
+    progresso = []
+
+    imagens, resumo = ler_stream_openrouter(resposta, ao_progresso=lambda *args: progresso.append(args))
+
+    assert resposta.fechada
+    assert [np.asarray(img.pil).tolist() for img in imagens] == [
+        np.asarray(imagem).tolist(),
+        np.asarray(outra).tolist(),
+    ]
+    assert resumo["id"] == "gen-1"
+    assert resumo["finish_reason"] == "stop"
+    assert resumo["content"] == "aqui: <imagem>"
+    assert progresso[0][0] == "processando"
+    assert progresso[-1] == ("concluído", resumo["bytes_recebidos"], 2)